@@ -25,4 +25,4 @@
 #                                                                         #
 ###########################################################################
 
-__api_version__ = "v1.2"
+from ddreplay_client import __api_version__
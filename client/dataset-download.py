@@ -28,75 +28,51 @@
 
 import sys
 import os
-import requests
-import re
+import argparse
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
-def download_dataset(repo_url, PID, VID=None):
-
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
-
-    repo_url += "/api/" + __api_version__
-
-    req_url = repo_url + "/datasets/" + PID
-
-    if VID is not None:
-        req_url += "/versions/" + VID
+def download_dataset(repo_url, PID, VID=None, destination=None, jobs=8, 
+                     as_zip=False, verify=True):
 
     try:
-        r = requests.get(req_url, stream=True)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as err:
+        with Client(repo_url, pool_size=jobs) as client:
+            if as_zip:
+                filename = client.download_dataset(PID, VID)
+                print('Dataset contents saved to \'' + filename + '\'')
+                return
+
+            result = client.download_dataset_files(PID, VID, destination, jobs, verify)
+    except DDReplayError as err:
         print(err)
         sys.exit(1)
 
-    if 'Content-Disposition' not in r.headers:
-        print('Missing \'Content-Disposition\' headers in response.')
-        sys.exit(1)
-
-    cd = r.headers['Content-Disposition']
-    filename = re.findall('filename=(.+)', cd)
-
-    if len(filename) == 0:
-        print('Missing \'attachment; filename\' field in response')
-        sys.exit(1)
-
-    if len(filename) != 1:
-        print('Too many \'attachment; filename\' fields in response')
-        sys.exit(1)
-
-    filename = filename[0]
-
-    with open(filename, "wb") as outfile:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                outfile.write(chunk)
-
-    print('Dataset contents saved to \'' + filename + '\'')
-
-def help():
-    print("Usage:", os.path.basename(sys.argv[0]), "<URL> <PID> [VID]")
-    print("Downloads the data associated to a Dataset Version identified by PID and VID")
-    print()
-    print("Arguments:")
-    print("    <URL> - repository url")
-    print("    <PID> - Dataset ID")
-    print("    <VID> - Version ID (if unspecified, the latest version is downloaded)")
+    print('Dataset contents ({} files, {} bytes) saved to \'{}\'{}'.format(
+          len(result.files), result.total_bytes, result.destination,
+          ' and verified' if result.verified else ''))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Downloads the data associated to a Dataset Version identified by PID and VID")
+
+    parser.add_argument('url', help="repository url")
+    parser.add_argument('PID', help="Dataset ID")
+    parser.add_argument('VID', nargs='?', default=None,
+            help="Version ID (if unspecified, the latest version is downloaded)")
+    parser.add_argument('-o', '--output', default=None,
+            help="destination directory (default: <PID>)")
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+            help="number of concurrent connections")
+    parser.add_argument('--zip', action='store_true',
+            help="download the contents as a single zip file")
+    parser.add_argument('--no-verify', action='store_true',
+            help="don't verify the downloaded files")
+
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 3:
-        help()
-        sys.exit(1)
-
-    repo_url = sys.argv[1]
-    PID = sys.argv[2]
-
-    if len(sys.argv) == 4:
-        VID = sys.argv[3]
-    else:
-        VID = None
+    args = parse_args(sys.argv[1:])
 
-    download_dataset(repo_url, PID, VID)
+    download_dataset(args.url, args.PID, args.VID, args.output, args.jobs,
+                     args.zip, not args.no_verify)
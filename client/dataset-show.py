@@ -28,34 +28,24 @@
 
 import sys
 import os
-import requests
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
 def show_dataset(repo_url, PID=None, VID=None):
 
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
-
-    repo_url += "/api/" + __api_version__
-
-    req_url = repo_url + "/datasets"
+    req_path = "/datasets/"
 
     if PID is not None:
-        req_url += "/" + PID + "/versions/"
+        req_path += PID + "/versions/"
 
         if VID is not None and VID != 'all':
-            req_url += VID + "/record"
+            req_path += VID + "/record"
 
     try:
-        r = requests.get(req_url)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print(err)
-        sys.exit(1)
-
-    if r.status_code != 200:
-        print("Unable to list dataset: HTTP Error", r.status_code)
+        with Client(repo_url) as client:
+            r = client.request('GET', req_path)
+    except DDReplayError as err:
+        print("Unable to list dataset:", err)
         sys.exit(1)
 
     print(r.text, end='')
@@ -28,28 +28,16 @@
 
 import sys
 import os
-import requests
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
 def create_draft_from_dataset(repo_url, PID):
 
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
-
-    repo_url += "/api/" + __api_version__
-
-    req_url = repo_url + "/datasets/" + PID + "/"
-
     try:
-        r = requests.put(req_url)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print(err)
-        sys.exit(1)
-
-    if r.status_code != 201:
-        print("Unable to create draft from dataset: HTTP Error", r.status_code)
+        with Client(repo_url) as client:
+            r = client.request('PUT', '/datasets/' + PID + '/', expected=(201,))
+    except DDReplayError as err:
+        print("Unable to create draft from dataset:", err)
         sys.exit(1)
 
     print(r.text, end='')
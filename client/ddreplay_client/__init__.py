@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+""" Python client library for the Dataset Replayer REST API.
+
+Example:
+
+    from ddreplay_client import Client
+
+    with Client("localhost:5000") as client:
+        draft = client.create_draft()
+        client.upload_file(draft.id, "data.csv")
+        version = client.publish_draft(draft.id, "author", "first version")
+"""
+
+__api_version__ = "v1.2"
+
+from .errors import DDReplayError, ConnectionError, HTTPError, NotFoundError, \
+                    ConflictError
+from .models import Draft, Dataset, Version, Fingerprints, UploadResult
+from .client import Client
+from .fpcache import FingerprintCache
+from .download import ParallelDownloader, DownloadResult
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+""" content-defined chunking with the parameters of a dataset.
+
+The chunking parameters of a draft are sent by the server with its 
+fingerprints (see Client.get_fingerprints), e.g.:
+
+    {"average_block_size": 4096, "max_block_size": 32768, "min_block_size": 1024}
+
+Local files must be fingerprinted with the same parameters for deltas to 
+work. The 'algorithm' parameter selects the chunker ('rabin' if missing, or
+'fastcdc', which doesn't need pyrabin). pyrabin keeps its parameters as 
+global state, so Rabin fingerprints for non-default parameters are computed
+in worker processes configured for them.
+"""
+
+import os
+import json
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import rabin as librp
+except ImportError:
+    librp = None
+
+from . import fastcdc
+from .errors import DDReplayError
+from .transfer import add_chunk_digests
+
+def chunking_key(params):
+    """ a string that identifies the chunking parameters ``params`` """
+
+    if not params:
+        return 'default'
+
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+def _configure_worker(params):
+    for name, value in params.items():
+        getattr(librp, 'set_' + name)(value)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+try:
+    _mp_context = multiprocessing.get_context('forkserver')
+except ValueError:
+    _mp_context = multiprocessing.get_context('spawn')
+
+def _get_pool(params):
+    key = chunking_key(params)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ProcessPoolExecutor(max_workers=os.cpu_count(), 
+                                              mp_context=_mp_context,
+                                              initializer=_configure_worker,
+                                              initargs=(params,))
+        return _pools[key]
+
+def get_file_fingerprints(filepath, params=None):
+    """ compute the Rabin fingerprints of ``filepath`` with the chunking
+    parameters ``params`` (pyrabin's defaults if None) """
+
+    if librp is None:
+        raise DDReplayError("Computing Rabin fingerprints requires the 'rabin' module")
+
+    if not params:
+        return librp.get_file_fingerprints(filepath)
+
+    return _get_pool(params).submit(librp.get_file_fingerprints, filepath).result()
+
+def _rabin_fingerprints(filepath, params):
+    return add_chunk_digests(filepath, get_file_fingerprints(filepath, params))
+
+def _fastcdc_fingerprints(filepath, params):
+    return fastcdc.fingerprint_file(filepath, params)[0]
+
+_chunkers = {
+    'rabin' : _rabin_fingerprints,
+    'fastcdc' : _fastcdc_fingerprints,
+}
+
+def fingerprint_file(filepath, params=None):
+    """ compute the fingerprints of ``filepath``, including the digests of 
+    its chunks, with the chunking parameters ``params`` of a dataset """
+
+    params = dict(params or {})
+    algorithm = params.pop('algorithm', 'rabin')
+
+    if algorithm not in _chunkers:
+        raise DDReplayError("Unsupported chunking algorithm '{}'".format(algorithm))
+
+    return _chunkers[algorithm](filepath, params)
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+import os
+import re
+import json
+import _pickle
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder, \
+                                                MultipartEncoderMonitor
+
+from . import __api_version__
+from .errors import DDReplayError, ConnectionError, error_for_response
+from .models import Draft, Dataset, Version, Fingerprints, UploadResult
+from .chunking import fingerprint_file, chunking_key
+from .download import ParallelDownloader
+from .transfer import find_deltas, negotiate_upload_encoding, \
+                      looks_compressed, CompressedBody, FileView
+
+# requests that can be safely retried if the connection drops after the 
+# request was sent or the server is temporarily unavailable. Requests with a
+# body (uploads) and requests that create new objects are only retried if 
+# the connection could not be established
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'DELETE'])
+
+RETRY_STATUS = (502, 503, 504)
+
+# identifies the kind of fingerprints stored in the fingerprint cache
+FINGERPRINT_PARAMS = 'rabin+sha256'
+
+# header with the chunking parameters of a draft's fingerprints
+CHUNKING_HEADER = 'X-DDReplay-Chunking'
+
+# header sent by servers that key all fingerprints by path
+FINGERPRINT_KEYS_HEADER = 'X-DDReplay-Fingerprint-Keys'
+
+def make_retry(retries, backoff_factor):
+    kwargs = dict(total=retries, connect=retries, read=retries, status=retries,
+                  backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS,
+                  raise_on_status=False) 
+
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # older urllib3 versions
+        kwargs.pop('raise_on_status')
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+def lookup_fingerprints(server_fps, repo_path):
+    """ return the fingerprints for the file at ``repo_path`` (its full path
+    in the draft) from the draft fingerprints ``server_fps``. Older servers
+    keyed files created by a single upload by their name only, so their 
+    name is only tried for sets with ``legacy_keys`` """
+
+    repo_path = repo_path.strip('/')
+
+    if repo_path in server_fps:
+        return server_fps[repo_path]
+
+    if not getattr(server_fps, 'legacy_keys', False):
+        return None
+
+    return server_fps.get(repo_path.rsplit('/', 1)[-1])
+
+class Client:
+    """ This class provides access to a Dataset Replayer repository. A single
+    instance keeps a pool of keep-alive connections to the repository (up to
+    ``pool_size``) and can be shared by several threads. Failed requests
+    are retried ``retries`` times, waiting ``backoff_factor * 2^n`` seconds
+    between attempts.
+    """
+
+    def __init__(self, repo_url, pool_size=10, retries=3, backoff_factor=0.5,
+                 timeout=None, compress_uploads=True, fingerprint_cache=None):
+
+        if "http" not in repo_url:
+            repo_url = "http://" + repo_url
+
+        self.base_url = repo_url.rstrip('/') + "/api/" + __api_version__
+        self.timeout = timeout
+        self.compress_uploads = compress_uploads
+
+        # optional FingerprintCache for local files
+        self.fingerprint_cache = fingerprint_cache
+
+        # encodings accepted by the server for request bodies, as advertised
+        # in its last response
+        self.accept_encoding = None
+
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=make_retry(retries, backoff_factor))
+
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ##### low level API #####
+    def request(self, method, path, expected=(200,), **kwargs):
+        """ send a request to ``path`` (relative to the API root) and return
+        the response, raising a DDReplayError if its status is not one of 
+        ``expected`` """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        try:
+            r = self.session.request(method, self.base_url + path, **kwargs)
+        except requests.exceptions.RequestException as err:
+            raise ConnectionError(str(err)) from err
+
+        if 'Accept-Encoding' in r.headers:
+            self.accept_encoding = r.headers['Accept-Encoding']
+
+        if r.status_code not in expected:
+            raise error_for_response(r)
+
+        return r
+
+    def _download(self, path, dst_dir):
+
+        r = self.request('GET', path, stream=True)
+
+        filenames = re.findall('filename=(.+)', r.headers.get('Content-Disposition', ''))
+
+        if len(filenames) != 1:
+            raise DDReplayError("Missing or malformed 'Content-Disposition' "
+                                "header in response")
+
+        filename = os.path.join(dst_dir, filenames[0])
+
+        with open(filename, "wb") as outfile:
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                if chunk:
+                    outfile.write(chunk)
+
+        return filename
+
+    def _prepare_body(self, multipart_data, headers, local_filepath, progress):
+        """ return the body to send for ``multipart_data`` (compressed if 
+        the server supports it), updating ``headers`` accordingly """
+
+        encoding = None
+
+        if self.compress_uploads and not looks_compressed(local_filepath):
+            if self.accept_encoding is None:
+                # any response will do to learn what the server accepts
+                self.request('HEAD', '/drafts/')
+            encoding = negotiate_upload_encoding(self.accept_encoding)
+
+        callback = None
+        if progress is not None:
+            callback = lambda monitor: progress(monitor.bytes_read, monitor.len)
+
+        if encoding is None:
+            if callback is None:
+                return multipart_data
+            return MultipartEncoderMonitor(multipart_data, callback)
+
+        body = CompressedBody(multipart_data, encoding)
+        body.callback = callback
+        headers["Content-Encoding"] = encoding
+
+        return body
+
+    def compute_fingerprints(self, local_filepath, chunking=None):
+        """ return the fingerprints of ``local_filepath`` computed with the
+        ``chunking`` parameters of the draft (e.g. ``server_fps.chunking``),
+        reusing the ones in the fingerprint cache if the file hasn't changed """
+
+        def compute(filepath):
+            return fingerprint_file(filepath, chunking)
+
+        if self.fingerprint_cache is not None:
+            params = FINGERPRINT_PARAMS
+            if chunking:
+                params += ':' + chunking_key(chunking)
+
+            return self.fingerprint_cache.get_file_fingerprints(local_filepath,
+                    params, compute=compute)
+
+        return compute(local_filepath)
+
+    ##### drafts #####
+    def list_drafts(self):
+        r = self.request('GET', '/drafts/')
+        return [ Draft(d) for d in r.json()['drafts'] ]
+
+    def get_draft(self, DID):
+        r = self.request('GET', '/drafts/' + DID + '/record')
+        return Draft(r.json()['draft'])
+
+    def create_draft(self, compression=None, chunking=None):
+        """ create an empty draft. ``chunking`` is the name of one of the
+        chunking profiles defined in the repository """
+        params = {}
+        if compression is not None:
+            params['compression'] = compression
+        if chunking is not None:
+            params['chunking'] = chunking
+
+        r = self.request('POST', '/drafts/', expected=(201,), params=params)
+        return Draft(r.json()['draft'])
+
+    def delete_draft(self, DID):
+        self.request('DELETE', '/drafts/' + DID, expected=(204,))
+
+    def delete_path(self, DID, repo_path):
+        """ remove the file or directory ``repo_path`` from the draft and 
+        return the updated draft """
+        r = self.request('DELETE', '/drafts/' + DID + '/' + repo_path.strip('/'))
+        return Draft(r.json()['draft'])
+
+    def move_path(self, DID, src_path, dst_path):
+        """ move (rename) the file or directory ``src_path`` of the draft to
+        ``dst_path`` and return the updated draft. No data is sent """
+        r = self.request('POST', '/drafts/' + DID + '/move', 
+                         params={'source' : src_path, 'destination' : dst_path})
+        return Draft(r.json()['draft'])
+
+    def copy_path(self, DID, src_path, dst_path):
+        """ copy the file or directory ``src_path`` of the draft to 
+        ``dst_path`` and return the updated draft. No data is sent """
+        r = self.request('POST', '/drafts/' + DID + '/copy', 
+                         params={'source' : src_path, 'destination' : dst_path})
+        return Draft(r.json()['draft'])
+
+    def download_draft(self, DID, dst_dir='.'):
+        """ download the contents of the draft as a zip file into ``dst_dir``
+        and return its path """
+        return self._download('/drafts/' + DID, dst_dir)
+
+    def download_draft_files(self, DID, destination, jobs=8, verify=True, 
+                             progress=None):
+        """ download the files of the draft into the directory ``destination``
+        using up to ``jobs`` concurrent requests """
+
+        downloader = ParallelDownloader(self, jobs, verify=verify, progress=progress)
+        return downloader.download('/drafts/' + DID, destination)
+
+    def publish_draft(self, DID, author, message):
+        r = self.request('POST', '/drafts/' + DID + '/publish', expected=(201,),
+                         params={'author' : author, 'message' : message})
+        return Version(r.json()['version'])
+
+    def get_fingerprints(self, DID):
+        """ return the fingerprints of all the files in the draft, as a 
+        Fingerprints dictionary {path : [(offset, size, fingerprint, digest), 
+        ...]} that also has the draft's chunking parameters """
+        r = self.request('GET', '/drafts/' + DID + '/fingerprints')
+
+        chunking = r.headers.get(CHUNKING_HEADER)
+
+        return Fingerprints(_pickle.loads(r.content), 
+                            json.loads(chunking) if chunking else None,
+                            legacy_keys=r.headers.get(FINGERPRINT_KEYS_HEADER) != 'path')
+
+    def upload_file(self, DID, local_filepath, repo_filepath=None, usr_path=None,
+                    unpack=False, progress=None):
+        """ upload ``local_filepath`` into the draft as ``repo_filepath`` (by 
+        default, its basename) inside the directory ``usr_path`` (which can
+        also be given as part of ``repo_filepath``). If ``unpack``
+        is True and the file is an archive, its contents are extracted. 
+        ``progress(bytes_sent, total)`` is called as data is sent """
+
+        if repo_filepath is None:
+            repo_filepath = os.path.basename(local_filepath)
+
+        if usr_path is None and '/' in repo_filepath:
+            usr_path, repo_filepath = repo_filepath.rsplit('/', 1)
+
+        path = '/drafts/' + DID
+        if usr_path is not None:
+            path += '/' + usr_path.strip('/')
+
+        bytes_in_file = os.path.getsize(local_filepath)
+
+        with open(local_filepath, "rb") as infile:
+
+            multipart_data = MultipartEncoder(
+                    fields = {"file": (repo_filepath, infile, "application/octet-stream")
+            })
+
+            # the user-provided filename is passed using the content-disposition
+            # HTTP header
+            headers = {"Content-Type": multipart_data.content_type,
+                       "content-disposition": "attachment; filename=" + repo_filepath}
+
+            body = self._prepare_body(multipart_data, headers, local_filepath, progress)
+
+            r = self.request('PUT', path, headers=headers, data=body,
+                             params={'unpack' : 'true'} if unpack else None)
+
+        return UploadResult(Draft(r.json()['draft']), repo_filepath, 'upload',
+                            bytes_in_file, bytes_in_file)
+
+    def replace_file(self, DID, local_filepath, repo_filepath, usr_path=None,
+                     server_fps=None, local_fps=None, progress=None):
+        """ replace ``repo_filepath`` in the draft with the contents of 
+        ``local_filepath``, sending only the chunks that the server doesn't
+        have. ``server_fps`` can be provided to avoid fetching the draft's 
+        fingerprints again (e.g. when replacing many files), and 
+        ``local_fps`` to avoid recomputing the ones for the local file (if
+        the client has a fingerprint cache, they are also looked up there) """
+
+        if usr_path is None and '/' in repo_filepath:
+            usr_path, repo_filepath = repo_filepath.rsplit('/', 1)
+
+        # step 1. get the dataset's fingerprints from the server
+        if server_fps is None:
+            server_fps = self.get_fingerprints(DID)
+
+        full_path = repo_filepath
+        if usr_path is not None:
+            full_path = usr_path.strip('/') + '/' + repo_filepath
+
+        stored_fps = lookup_fingerprints(server_fps, full_path)
+
+        if stored_fps is None:
+            raise DDReplayError("No fingerprints for '{}' in draft {}".format(
+                                full_path, DID))
+
+        # step 2. compute the local_filepath's fingerprints
+        if local_fps is None:
+            local_fps = self.compute_fingerprints(local_filepath, 
+                                                  getattr(server_fps, 'chunking', None))
+
+        # step 3. compare the fingerprints for differences
+        deltas = find_deltas(local_fps, stored_fps)
+
+        bytes_in_file = os.path.getsize(local_filepath)
+
+        if len(deltas) == 0:
+            return UploadResult(None, repo_filepath, 'unchanged', bytes_in_file, 0)
+
+        # step 4. upload differing fragments from the local file
+        fields = [
+            ("fingerprints", (repo_filepath + ".fps", _pickle.dumps(local_fps), 
+                              "application/octet-stream"))
+        ]
+
+        bytes_to_transfer = 0
+
+        for offset, size, _ in deltas:
+            bytes_to_transfer += size
+
+            fields.append(
+                ("parts",
+                (repo_filepath + ".__part_" + str(offset) + "_" + str(size) + "__",
+                FileView(local_filepath, offset, size),
+                "application/octet-stream"
+                ))
+            )
+
+        multipart_data = MultipartEncoder(fields = fields)
+
+        headers = {"Content-Type": multipart_data.content_type,
+                   "content-disposition": "attachment; filename=" + repo_filepath}
+
+        body = self._prepare_body(multipart_data, headers, local_filepath, progress)
+
+        path = '/drafts/' + DID
+        if usr_path is not None:
+            path += '/' + usr_path.strip('/')
+
+        r = self.request('PUT', path, headers=headers, data=body,
+                         params={'replace' : 'true'})
+
+        return UploadResult(Draft(r.json()['draft']), repo_filepath, 'replace',
+                            bytes_in_file, bytes_to_transfer)
+
+    def upload_batch(self, DID, new_files=None, replaced_files=None, 
+                     server_fps=None, local_fps=None, usr_path=None, progress=None):
+        """ upload several files to the draft in a single request, which the 
+        server processes concurrently and commits at once. ``new_files`` and
+        ``replaced_files`` map paths in the draft (relative to ``usr_path``) 
+        to local files. Only the chunks that the server doesn't have are sent
+        for replaced files (``local_fps`` can map their paths to already 
+        computed fingerprints). Returns a list of UploadResult.
+        """
+
+        new_files = new_files or {}
+        replaced_files = replaced_files or {}
+
+        fields = []
+        results = []
+        open_files = []
+
+        try:
+            for repo_filepath, local_filepath in sorted(new_files.items()):
+                infile = open(local_filepath, "rb")
+                open_files.append(infile)
+
+                fields.append(("files", (repo_filepath, infile, "application/octet-stream")))
+
+                size = os.path.getsize(local_filepath)
+                results.append(UploadResult(None, repo_filepath, 'upload', size, size))
+
+            if len(replaced_files) > 0 and server_fps is None:
+                server_fps = self.get_fingerprints(DID)
+
+            for repo_filepath, local_filepath in sorted(replaced_files.items()):
+                full_path = repo_filepath
+                if usr_path is not None:
+                    full_path = usr_path.strip('/') + '/' + repo_filepath
+
+                stored_fps = lookup_fingerprints(server_fps, full_path)
+
+                if stored_fps is None:
+                    raise DDReplayError("No fingerprints for '{}' in draft {}".format(
+                                        full_path, DID))
+
+                file_fps = (local_fps or {}).get(repo_filepath)
+                if file_fps is None:
+                    file_fps = self.compute_fingerprints(local_filepath, 
+                                                         getattr(server_fps, 'chunking', None))
+
+                deltas = find_deltas(file_fps, stored_fps)
+                size = os.path.getsize(local_filepath)
+
+                if len(deltas) == 0:
+                    results.append(UploadResult(None, repo_filepath, 'unchanged', size, 0))
+                    continue
+
+                fields.append(("replace.fingerprints", 
+                               (repo_filepath, _pickle.dumps(file_fps), 
+                                "application/octet-stream")))
+
+                for offset, length, _ in deltas:
+                    fields.append(("replace.parts",
+                        (repo_filepath + ".__part_" + str(offset) + "_" + str(length) + "__",
+                         FileView(local_filepath, offset, length),
+                         "application/octet-stream")))
+
+                results.append(UploadResult(None, repo_filepath, 'replace', size,
+                                            sum(d[1] for d in deltas)))
+
+            if len(fields) == 0:
+                return results
+
+            multipart_data = MultipartEncoder(fields = fields)
+
+            headers = {"Content-Type": multipart_data.content_type}
+
+            # deciding whether compressing the whole batch pays off based on a
+            # single file is a bit crude, but batches are usually homogeneous
+            body = self._prepare_body(multipart_data, headers, 
+                    next(iter(new_files.values()), None) or 
+                    next(iter(replaced_files.values())), progress)
+
+            path = '/drafts/' + DID + '/batch'
+            if usr_path is not None:
+                path += '/' + usr_path.strip('/')
+
+            r = self.request('POST', path, headers=headers, data=body)
+
+        finally:
+            for f in open_files:
+                f.close()
+
+        draft = Draft(r.json()['draft'])
+
+        for result in results:
+            result.draft = draft
+
+        return results
+
+    ##### datasets #####
+    def list_datasets(self):
+        r = self.request('GET', '/datasets/')
+        return [ Dataset(d) for d in r.json()['datasets'] ]
+
+    def list_versions(self, PID):
+        r = self.request('GET', '/datasets/' + PID + '/versions/')
+        return [ Version(v) for v in r.json()['versions'] ]
+
+    def get_version(self, PID, VID=None):
+        """ return the version ``VID`` of dataset ``PID`` (by default, the 
+        latest one) """
+
+        if VID is None:
+            r = self.request('GET', '/datasets/' + PID + '/record')
+        else:
+            r = self.request('GET', '/datasets/' + PID + '/versions/' + VID + '/record')
+
+        return Version(r.json()['version'])
+
+    def download_dataset(self, PID, VID=None, dst_dir='.'):
+        """ download the contents of a dataset version (by default, the latest
+        one) as a zip file into ``dst_dir`` and return its path """
+
+        path = '/datasets/' + PID
+
+        if VID is not None:
+            path += '/versions/' + VID
+
+        return self._download(path + '/', dst_dir)
+
+    def list_files(self, PID=None, VID=None, DID=None):
+        """ return the list of files (with their sizes) of a draft or of a
+        dataset version (by default, the latest one) """
+
+        if DID is not None:
+            path = '/drafts/' + DID
+        else:
+            path = '/datasets/' + PID
+            if VID is not None:
+                path += '/versions/' + VID
+
+        return self.request('GET', path + '/files/').json()['files']
+
+    def download_dataset_files(self, PID, VID=None, destination=None, jobs=8,
+                               verify=True, progress=None):
+        """ download the files of a dataset version (by default, the latest 
+        one) into the directory ``destination`` (by default, one named after
+        the dataset) using up to ``jobs`` concurrent requests """
+
+        path = '/datasets/' + PID
+
+        if VID is not None:
+            path += '/versions/' + VID
+
+        if destination is None:
+            destination = PID
+
+        downloader = ParallelDownloader(self, jobs, verify=verify, progress=progress)
+        return downloader.download(path, destination)
+
+    def create_draft_from_dataset(self, PID):
+        r = self.request('PUT', '/datasets/' + PID + '/', expected=(201,))
+        return Draft(r.json()['draft'])
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+""" parallel download of drafts and dataset versions """
+
+import os
+import tempfile
+import threading
+import zipfile
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import rabin as librp
+except ImportError:
+    librp = None
+
+from .errors import DDReplayError, ConnectionError, NotFoundError
+from .transfer import fingerprints_digest, file_sha256
+
+class DownloadResult:
+    """ outcome of downloading a draft or version """
+
+    def __init__(self, destination, files, total_bytes, verified, mode):
+        self.destination = destination
+        self.files = files
+        self.total_bytes = total_bytes
+        self.verified = verified
+        self.mode = mode
+
+    def __repr__(self):
+        return "DownloadResult(destination={!r}, files={}, total_bytes={}, " \
+               "verified={}, mode={!r})".format(self.destination, len(self.files),
+                self.total_bytes, self.verified, self.mode)
+
+def _is_unsafe_path(path):
+    """ a path sent by the server must stay inside the destination """
+    return path.startswith('/') or '..' in path.split('/')
+
+class ParallelDownloader:
+    """ This class downloads all the files of a draft or version into a local
+    directory, fetching several files (or ranges of large files) at the same
+    time over the pooled connections of ``client``. Files larger than 
+    ``part_size`` are split into ranges. Each file is written to a temporary
+    name and renamed once complete (and verified, if ``verify`` is True).
+    """
+
+    def __init__(self, client, jobs=8, part_size=32*1024*1024, 
+                 buffer_size=1024*1024, verify=True, progress=None):
+        self.client = client
+        self.jobs = jobs
+        self.part_size = part_size
+        self.buffer_size = buffer_size
+        self.verify = verify
+        self.progress = progress
+        self.retries = 3
+
+        self.lock = threading.Lock()
+        self.bytes_done = 0
+
+    def _report(self, nbytes, total):
+        if self.progress is None:
+            return
+
+        with self.lock:
+            self.bytes_done += nbytes
+            done = self.bytes_done
+
+        self.progress(done, total)
+
+    def _fetch_range(self, url_path, fd, start, stop, size, total):
+        """ download bytes [start, stop) of the file into ``fd``, resuming
+        from the last byte received if the connection drops """
+
+        offset = start
+        failures = 0
+
+        while offset < stop:
+            headers = {'Range' : 'bytes={}-{}'.format(offset, stop - 1)}
+
+            try:
+                r = self.client.request('GET', url_path, expected=(200, 206),
+                                        headers=headers, stream=True)
+
+                # the whole file was sent: only acceptable if it was requested
+                if r.status_code == 200 and (offset != 0 or stop != size):
+                    r.close()
+                    raise DDReplayError("The server does not support Range requests")
+
+                for chunk in r.iter_content(self.buffer_size):
+                    chunk = chunk[:stop - offset]
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                    self._report(len(chunk), total)
+
+                r.close()
+
+            except (ConnectionError, requests.exceptions.RequestException) as err:
+                failures += 1
+                if failures > self.retries:
+                    raise DDReplayError("Download of {} failed: {}".format(url_path, err))
+                continue
+
+            if offset < stop:
+                failures += 1
+                if failures > self.retries:
+                    raise DDReplayError("Incomplete download of " + url_path)
+
+    def _download_file(self, base_path, entry, destination, total):
+        relpath = entry['path']
+
+        if _is_unsafe_path(relpath):
+            raise DDReplayError("Unsafe path in manifest: " + relpath)
+
+        dst_file = os.path.join(destination, *relpath.split('/'))
+        tmp_file = dst_file + '.ddreplay-part'
+
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+        size = entry['size']
+        url_path = base_path + '/files/' + relpath
+
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        try:
+            os.ftruncate(fd, size)
+
+            ranges = [ (o, min(o + self.part_size, size)) 
+                        for o in range(0, size, self.part_size) ]
+
+            if len(ranges) == 1:
+                self._fetch_range(url_path, fd, 0, size, size, total)
+            elif len(ranges) > 1:
+                # large files are split into ranges that are fetched in 
+                # parallel by a dedicated pool, so that the main pool can
+                # only block on whole files (avoiding deadlocks)
+                with ThreadPoolExecutor(max_workers=min(self.jobs, len(ranges))) as pool:
+                    futures = [ pool.submit(self._fetch_range, url_path, fd, 
+                                            start, stop, size, total) 
+                                    for start, stop in ranges ]
+                    for f in futures:
+                        f.result()
+        finally:
+            os.close(fd)
+
+        if os.path.getsize(tmp_file) != size:
+            os.remove(tmp_file)
+            raise DDReplayError("Size mismatch for '{}'".format(relpath))
+
+        verified = False
+
+        if self.verify and entry.get('sha256') is not None:
+            if file_sha256(tmp_file) != entry['sha256']:
+                os.remove(tmp_file)
+                raise DDReplayError("Verification failed for '{}'".format(relpath))
+            verified = True
+        elif self.verify and entry.get('fingerprints') is not None and librp is not None:
+            if fingerprints_digest(librp.get_file_fingerprints(tmp_file)) != \
+                    entry['fingerprints']:
+                os.remove(tmp_file)
+                raise DDReplayError("Verification failed for '{}'".format(relpath))
+            verified = True
+
+        os.replace(tmp_file, dst_file)
+
+        return relpath, verified
+
+    def download(self, base_path, destination):
+        """ download all the files of the draft/version at ``base_path`` (e.g.
+        '/drafts/<DID>') into the directory ``destination`` """
+
+        try:
+            manifest = self.client.request('GET', base_path + '/files/').json()
+        except NotFoundError:
+            # servers that don't support downloading single files can only
+            # send the whole contents as a zip
+            return self._download_zip(base_path, destination)
+
+        total = manifest.get('total_size', sum(f['size'] for f in manifest['files']))
+        files = []
+        verified = True
+
+        # refuse the whole manifest before anything is written
+        for entry in manifest['files']:
+            if _is_unsafe_path(entry['path']):
+                raise DDReplayError("Unsafe path in manifest: " + entry['path'])
+
+        os.makedirs(destination, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [ pool.submit(self._download_file, base_path, entry, 
+                                    destination, total) 
+                            for entry in manifest['files'] ]
+
+            for f in as_completed(futures):
+                relpath, file_verified = f.result()
+                files.append(relpath)
+                verified = verified and file_verified
+
+        return DownloadResult(destination, sorted(files), total, verified, 'parallel')
+
+    def _download_zip(self, base_path, destination):
+
+        if base_path.startswith('/datasets/'):
+            base_path += '/'
+
+        r = self.client.request('GET', base_path, stream=True)
+
+        with tempfile.TemporaryFile() as spool:
+            for chunk in r.iter_content(self.buffer_size):
+                spool.write(chunk)
+
+            spool.seek(0)
+
+            with zipfile.ZipFile(spool) as archive:
+                for name in archive.namelist():
+                    if _is_unsafe_path(name):
+                        raise DDReplayError("Unsafe path in archive: " + name)
+
+                archive.extractall(destination)
+                files = [ i.filename for i in archive.infolist() if not i.is_dir() ]
+                total = sum(i.file_size for i in archive.infolist())
+
+        return DownloadResult(destination, sorted(files), total, False, 'zip')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+class DDReplayError(Exception):
+    """ base class for all errors raised by the client library """
+    pass
+
+class ConnectionError(DDReplayError):
+    """ the repository could not be reached (after retrying) """
+    pass
+
+class HTTPError(DDReplayError):
+    """ the repository returned an unexpected HTTP status """
+
+    def __init__(self, status_code, message, response=None):
+        super().__init__("HTTP Error {}: {}".format(status_code, message))
+        self.status_code = status_code
+        self.response = response
+
+class NotFoundError(HTTPError):
+    """ the requested draft, dataset or version does not exist (HTTP 404) """
+    pass
+
+class ConflictError(HTTPError):
+    """ the request conflicts with the state of the repository (HTTP 409) """
+    pass
+
+def error_for_response(response):
+    """ build the appropriate exception for the (failed) ``response`` """
+
+    message = response.reason
+
+    try:
+        message = response.json().get('message', message)
+    except ValueError:
+        pass
+
+    if response.status_code == 404:
+        return NotFoundError(404, message, response)
+
+    if response.status_code == 409:
+        return ConflictError(409, message, response)
+
+    return HTTPError(response.status_code, message, response)
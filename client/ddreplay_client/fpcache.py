@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+""" persistent cache of the fingerprints of local files """
+
+import os
+import time
+import sqlite3
+import threading
+import _pickle
+
+try:
+    import rabin as librp
+except ImportError:
+    librp = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT NOT NULL,
+    params TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    fps BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (path, params)
+)
+"""
+
+# files modified less than this many seconds ago are not cached, since they 
+# may still be modified without their mtime changing (e.g. on filesystems
+# with a coarse timestamp granularity)
+RACY_INTERVAL = 2.0
+
+# the time an entry was last used is only updated if it is older than this 
+# many seconds (it is only needed to prune old entries), and the updates are
+# written in batches of up to USAGE_BATCH_SIZE entries (see flush())
+USAGE_RESOLUTION = 3600.0
+USAGE_BATCH_SIZE = 1000
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', 
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ddreplay', 'fingerprints.sqlite')
+
+class FingerprintCache:
+    """ This class caches the fingerprints of local files in a SQLite 
+    database, so that unchanged files don't need to be read again. An entry 
+    is only valid while the file keeps the same device, inode, size and 
+    modification time. ``params`` identifies the chunking parameters used to 
+    compute the fingerprints, since they are only comparable when computed
+    with the same ones. Lookups do not write to the database: the usage of 
+    the entries is recorded in memory and written by flush() (or close()).
+    """
+
+    def __init__(self, path=None):
+
+        if path is None:
+            path = default_cache_path()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # pending updates of 'last_used' {(path, params) : time}
+        self.used = {}
+
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self.lock, self.db:
+            if path != ':memory:':
+                # allow several clients to use the cache at the same time
+                self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(SCHEMA)
+
+    def close(self):
+        self.flush()
+
+        with self.lock:
+            self.db.close()
+
+    def flush(self):
+        """ write the pending updates of the time the entries were used """
+
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+
+        if not self.used:
+            return
+
+        with self.db:
+            self.db.executemany("UPDATE fingerprints SET last_used = ? WHERE "
+                                "path = ? AND params = ?", 
+                                [ (t, path, params) for (path, params), t in self.used.items() ])
+
+        self.used = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _identity(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, filepath, params='default', st=None):
+        """ return the cached fingerprints for ``filepath`` or None if there
+        are none or the file has changed """
+
+        filepath = os.path.abspath(filepath)
+
+        if st is None:
+            st = os.stat(filepath)
+
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT dev, inode, size, mtime_ns, fps, last_used FROM fingerprints "
+                    "WHERE path = ? AND params = ?", (filepath, params)).fetchone()
+
+            if row is None or tuple(row[:4]) != self._identity(st):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            now = time.time()
+
+            if now - row[5] > USAGE_RESOLUTION:
+                self.used[(filepath, params)] = now
+
+                if len(self.used) >= USAGE_BATCH_SIZE:
+                    self._flush()
+
+        return _pickle.loads(row[4])
+
+    def store(self, filepath, fps, params='default', st=None):
+        """ save the fingerprints ``fps`` of ``filepath`` """
+
+        filepath = os.path.abspath(filepath)
+
+        if st is None:
+            st = os.stat(filepath)
+
+        if time.time() - st.st_mtime_ns / 1e9 < RACY_INTERVAL:
+            return
+
+        with self.lock, self.db:
+            self.used.pop((filepath, params), None)
+            self.db.execute("INSERT OR REPLACE INTO fingerprints VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?, ?)", 
+                            (filepath, params) + self._identity(st) + 
+                            (_pickle.dumps(fps), time.time()))
+
+    def get_file_fingerprints(self, filepath, params='default', compute=None):
+        """ return the fingerprints of ``filepath``, computing them with 
+        ``compute(filepath)`` (by default, rabin's get_file_fingerprints)
+        if they are not in the cache """
+
+        if compute is None:
+            compute = librp.get_file_fingerprints
+
+        st = os.stat(filepath)
+
+        fps = self.lookup(filepath, params, st)
+
+        if fps is not None:
+            return fps
+
+        fps = compute(filepath)
+
+        # the file may have changed while we were reading it
+        if self._identity(os.stat(filepath)) == self._identity(st):
+            self.store(filepath, fps, params, st)
+
+        return fps
+
+    def prune(self, max_age=30*24*3600, remove_missing=True):
+        """ remove the entries that haven't been used in ``max_age`` seconds
+        and (optionally) those of files that no longer exist """
+
+        with self.lock:
+            self._flush()
+
+        with self.lock, self.db:
+            cursor = self.db.execute("DELETE FROM fingerprints WHERE last_used < ?",
+                                     (time.time() - max_age,))
+            removed = cursor.rowcount
+
+            if remove_missing:
+                paths = [ r[0] for r in self.db.execute("SELECT DISTINCT path FROM fingerprints") ]
+                for p in paths:
+                    if not os.path.exists(p):
+                        removed += self.db.execute("DELETE FROM fingerprints WHERE path = ?", 
+                                                   (p,)).rowcount
+
+        return removed
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+import datetime as dt
+
+def parse_datetime(value):
+    if value is None:
+        return None
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f+00:00', '%Y-%m-%dT%H:%M:%S+00:00', 
+                '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return dt.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    return value
+
+class Record:
+    """ base class for the typed results returned by the client. The JSON 
+    record sent by the repository is kept in ``record`` """
+
+    def __init__(self, record):
+        self.record = record
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.record)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.record == other.record
+
+    def find(self, path):
+        """ return the entry for ``path`` in the contents, or None """
+        return find_entry(self.contents, path)
+
+    def files(self):
+        """ iterate over the relative paths of all the files in the contents """
+        return iter_files(self.contents)
+
+class Draft(Record):
+
+    def __init__(self, record):
+        super().__init__(record)
+        self.id = record['id']
+        self.PID = record.get('PID')
+        self.parent_version = record.get('parent_version')
+        self.created_at = parse_datetime(record.get('created_at'))
+        self.compression = record.get('compression')
+        self.chunking = record.get('chunking')
+        self.contents = record.get('contents', [])
+
+class Dataset(Record):
+
+    def __init__(self, record):
+        super().__init__(record)
+        self.PID = record['PID']
+        self.current = record.get('current')
+        self.compression = record.get('compression')
+        self.chunking = record.get('chunking')
+
+class Version(Record):
+
+    def __init__(self, record):
+        super().__init__(record)
+        self.id = record['id']
+        self.PID = record['PID']
+        self.parent_version = record.get('parent_version')
+        self.created_at = parse_datetime(record.get('created_at'))
+        self.author = record.get('author')
+        self.message = record.get('message')
+        self.contents = record.get('contents', [])
+
+class Fingerprints(dict):
+    """ the fingerprints of the files in a draft {path : [(offset, size, 
+    hash, digest), ...]}, along with the ``chunking`` parameters used to 
+    compute them (None for the defaults). ``legacy_keys`` is True if they 
+    come from an older server, which may key files by their name only """
+
+    def __init__(self, fps, chunking=None, legacy_keys=False):
+        super().__init__(fps)
+        self.chunking = chunking
+        self.legacy_keys = legacy_keys
+
+class UploadResult:
+    """ outcome of uploading or replacing a file """
+
+    def __init__(self, draft, filename, mode, file_bytes, transferred_bytes):
+        self.draft = draft
+        self.filename = filename
+        self.mode = mode
+        self.file_bytes = file_bytes
+        self.transferred_bytes = transferred_bytes
+
+    def __repr__(self):
+        return "UploadResult(filename={!r}, mode={!r}, file_bytes={}, " \
+               "transferred_bytes={})".format(self.filename, self.mode, 
+                self.file_bytes, self.transferred_bytes)
+
+def find_entry(entries, path):
+
+    for e in entries:
+        if e["type"] == "directory":
+            r = find_entry(e["children"], path)
+            if r is not None:
+                return r
+        else:
+            if e["name"] == path or e.get("path") == path:
+                return e
+
+    return None
+
+def iter_files(entries):
+
+    for e in entries:
+        if e["type"] == "directory":
+            yield from iter_files(e["children"])
+        else:
+            yield e.get("path", e["name"])
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+""" helpers to compute deltas and build (compressed) request bodies """
+
+import os
+import zlib
+import struct
+import hashlib
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def chunk_digest(data):
+    """ return the strong (SHA-256) digest of a chunk """
+
+    return hashlib.sha256(data).digest()
+
+def add_chunk_digests(filepath, fps):
+    """ return the fingerprints ``fps`` of ``filepath`` extended with the
+    digest of each chunk, so that chunks whose 64-bit Rabin hashes collide 
+    are not mistaken for each other """
+
+    strong_fps = []
+
+    with open(filepath, 'rb') as infile:
+        for fp in fps:
+            strong_fps.append((fp[0], fp[1], fp[2], chunk_digest(infile.read(fp[1]))))
+
+    return strong_fps
+
+def same_chunk(fp, other):
+    """ check if two fingerprints refer to the same chunk, comparing their
+    digests if both have one (as done by the server) """
+
+    if fp[1] != other[1] or fp[2] != other[2]:
+        return False
+
+    return len(fp) < 4 or len(other) < 4 or fp[3] == other[3]
+
+def same_fingerprints(fps, other_fps):
+    """ check if two files are made of the same chunks """
+
+    return len(fps) == len(other_fps) and \
+           all(same_chunk(a, b) for a, b in zip(fps, other_fps))
+
+def find_deltas(local_fps, server_fps):
+    """ return the fingerprints in ``local_fps`` that are not in ``server_fps``
+    i.e. the chunks that need to be sent to the server """
+
+    #  offset, size, fingerprint[, digest]
+    # (0, 6018, 16016700538401195842, b'...'),
+    # (6018, 4660, 4907972708255653084, b'...'),
+    # (10678, 46013, 4704480773185713968, b'...')
+
+    matches = match_chunks(local_fps, server_fps)
+
+    if np is not None:
+        return [ local_fps[i] for i in np.flatnonzero(matches < 0) ]
+
+    return [ e for e, j in zip(local_fps, matches) if j < 0 ]
+
+def match_chunks(fps, other_fps):
+    """ return the index of a chunk in ``other_fps`` with the same contents
+    as each chunk in ``fps`` (or -1), as a NumPy array if NumPy is available
+    or a list otherwise """
+
+    if np is not None:
+        return _match_chunks_vectorized(fps, other_fps)
+
+    candidates = {}
+    for j, fp in enumerate(other_fps):
+        candidates.setdefault(fp[2], []).append(j)
+
+    return [ next((j for j in candidates.get(fp[2], ()) 
+                    if same_chunk(fp, other_fps[j])), -1) for fp in fps ]
+
+FINGERPRINT_DTYPE = [
+    ('offset', '<u8'),
+    ('size', '<u8'),
+    ('hash', '<u8'),
+    ('digest', 'S32'),
+]
+
+def fingerprints_array(fps):
+    """ convert the fingerprints ``fps`` into a structured NumPy array 
+    (chunks without a digest get an empty one) """
+
+    try:
+        if all(len(fp) == 4 for fp in fps):
+            return np.array(fps, dtype=FINGERPRINT_DTYPE)
+
+        return np.array([ (fp[0], fp[1], fp[2], fp[3] if len(fp) > 3 else b'') 
+                            for fp in fps ], dtype=FINGERPRINT_DTYPE)
+    except OverflowError:
+        # negative Rabin hashes
+        return np.array([ (fp[0], fp[1], fp[2] & 0xFFFFFFFFFFFFFFFF, 
+                           fp[3] if len(fp) > 3 else b'') 
+                            for fp in fps ], dtype=FINGERPRINT_DTYPE)
+
+def _match_chunks_vectorized(fps, other_fps):
+    """ match_chunks with a sorted search over the hashes of ``other_fps``
+    (it must give the same results as the server) """
+
+    matches = np.full(len(fps), -1, dtype=np.int64)
+
+    if len(fps) == 0 or len(other_fps) == 0:
+        return matches
+
+    new = fingerprints_array(fps)
+    old = fingerprints_array(other_fps)
+
+    order = np.argsort(old['hash'], kind='stable')
+    sorted_hashes = old['hash'][order]
+
+    # searching for sorted keys is much faster (cache friendly)
+    new_order = np.argsort(new['hash'], kind='stable')
+    first = np.empty(len(new), dtype=np.int64)
+    first[new_order] = np.searchsorted(sorted_hashes, new['hash'][new_order])
+    first = np.minimum(first, len(old) - 1)
+    same_hash = sorted_hashes[first] == new['hash']
+
+    candidate = order[first]
+    found = same_hash & (old['size'][candidate] == new['size'])
+
+    both_digests = (new['digest'] != b'') & (old['digest'][candidate] != b'')
+    found &= ~both_digests | (old['digest'][candidate] == new['digest'])
+
+    matches[found] = candidate[found]
+
+    # other chunks with the same hash may still match
+    for i in np.flatnonzero(same_hash & ~found):
+        last = np.searchsorted(sorted_hashes, new['hash'][i], side='right')
+
+        for j in order[first[i]+1:last]:
+            if same_chunk(fps[i], other_fps[j]):
+                matches[i] = j
+                break
+
+    return matches
+
+def fingerprints_digest(fps):
+    """ return the digest of the fingerprints of a file, as computed by the 
+    server in the file lists of drafts and versions """
+
+    h = hashlib.sha256()
+
+    for fp in fps:
+        h.update(struct.pack('<QQ', fp[1], fp[2] & 0xFFFFFFFFFFFFFFFF))
+
+    return h.hexdigest()
+
+def file_sha256(filepath, buffer_size=1024*1024):
+    """ return the SHA-256 (hex) digest of ``filepath`` """
+
+    h = hashlib.sha256()
+
+    with open(filepath, 'rb') as infile:
+        for block in iter(lambda: infile.read(buffer_size), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+def negotiate_upload_encoding(accept_encoding):
+    """ The server advertises the encodings it accepts for request bodies
+    with the 'Accept-Encoding' header of its responses. Pick the best one.
+    """
+
+    accepted = [ e.strip().lower() for e in (accept_encoding or '').split(',') ]
+
+    if 'zstd' in accepted and zstandard is not None:
+        return 'zstd'
+
+    if 'gzip' in accepted:
+        return 'gzip'
+
+    return None
+
+COMPRESSED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z',
+                         '.jpg', '.jpeg', '.png', '.mp4', '.bam', '.cram')
+
+COMPRESSED_MAGICS = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'\x28\xb5\x2f\xfd', 
+                     b'PK\x03\x04', b'\x89PNG', b'\xff\xd8\xff')
+
+def looks_compressed(filepath):
+    """ check if the contents of ``filepath`` are already compressed """
+
+    if filepath.lower().endswith(COMPRESSED_EXTENSIONS):
+        return True
+
+    with open(filepath, "rb") as infile:
+        head = infile.read(8)
+
+    return any(head.startswith(m) for m in COMPRESSED_MAGICS)
+
+class CompressedBody:
+    """ This class compresses a (streaming) request body using ``encoding``.
+    Since the server needs to know the length of the request, the compressed
+    data is spooled to a temporary file (kept in memory if small enough).
+    """
+
+    def __init__(self, body, encoding, callback=None):
+
+        if encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        self.spool = tempfile.SpooledTemporaryFile(max_size=64*1024*1024)
+
+        while True:
+            chunk = body.read(1024*1024)
+            if not chunk:
+                break
+            self.spool.write(compressor.compress(chunk))
+
+        self.spool.write(compressor.flush())
+
+        self.len = self.spool.tell()
+        self.spool.seek(0)
+
+        self.bytes_read = 0
+        self.callback = callback
+
+    def read(self, amount=-1):
+        data = self.spool.read(amount)
+        self.bytes_read += len(data)
+
+        if self.callback is not None:
+            self.callback(self)
+
+        return data
+
+class FileView:
+    """ a read-only view of ``read_limit`` bytes of ``filepath`` starting at
+    ``start_offset``, so that chunks can be streamed without loading them """
+
+    def __init__(self, filepath, start_offset, read_limit):
+
+        self.fh = open(filepath, "rb")
+        self.start_offset = start_offset
+        self.read_limit = read_limit
+
+        self.current_offset = start_offset
+        self.amount_seen = 0
+        self.len = read_limit
+
+    def __del__(self):
+        self.fh.close()
+
+    def read(self, amount=-1):
+        if self.amount_seen >= self.read_limit:
+            self.len = 0
+            return b''
+
+        self.fh.seek(self.current_offset)
+
+        remaining_amount = self.read_limit - self.amount_seen
+
+        to_read = remaining_amount if amount < 0 else min(amount, remaining_amount)
+
+        data = self.fh.read(to_read)
+
+        self.amount_seen += len(data)
+        self.current_offset = self.start_offset + self.amount_seen 
+        self.len = self.read_limit - self.amount_seen
+
+        return data
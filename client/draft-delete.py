@@ -28,33 +28,20 @@
 
 import sys
 import os
-import requests
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
 def delete_draft(repo_url, DIDs):
 
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
+    with Client(repo_url) as client:
+        for DID in DIDs:
+            try:
+                client.delete_draft(DID)
+            except DDReplayError as err:
+                print("Unable to delete draft:", err)
+                sys.exit(1)
 
-    repo_url += "/api/" + __api_version__
-
-    for DID in DIDs:
-
-        req_url = repo_url + "/drafts/" + DID
-
-        try:
-            r = requests.delete(req_url)
-            r.raise_for_status()
-        except requests.exceptions.RequestException as err:
-            print(err)
-            sys.exit(1)
-
-        if r.status_code != 204:
-            print("Unable to delete draft: HTTP Error", r.status_code)
-            sys.exit(1)
-
-        print('Draft', DID, 'successfully deleted')
+            print('Draft', DID, 'successfully deleted')
 
 def help():
     print("Usage:", os.path.basename(sys.argv[0]), "<URL> <DID> [<DID> ...]")
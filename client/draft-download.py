@@ -28,66 +28,49 @@
 
 import sys
 import os
-import requests
-import re
+import argparse
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
-def download_draft(repo_url, DID):
-
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
-
-    repo_url += "/api/" + __api_version__
-
-    req_url = repo_url + "/drafts/" + DID
+def download_draft(repo_url, DID, destination=None, jobs=8, as_zip=False, 
+                   verify=True):
 
     try:
-        r = requests.get(req_url, stream=True)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as err:
+        with Client(repo_url, pool_size=jobs) as client:
+            if as_zip:
+                filename = client.download_draft(DID)
+                print('Draft contents saved to \'' + filename + '\'')
+                return
+
+            result = client.download_draft_files(DID, destination or DID, jobs, verify)
+    except DDReplayError as err:
         print(err)
         sys.exit(1)
 
-    if 'Content-Disposition' not in r.headers:
-        print('Missing \'Content-Disposition\' headers in response.')
-        sys.exit(1)
-
-    cd = r.headers['Content-Disposition']
-    filename = re.findall('filename=(.+)', cd)
-
-    if len(filename) == 0:
-        print('Missing \'attachment; filename\' field in response')
-        sys.exit(1)
-
-    if len(filename) != 1:
-        print('Too many \'attachment; filename\' fields in response')
-        sys.exit(1)
-
-    filename = filename[0]
+    print('Draft contents ({} files, {} bytes) saved to \'{}\'{}'.format(
+          len(result.files), result.total_bytes, result.destination,
+          ' and verified' if result.verified else ''))
 
-    with open(filename, "wb") as outfile:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                outfile.write(chunk)
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Downloads the data associated to an existing Draft")
 
-    print('Draft contents saved to \'' + filename + '\'')
+    parser.add_argument('url', help="repository url")
+    parser.add_argument('DID', help="draft ID")
+    parser.add_argument('-o', '--output', default=None,
+            help="destination directory (default: <DID>)")
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+            help="number of concurrent connections")
+    parser.add_argument('--zip', action='store_true',
+            help="download the contents as a single zip file")
+    parser.add_argument('--no-verify', action='store_true',
+            help="don't verify the downloaded files")
 
-def help():
-    print("Usage:", os.path.basename(sys.argv[0]), "<URL> <DID>")
-    print("Downloads the data associated to an existing Draft")
-    print()
-    print("Arguments:")
-    print("    <URL> - repository url")
-    print("    <DID> - draft ID")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 3:
-        help()
-        sys.exit(1)
-
-    repo_url = sys.argv[1]
-    DID = sys.argv[2]
+    args = parse_args(sys.argv[1:])
 
-    download_draft(repo_url, DID)
+    download_draft(args.url, args.DID, args.output, args.jobs, args.zip,
+                   not args.no_verify)
@@ -28,30 +28,18 @@
 
 import sys
 import os
-import requests
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
 def publish_draft(repo_url, DID, author, message):
 
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
-
-    repo_url += "/api/" + __api_version__
-
-    req_url = repo_url + "/drafts/" + DID + "/publish?"
-    req_url += "author=" + author
-    req_url += "&message=" + message
-
     try:
-        r = requests.get(req_url)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print(err)
-        sys.exit(1)
-
-    if r.status_code != 201:
-        print("Unable to publish draft: HTTP Error", r.status_code)
+        with Client(repo_url) as client:
+            r = client.request('POST', '/drafts/' + DID + '/publish', 
+                               expected=(201,),
+                               params={'author' : author, 'message' : message})
+    except DDReplayError as err:
+        print("Unable to publish draft:", err)
         sys.exit(1)
 
     print(r.text, end='')
@@ -28,31 +28,21 @@
 
 import sys
 import os
-import requests
 
-from api import __api_version__
+from ddreplay_client import Client, DDReplayError
 
 def show_draft(repo_url, DID=None):
 
-    if "http" not in repo_url:
-        repo_url = "http://" + repo_url
-
-    repo_url += "/api/" + __api_version__
-
-    req_url = repo_url + "/drafts/"
+    req_path = "/drafts/"
 
     if DID is not None:
-        req_url += DID + "/record"
+        req_path += DID + "/record"
 
     try:
-        r = requests.get(req_url)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print(err)
-        sys.exit(1)
-
-    if r.status_code != 200:
-        print("Unable to list draft: HTTP Error", r.status_code)
+        with Client(repo_url) as client:
+            r = client.request('GET', req_path)
+    except DDReplayError as err:
+        print("Unable to list draft:", err)
         sys.exit(1)
 
     print(r.text, end='')
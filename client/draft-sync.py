@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+import sys
+import os
+import fnmatch
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ddreplay_client import Client, DDReplayError, HTTPError, FingerprintCache
+from ddreplay_client.client import lookup_fingerprints
+from ddreplay_client.transfer import find_deltas, same_fingerprints, file_sha256
+
+def scan_local_tree(root, excludes=()):
+    """ return a dictionary {relative path : local path} with all the files
+    found under ``root``. Relative paths always use '/' as separator """
+
+    files = {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for f in filenames:
+            local_path = os.path.join(dirpath, f)
+            relpath = os.path.relpath(local_path, root).replace(os.sep, '/')
+
+            if any(fnmatch.fnmatch(relpath, e) for e in excludes):
+                continue
+
+            if os.path.isfile(local_path):
+                files[relpath] = local_path
+
+    return files
+
+def plan_sync(local_files, draft):
+    """ compare the local files with the contents of ``draft`` and return 
+    the paths that are new, that may have changed and that were removed """
+
+    remote_files = set(draft.files())
+
+    new = sorted(set(local_files) - remote_files)
+    common = sorted(set(local_files) & remote_files)
+    removed = sorted(remote_files - set(local_files))
+
+    return new, common, removed
+
+def find_renames(executor, new, removed, local_files, draft):
+    """ find the new local files whose contents match those of a file that
+    was removed locally (i.e. that were moved or renamed). Returns a 
+    dictionary {new path : old path} """
+
+    old_paths = {}
+    for relpath in removed:
+        digest = (draft.find(relpath) or {}).get('sha256')
+        if digest is not None:
+            old_paths.setdefault(digest, []).append(relpath)
+
+    if len(old_paths) == 0:
+        return {}
+
+    renames = {}
+    digests = executor.map(lambda p: file_sha256(local_files[p]), new)
+
+    for relpath, digest in zip(new, digests):
+        if len(old_paths.get(digest, [])) > 0:
+            renames[relpath] = old_paths[digest].pop(0)
+
+    return renames
+
+def split_path(relpath):
+    if '/' in relpath:
+        return relpath.rsplit('/', 1)
+    return None, relpath
+
+class Progress:
+
+    def __init__(self, total, quiet=False):
+        self.lock = threading.Lock()
+        self.total = total
+        self.done = 0
+        self.quiet = quiet
+
+    def report(self, action, relpath, detail=''):
+        with self.lock:
+            self.done += 1
+            if not self.quiet:
+                print("[{}/{}] {:<9} {} {}".format(self.done, self.total, 
+                      action, relpath, detail))
+
+def check_file(client, relpath, local_path, server_fps):
+    """ compare the fingerprints of ``local_path`` with the ones in the 
+    server. Returns (changed, local fingerprints, size, bytes to send) """
+
+    local_fps = client.compute_fingerprints(local_path, getattr(server_fps, 'chunking', None))
+    stored_fps = lookup_fingerprints(server_fps, relpath)
+
+    size = os.path.getsize(local_path)
+
+    if stored_fps is not None and same_fingerprints(local_fps, stored_fps):
+        return False, local_fps, size, 0
+
+    return True, local_fps, size, sum(fp[1] for fp in find_deltas(local_fps, stored_fps or []))
+
+def make_batches(paths, local_files, batch_size, batch_bytes):
+    """ group ``paths`` into batches of at most ``batch_size`` files and 
+    (approximately) ``batch_bytes`` bytes """
+
+    batch = []
+    size = 0
+
+    for relpath in paths:
+        file_size = os.path.getsize(local_files[relpath])
+
+        if len(batch) > 0 and (len(batch) >= batch_size or size + file_size > batch_bytes):
+            yield batch
+            batch = []
+            size = 0
+
+        batch.append(relpath)
+        size += file_size
+
+    if len(batch) > 0:
+        yield batch
+
+def send_batch(client, DID, batch, local_files, new_set, server_fps, local_fps,
+               use_batch_api):
+    """ upload the files in ``batch`` (either new or changed) and return the
+    list of UploadResult """
+
+    if use_batch_api:
+        return client.upload_batch(DID,
+                new_files={ p : local_files[p] for p in batch if p in new_set },
+                replaced_files={ p : local_files[p] for p in batch if p not in new_set },
+                server_fps=server_fps, local_fps=local_fps)
+
+    results = []
+
+    for relpath in batch:
+        usr_path, filename = split_path(relpath)
+
+        if relpath in new_set:
+            result = client.upload_file(DID, local_files[relpath], filename, 
+                                        usr_path=usr_path)
+        else:
+            result = client.replace_file(DID, local_files[relpath], filename, 
+                                         usr_path=usr_path, server_fps=server_fps,
+                                         local_fps=local_fps.get(relpath))
+        result.filename = relpath
+        results.append(result)
+
+    return results
+
+def sync_directory(repo_url, DID, root, jobs=8, excludes=(), delete=False, 
+                   dry_run=False, quiet=False, cache=None, batch_size=64,
+                   batch_bytes=64*1024*1024):
+
+    if not os.path.isdir(root):
+        print("ERROR: '{}' is not a directory".format(root))
+        sys.exit(1)
+
+    local_files = scan_local_tree(root, excludes)
+
+    with Client(repo_url, pool_size=jobs, fingerprint_cache=cache) as client:
+
+        try:
+            # fetch the draft's contents and fingerprints once for all files
+            draft = client.get_draft(DID)
+            server_fps = client.get_fingerprints(DID)
+        except DDReplayError as err:
+            print("ERROR:", err)
+            sys.exit(1)
+
+        new, common, removed = plan_sync(local_files, draft)
+
+        print("Synchronizing '{}' with draft {}: {} new, {} to check, {} "
+              "removed".format(root, DID, len(new), len(common), len(removed)))
+
+        progress = Progress(len(new) + len(common) + 
+                            (len(removed) if delete else 0), quiet)
+        totals = {}
+        errors = 0
+
+        def account(action, relpath, file_bytes, transferred):
+            count, total_bytes, total_transferred = totals.get(action, (0, 0, 0))
+            totals[action] = (count + 1, total_bytes + file_bytes, 
+                              total_transferred + transferred)
+
+            progress.report(action, relpath, 
+                '({} of {} bytes sent)'.format(transferred, file_bytes)
+                if action == 'replace' else '')
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+            # step 0. files that were moved locally are moved in the draft 
+            # too, without sending them again (this requires --delete, since
+            # they are removed from their old path)
+            if delete and len(removed) > 0:
+                renames = find_renames(executor, new, removed, local_files, draft)
+
+                for relpath, old_path in sorted(renames.items()):
+                    try:
+                        if not dry_run:
+                            client.move_path(DID, old_path, relpath)
+                    except DDReplayError:
+                        # e.g. older servers, the file is uploaded again
+                        continue
+
+                    new.remove(relpath)
+                    removed.remove(old_path)
+                    account('move', relpath, 0, 0)
+                    progress.total -= 1
+
+            # step 1. find out which of the files in the draft have changed
+            changed = []
+            local_fps = {}
+
+            futures = { executor.submit(check_file, client, relpath, 
+                                        local_files[relpath], server_fps) : relpath 
+                            for relpath in common }
+
+            for f in as_completed(futures):
+                relpath = futures[f]
+                try:
+                    is_changed, fps, size, to_send = f.result()
+                except (DDReplayError, OSError) as err:
+                    errors += 1
+                    progress.report('FAILED', relpath, str(err))
+                    continue
+
+                if not is_changed:
+                    account('unchanged', relpath, size, 0)
+                elif dry_run:
+                    account('replace', relpath, size, to_send)
+                else:
+                    changed.append(relpath)
+                    local_fps[relpath] = fps
+
+            if dry_run:
+                for relpath in new:
+                    size = os.path.getsize(local_files[relpath])
+                    account('upload', relpath, size, size)
+                new = []
+
+            # step 2. send new and changed files in batches, so that the 
+            # server updates the draft's metadata once per batch
+            new_set = set(new)
+            batches = list(make_batches(new + sorted(changed), local_files,
+                                        max(1, batch_size), batch_bytes))
+            use_batch_api = batch_size > 1
+
+            while len(batches) > 0:
+                futures = { executor.submit(send_batch, client, DID, b, local_files,
+                                            new_set, server_fps, local_fps, 
+                                            use_batch_api) : b 
+                                for b in batches }
+                batches = []
+
+                for f in as_completed(futures):
+                    batch = futures[f]
+                    try:
+                        results = f.result()
+                    except HTTPError as err:
+                        # servers without support for batches
+                        if use_batch_api and err.status_code in (404, 405):
+                            batches.append(batch)
+                            continue
+                        errors += len(batch)
+                        for relpath in batch:
+                            progress.report('FAILED', relpath, str(err))
+                        continue
+                    except (DDReplayError, OSError) as err:
+                        errors += len(batch)
+                        for relpath in batch:
+                            progress.report('FAILED', relpath, str(err))
+                        continue
+
+                    for r in results:
+                        account(r.mode, r.filename, r.file_bytes, r.transferred_bytes)
+
+                if len(batches) > 0:
+                    print("The repository does not support batch uploads, "
+                          "sending files one by one")
+                    use_batch_api = False
+
+        # step 3. remove the files that no longer exist locally from the 
+        # draft, if asked to
+        if delete:
+            for relpath in removed:
+                try:
+                    if not dry_run:
+                        client.delete_path(DID, relpath)
+                except DDReplayError as err:
+                    errors += 1
+                    progress.report('FAILED', relpath, str(err))
+                    continue
+
+                account('delete', relpath, 0, 0)
+
+    if not quiet and not delete:
+        for relpath in removed:
+            print("[removed]  {} (not found locally, kept in draft)".format(relpath))
+
+    print()
+    for action in ('upload', 'replace', 'move', 'unchanged'):
+        count, total_bytes, transferred = totals.get(action, (0, 0, 0))
+        print("{:>9}: {} files, {} bytes ({} bytes sent)".format(
+              action, count, total_bytes, transferred))
+
+    if delete:
+        print("{:>9}: {} files".format('delete', totals.get('delete', (0,))[0]))
+    elif len(removed) > 0:
+        print("{:>9}: {} files (kept in draft, use --delete to remove them)".format(
+              'removed', len(removed)))
+
+    if cache is not None:
+        cache.flush()
+        print("fingerprint cache: {} hits, {} misses".format(cache.hits, cache.misses))
+
+    if dry_run:
+        print("(dry run: nothing was sent to the repository)")
+
+    if errors > 0:
+        print("ERROR: {} files could not be synchronized".format(errors))
+        sys.exit(1)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Synchronize the contents of Draft <DID> with a local directory, "
+            "uploading new files and sending only the changes of modified ones")
+
+    parser.add_argument('url', help="repository url")
+    parser.add_argument('DID', help="draft ID")
+    parser.add_argument('directory', help="local directory to synchronize")
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+            help="number of requests sent concurrently")
+    parser.add_argument('-b', '--batch-size', type=int, default=64,
+            help="maximum number of files sent in a single request (1 disables "
+                 "batching)")
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+            metavar='PATTERN', help="ignore local files matching PATTERN")
+    parser.add_argument('--delete', action='store_true',
+            help="remove files from the draft that don't exist locally")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help="only show what would be transferred")
+    parser.add_argument('--cache-file', default=None,
+            help="fingerprint cache for local files (default: "
+                 "~/.cache/ddreplay/fingerprints.sqlite)")
+    parser.add_argument('--no-cache', action='store_true',
+            help="always recompute the fingerprints of local files")
+    parser.add_argument('-q', '--quiet', action='store_true')
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+
+    args = parse_args(sys.argv[1:])
+
+    cache = None if args.no_cache else FingerprintCache(args.cache_file)
+
+    try:
+        sync_directory(args.url, args.DID, args.directory, args.jobs, args.exclude,
+                       args.delete, args.dry_run, args.quiet, cache, args.batch_size)
+    finally:
+        if cache is not None:
+            cache.close()
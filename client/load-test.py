@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+""" Load generator for the Dataset Replayer.
+
+This script simulates many concurrent clients (virtual users) issuing the
+same API calls as the rest of the client scripts: creating drafts, uploading
+files, replacing them with deltas, publishing drafts and downloading datasets.
+Each virtual user runs in its own thread and owns its own dataset, picking 
+operations at random according to a workload mix. At the end, per-operation
+throughput and tail latencies are reported.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import shutil
+import threading
+
+from ddreplay_client import Client, DDReplayError
+
+# predefined workload mixes (relative weights)
+WORKLOAD_MIXES = {
+    'balanced' : {'upload' : 3, 'replace' : 3, 'fingerprints' : 1, 
+                  'publish' : 1, 'download' : 2, 'create_draft' : 1},
+    'read-heavy' : {'download' : 8, 'fingerprints' : 2, 'replace' : 1, 
+                    'publish' : 1},
+    'write-heavy' : {'upload' : 5, 'replace' : 5, 'publish' : 1, 
+                     'download' : 1, 'create_draft' : 1},
+    'delta' : {'replace' : 8, 'publish' : 1, 'fingerprints' : 1},
+}
+
+def parse_mix(value):
+    """ parse a workload mix, either the name of a predefined one or a 
+    comma-separated list of ``op=weight`` pairs """
+
+    if value in WORKLOAD_MIXES:
+        return WORKLOAD_MIXES[value]
+
+    mix = {}
+    for item in value.split(','):
+        op, weight = item.split('=')
+        if op not in VirtualUser.OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation '{}'".format(op))
+        mix[op] = float(weight)
+
+    return mix
+
+def parse_size(value):
+    units = {'K' : 1024, 'M' : 1024**2, 'G' : 1024**3}
+
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+
+    return int(value)
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+class Statistics:
+    """ thread-safe collection of the latencies of each operation """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def record(self, op, seconds, nbytes=0, error=False):
+        with self.lock:
+            if error:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            else:
+                self.latencies.setdefault(op, []).append(seconds)
+                self.bytes[op] = self.bytes.get(op, 0) + nbytes
+
+    def summary(self, elapsed):
+        result = {}
+
+        with self.lock:
+            ops = set(self.latencies) | set(self.errors)
+
+            for op in sorted(ops):
+                lat = self.latencies.get(op, [])
+                entry = {
+                    'count' : len(lat),
+                    'errors' : self.errors.get(op, 0),
+                    'ops_per_second' : len(lat) / elapsed if elapsed > 0 else None,
+                    'bytes_per_second' : self.bytes.get(op, 0) / elapsed if elapsed > 0 else None,
+                }
+
+                if len(lat) > 0:
+                    entry.update({
+                        'latency_mean' : sum(lat) / len(lat),
+                        'latency_p50' : percentile(lat, 50),
+                        'latency_p95' : percentile(lat, 95),
+                        'latency_p99' : percentile(lat, 99),
+                        'latency_p999' : percentile(lat, 99.9),
+                        'latency_max' : max(lat),
+                    })
+
+                result[op] = entry
+
+        return result
+
+class VirtualUser(threading.Thread):
+    """ a simulated client that owns a dataset and a working draft """
+
+    OPERATIONS = ('upload', 'replace', 'fingerprints', 'publish', 'download', 
+                  'create_draft')
+
+    def __init__(self, uid, repo_url, args, mix, stats, deadline):
+        super().__init__(name='vuser-{}'.format(uid), daemon=True)
+
+        self.uid = uid
+        self.args = args
+        self.stats = stats
+        self.deadline = deadline
+        self.rng = random.Random(args.seed + uid)
+
+        self.ops = list(mix.keys())
+        self.weights = [ mix[op] for op in self.ops ]
+
+        # keep-alive connections are reused for all requests of this user.
+        # Failed requests are not retried so that errors are reported
+        self.client = Client(repo_url, pool_size=1, retries=0,
+                             compress_uploads=args.compress)
+
+        self.workdir = tempfile.mkdtemp(prefix='ddreplay_load_')
+
+        self.PID = None
+        self.DID = None
+        self.files = {}
+        self.counter = 0
+
+    ##### helpers #####
+    def random_bytes(self, size):
+        return self.rng.getrandbits(8 * size).to_bytes(size, 'little') if size > 0 else b''
+
+    def new_file(self):
+        self.counter += 1
+        name = 'u{:04d}_f{:06d}.dat'.format(self.uid, self.counter)
+        return name, self.random_bytes(self.args.file_size)
+
+    def write_file(self, name, content):
+        filepath = os.path.join(self.workdir, name)
+        with open(filepath, 'wb') as outfile:
+            outfile.write(content)
+        return filepath
+
+    def timed(self, op, function):
+        start = time.perf_counter()
+        try:
+            nbytes = function()
+        except DDReplayError as e:
+            self.stats.record(op, time.perf_counter() - start, error=True)
+            if self.args.verbose:
+                print("[{}] {} failed: {}".format(self.name, op, e), file=sys.stderr)
+            return False
+
+        self.stats.record(op, time.perf_counter() - start, nbytes or 0)
+        return True
+
+    ##### operations #####
+    def upload(self, name=None, content=None):
+        if name is None:
+            if len(self.files) >= self.args.max_files:
+                return self.replace()
+            name, content = self.new_file()
+
+        result = self.client.upload_file(self.DID, self.write_file(name, content), name)
+
+        self.files[name] = content
+        return result.transferred_bytes
+
+    def replace(self):
+        if len(self.files) == 0:
+            return self.upload()
+
+        name = self.rng.choice(sorted(self.files))
+
+        # modify a small region of the file
+        data = bytearray(self.files[name])
+        offset = self.rng.randrange(max(1, len(data)))
+        data[offset:offset] = self.random_bytes(self.args.edit_size)
+        data = bytes(data)
+
+        result = self.client.replace_file(self.DID, self.write_file(name, data), name)
+
+        self.files[name] = data
+        return result.transferred_bytes
+
+    def fingerprints(self):
+        r = self.client.request('GET', '/drafts/' + self.DID + '/fingerprints')
+        return len(r.content)
+
+    def publish(self):
+        self.client.publish_draft(self.DID, self.name, 'load test')
+
+        # continue working on a new draft of the dataset
+        self.DID = self.client.create_draft_from_dataset(self.PID).id
+        return 0
+
+    def download(self):
+        r = self.client.request('GET', '/datasets/' + self.PID + '/', stream=True)
+        nbytes = 0
+        for chunk in r.iter_content(1024*1024):
+            nbytes += len(chunk)
+
+        return nbytes
+
+    def create_draft(self):
+        DID = self.client.create_draft().id
+        self.client.delete_draft(DID)
+        return 0
+
+    ##### main loop #####
+    def setup(self):
+        self.DID = self.client.create_draft().id
+
+        for _ in range(0, self.args.initial_files):
+            self.upload(*self.new_file())
+
+        self.PID = self.client.publish_draft(self.DID, self.name, 'initial version').PID
+
+        self.DID = self.client.create_draft_from_dataset(self.PID).id
+
+    def run(self):
+        if not self.timed('setup', self.setup):
+            return
+
+        iterations = 0
+
+        while time.monotonic() < self.deadline:
+            if self.args.iterations is not None and iterations >= self.args.iterations:
+                break
+
+            op = self.rng.choices(self.ops, self.weights)[0]
+            self.timed(op, getattr(self, op))
+            iterations += 1
+
+            if self.args.think_time > 0:
+                time.sleep(self.rng.expovariate(1.0 / self.args.think_time))
+
+        self.client.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def print_report(report):
+    print("{:<14} {:>8} {:>6} {:>9} {:>11} {:>9} {:>9} {:>9} {:>9}".format(
+          'operation', 'count', 'errors', 'ops/s', 'MiB/s', 'p50 (ms)', 
+          'p95 (ms)', 'p99 (ms)', 'max (ms)'))
+
+    for op, e in report['operations'].items():
+        ms = lambda k: '{:.1f}'.format(e[k] * 1000) if k in e else '-'
+        print("{:<14} {:>8} {:>6} {:>9.2f} {:>11.2f} {:>9} {:>9} {:>9} {:>9}".format(
+              op, e['count'], e['errors'], e['ops_per_second'], 
+              e['bytes_per_second'] / 1024**2, ms('latency_p50'), 
+              ms('latency_p95'), ms('latency_p99'), ms('latency_max')))
+
+def load_test(repo_url, args):
+
+    stats = Statistics()
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    users = []
+    for uid in range(0, args.users):
+        user = VirtualUser(uid, repo_url, args, args.mix, stats, deadline)
+        user.start()
+        users.append(user)
+
+        if args.ramp_up > 0:
+            time.sleep(args.ramp_up / args.users)
+
+    for user in users:
+        user.join()
+
+    elapsed = time.monotonic() - start
+
+    report = {
+        'url' : repo_url,
+        'users' : args.users,
+        'mix' : args.mix,
+        'elapsed_seconds' : elapsed,
+        'operations' : stats.summary(elapsed),
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+
+    print_report(report)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Simulate many concurrent clients against a repository")
+
+    parser.add_argument('url', help="repository url")
+    parser.add_argument('-u', '--users', type=int, default=10,
+            help="number of concurrent virtual users")
+    parser.add_argument('-d', '--duration', type=float, default=60,
+            help="test duration in seconds")
+    parser.add_argument('-n', '--iterations', type=int, default=None,
+            help="maximum number of operations per user")
+    parser.add_argument('--ramp-up', type=float, default=0,
+            help="seconds over which virtual users are started")
+    parser.add_argument('--think-time', type=float, default=0,
+            help="mean pause between the operations of a user (seconds)")
+    parser.add_argument('--mix', type=parse_mix, default='balanced',
+            help="workload mix: one of {} or a list of op=weight pairs "
+                 "(ops: {})".format(', '.join(sorted(WORKLOAD_MIXES)), 
+                                    ', '.join(VirtualUser.OPERATIONS)))
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('256K'))
+    parser.add_argument('--edit-size', type=parse_size, default=parse_size('4K'),
+            help="bytes inserted into a file on each replace")
+    parser.add_argument('--initial-files', type=int, default=4)
+    parser.add_argument('--max-files', type=int, default=32,
+            help="maximum number of files per user (further uploads become replaces)")
+    parser.add_argument('--compress', action='store_true',
+            help="compress request bodies if the server supports it")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('-o', '--output', default=None,
+            help="also write the report as JSON to this file")
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+
+    return args
+
+if __name__ == "__main__":
+
+    args = parse_args(sys.argv[1:])
+
+    load_test(args.url, args)
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+""" Benchmark suite for the storage and transfer hot paths of the repository.
+
+This script generates a synthetic dataset and drives the repository through
+several create/upload/publish/download/create-from-dataset/replace cycles, 
+mutating a fraction of the files between versions. It records latency 
+percentiles and throughput per operation, bytes transferred and the disk 
+usage of the repository, and writes them as JSON so that results can be 
+compared between releases:
+
+    ./benchmark.py --files 200 --size-dist lognormal --mean-size 1M \\
+                   --mutation-rate 0.1 --cycles 5 --output results.json
+
+By default the Flask app is driven in-process with a temporary repository. 
+Use --url to benchmark a running server instead.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import datetime as dt
+import _pickle
+
+import rabin as librp
+
+API_PREFIX = "/api/v1.2"
+
+################################################################################
+##### transports                                                           #####
+################################################################################
+class FlaskTransport:
+    """ drives the Flask app in-process using a temporary repository """
+
+    def __init__(self, config):
+        os.environ.setdefault('FLASK_CONFIGURATION', 'testing')
+
+        from ddreplay import app, set_repository
+        from storage.repository import Repository
+
+        self.repo_location = tempfile.mkdtemp(prefix='bench_repo_')
+        self.repo = Repository(backend='filesystem', 
+                               base_location=self.repo_location,
+                               permanent_remove=True, remove_fingerprints=True)
+        set_repository(self.repo)
+
+        app.config.update(config)
+        self.client = app.test_client()
+
+    def request(self, method, path, files=None, headers=None, stream=False):
+        data = None
+
+        if files is not None:
+            data = {}
+            for name, filename, content in files:
+                data.setdefault(name, []).append((io.BytesIO(content), filename))
+
+        response = self.client.open(API_PREFIX + path, method=method, 
+                                    data=data, headers=headers)
+
+        return response.status_code, response.get_data()
+
+    def repository_location(self):
+        return self.repo_location
+
+    def close(self):
+        self.repo.destroy()
+
+class HTTPTransport:
+    """ drives a running server through HTTP """
+
+    def __init__(self, url, repository_location=None):
+        import requests
+
+        if "http" not in url:
+            url = "http://" + url
+
+        self.url = url + API_PREFIX
+        self.session = requests.Session()
+        self.location = repository_location
+
+    def request(self, method, path, files=None, headers=None, stream=False):
+        if files is not None:
+            files = [ (name, (filename, content)) for name, filename, content in files ]
+
+        r = self.session.request(method, self.url + path, files=files, 
+                                 headers=headers, stream=stream)
+
+        body = b''.join(r.iter_content(1024*1024))
+
+        return r.status_code, body
+
+    def repository_location(self):
+        return self.location
+
+    def close(self):
+        self.session.close()
+
+################################################################################
+##### synthetic data                                                       #####
+################################################################################
+def parse_size(value):
+    units = {'K' : 1024, 'M' : 1024**2, 'G' : 1024**3}
+
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+
+    return int(value)
+
+def random_bytes(rng, size):
+    if size <= 0:
+        return b''
+    return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+def generate_content(rng, size, compressible):
+    if not compressible:
+        return random_bytes(rng, size)
+
+    # CSV-like text
+    lines = []
+    total = 0
+    while total < size:
+        line = '{},{},{:.6f},{}\n'.format(rng.randrange(10**6), 
+                rng.choice(['A', 'C', 'G', 'T']) * rng.randrange(1, 40),
+                rng.random(), rng.randrange(10**9)).encode()
+        lines.append(line)
+        total += len(line)
+
+    return b''.join(lines)[:size]
+
+def generate_sizes(rng, args):
+    sizes = []
+
+    for i in range(0, args.files):
+        if args.size_dist == 'fixed':
+            size = args.mean_size
+        elif args.size_dist == 'uniform':
+            size = rng.randint(1, 2 * args.mean_size)
+        else:
+            # lognormal with the requested mean
+            sigma = 1.0
+            mu = max(0.0, math.log(args.mean_size) - sigma**2 / 2)
+            size = int(rng.lognormvariate(mu, sigma))
+
+        sizes.append(max(1, size))
+
+    return sizes
+
+def mutate_content(rng, content, args):
+    """ modify ``content`` with a few localized edits (insertions, deletions
+    and overwrites), touching about ``args.edit_fraction`` of its bytes """
+
+    data = bytearray(content)
+    budget = max(1, int(len(data) * args.edit_fraction))
+
+    while budget > 0:
+        size = min(budget, rng.randint(1, 4096))
+        offset = rng.randrange(max(1, len(data)))
+        kind = rng.choice(['insert', 'delete', 'overwrite'])
+        new = random_bytes(rng, size)
+
+        if kind == 'insert':
+            data[offset:offset] = new
+        elif kind == 'delete':
+            del data[offset:offset+size]
+        else:
+            data[offset:offset+size] = new
+
+        budget -= size
+
+    return bytes(data)
+
+################################################################################
+##### benchmark driver                                                     #####
+################################################################################
+class Recorder:
+
+    def __init__(self):
+        self.operations = {}
+
+    def record(self, op, seconds, bytes_sent=0, bytes_received=0, logical_bytes=0):
+        entry = self.operations.setdefault(op, {
+            'latencies' : [], 'bytes_sent' : 0, 'bytes_received' : 0,
+            'logical_bytes' : 0
+        })
+
+        entry['latencies'].append(seconds)
+        entry['bytes_sent'] += bytes_sent
+        entry['bytes_received'] += bytes_received
+        entry['logical_bytes'] += logical_bytes
+
+    @staticmethod
+    def percentile(values, p):
+        values = sorted(values)
+        k = (len(values) - 1) * p / 100.0
+        f = int(k)
+        c = min(f + 1, len(values) - 1)
+        return values[f] + (values[c] - values[f]) * (k - f)
+
+    def summary(self):
+        result = {}
+
+        for op, e in self.operations.items():
+            lat = e['latencies']
+            total = sum(lat)
+
+            result[op] = {
+                'count' : len(lat),
+                'total_seconds' : total,
+                'latency_p50' : self.percentile(lat, 50),
+                'latency_p90' : self.percentile(lat, 90),
+                'latency_p99' : self.percentile(lat, 99),
+                'latency_max' : max(lat),
+                'bytes_sent' : e['bytes_sent'],
+                'bytes_received' : e['bytes_received'],
+                'logical_bytes' : e['logical_bytes'],
+                # throughput in terms of the data the user sees (e.g. the
+                # size of the files replaced, not the deltas transferred)
+                'logical_throughput_Bps' : e['logical_bytes'] / total if total > 0 else None,
+                'wire_throughput_Bps' : 
+                    (e['bytes_sent'] + e['bytes_received']) / total if total > 0 else None,
+            }
+
+        return result
+
+class Benchmark:
+
+    def __init__(self, transport, args):
+        self.transport = transport
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.recorder = Recorder()
+        self.files = {}
+
+    def call(self, op, method, path, files=None, headers=None, 
+             expected=(200, 201, 204), logical_bytes=0):
+
+        sent = sum(len(c) for _, _, c in files) if files else 0
+
+        start = time.perf_counter()
+        status, body = self.transport.request(method, path, files, headers)
+        elapsed = time.perf_counter() - start
+
+        if status not in expected:
+            raise Exception("{} {} failed with status {}: {}".format(
+                            method, path, status, body[:200]))
+
+        self.recorder.record(op, elapsed, sent, len(body), logical_bytes)
+
+        return body
+
+    @staticmethod
+    def draft_path(DID, name):
+        """ return the URL path where ``name`` (a path in the draft) is 
+        uploaded, and its filename """
+
+        usr_path, _, filename = name.rpartition('/')
+
+        return '/drafts/' + DID + ('/' + usr_path if usr_path else ''), filename
+
+    def file_name(self, i):
+        """ return the path of the i-th file of the dataset, which is placed 
+        --depth directories deep """
+
+        dirs = [ 'dir_{:02d}'.format((i // self.args.fanout ** level) % self.args.fanout)
+                    for level in range(self.args.depth) ]
+
+        return '/'.join(dirs + ['file_{:05d}.dat'.format(i)])
+
+    def upload(self, DID, name, content):
+        path, filename = self.draft_path(DID, name)
+
+        self.call('upload', 'PUT', path,
+                  files=[('file', filename, content)],
+                  headers={'content-disposition' : 'attachment; filename=' + filename},
+                  logical_bytes=len(content))
+
+    def replace(self, DID, name, content, server_fps):
+        # compute the deltas as the client does
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(content)
+            tmp.flush()
+            local_fps = librp.get_file_fingerprints(tmp.name)
+
+        known = set(h[2] for h in server_fps[name])
+        deltas = [ e for e in local_fps if e[2] not in known ]
+
+        if len(deltas) == 0:
+            return
+
+        path, filename = self.draft_path(DID, name)
+
+        files = [('fingerprints', filename + '.fps', _pickle.dumps(local_fps))]
+
+        for offset, size, _ in deltas:
+            files.append(('parts', '{}.__part_{}_{}__'.format(filename, offset, size),
+                          content[offset:offset+size]))
+
+        self.call('replace', 'PUT', path + '?replace=true',
+                  files=files,
+                  headers={'content-disposition' : 'attachment; filename=' + filename},
+                  logical_bytes=len(content))
+
+    def disk_usage(self):
+        location = self.transport.repository_location()
+
+        if location is None:
+            return None
+
+        try:
+            out = subprocess.check_output(['du', '-sb', location])
+            return int(out.split()[0])
+        except (OSError, subprocess.CalledProcessError):
+            total = 0
+            for root, dirs, files in os.walk(location):
+                for f in files:
+                    total += os.lstat(os.path.join(root, f)).st_size
+            return total
+
+    def run(self):
+        args = self.args
+
+        # initial version
+        sizes = generate_sizes(self.rng, args)
+        for i, size in enumerate(sizes):
+            self.files[self.file_name(i)] = \
+                    generate_content(self.rng, size, args.compressible)
+
+        dataset_bytes = sum(len(c) for c in self.files.values())
+
+        draft = json.loads(self.call('create_draft', 'POST', '/drafts/').decode())
+        DID = draft['draft']['id']
+
+        for name, content in sorted(self.files.items()):
+            self.upload(DID, name, content)
+
+        version = json.loads(self.call('publish', 'POST', 
+            '/drafts/' + DID + '/publish?author=bench&message=initial').decode())
+        PID = version['version']['PID']
+
+        self.call('download', 'GET', '/datasets/' + PID + '/', 
+                  logical_bytes=dataset_bytes)
+
+        disk_usage = [self.disk_usage()]
+
+        # subsequent versions
+        for cycle in range(0, args.cycles):
+            draft = json.loads(self.call('create_draft_from_dataset', 'PUT', 
+                                '/datasets/' + PID + '/').decode())
+            DID = draft['draft']['id']
+
+            fps_data = self.call('get_fingerprints', 'GET', 
+                                 '/drafts/' + DID + '/fingerprints')
+            server_fps = _pickle.loads(fps_data)
+
+            names = sorted(self.files)
+            mutated = self.rng.sample(names, int(len(names) * args.mutation_rate))
+
+            for name in mutated:
+                self.files[name] = mutate_content(self.rng, self.files[name], args)
+                self.replace(DID, name, self.files[name], server_fps)
+
+            self.call('publish', 'POST', '/drafts/' + DID + 
+                      '/publish?author=bench&message=cycle_{}'.format(cycle))
+
+            dataset_bytes = sum(len(c) for c in self.files.values())
+            self.call('download', 'GET', '/datasets/' + PID + '/', 
+                      logical_bytes=dataset_bytes)
+
+            disk_usage.append(self.disk_usage())
+
+        return {
+            'dataset_bytes' : dataset_bytes,
+            'disk_usage_bytes' : disk_usage,
+            'operations' : self.recorder.summary(),
+        }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Benchmark the storage and transfer hot paths of the repository")
+
+    parser.add_argument('--url', default=None,
+            help="benchmark a running server instead of the in-process app")
+    parser.add_argument('--repository', default=None,
+            help="repository location of the server (to measure disk usage with --url)")
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--mean-size', type=parse_size, default=parse_size('256K'))
+    parser.add_argument('--size-dist', choices=['fixed', 'uniform', 'lognormal'], 
+            default='lognormal')
+    parser.add_argument('--compressible', action='store_true',
+            help="generate text-like (compressible) data instead of random data")
+    parser.add_argument('--mutation-rate', type=float, default=0.2,
+            help="fraction of files modified between versions")
+    parser.add_argument('--edit-fraction', type=float, default=0.02,
+            help="fraction of bytes modified in each mutated file")
+    parser.add_argument('--depth', type=int, default=0,
+            help="place the files this many directories deep (0 for a flat dataset)")
+    parser.add_argument('--fanout', type=int, default=4,
+            help="number of subdirectories per directory (with --depth)")
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+            help="override a DD_* option of the in-process app (JSON value)")
+    parser.add_argument('--output', default=None,
+            help="write the results to this file (default: stdout)")
+
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+
+    config = {}
+    for c in args.config:
+        key, value = c.split('=', 1)
+        config[key] = json.loads(value)
+
+    if args.url is None:
+        transport = FlaskTransport(config)
+    else:
+        transport = HTTPTransport(args.url, args.repository)
+
+    try:
+        start = time.perf_counter()
+        results = Benchmark(transport, args).run()
+        elapsed = time.perf_counter() - start
+    finally:
+        transport.close()
+
+    report = {
+        'timestamp' : dt.datetime.now().isoformat(),
+        'host' : platform.node(),
+        'python' : platform.python_version(),
+        'parameters' : { k : v for k, v in vars(args).items() if k != 'output' },
+        'elapsed_seconds' : elapsed,
+        'results' : results,
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+
+""" Evaluate chunking profiles on a sample of existing data.
+
+For each candidate set of chunking parameters, this script fingerprints a 
+sample of files and reports the size of the resulting metadata (fingerprint
+sets) against the deduplication it achieves:
+
+  - 'dedup': fraction of the sampled bytes in duplicated chunks
+  - 'delta': fraction of the bytes of modified files that did not need to 
+    be sent, comparing each file with its copy in the parent version (only 
+    when sampling a repository with --repository)
+  - 'edits': the same, for copies of the sampled files with --edits small
+    random edits (insertions, deletions and overwrites)
+
+    ./chunking-eval.py --repository test_repo --sample 200 \\
+        --profile small:min=1024,avg=4096,max=32768 \\
+        --profile large:min=16384,avg=65536,max=524288 \\
+        --profile fast:algorithm=fastcdc,avg=8192
+
+Profiles accept the keys algorithm, window, min, avg and max (or the full 
+names used in DD_CHUNKING_PROFILES). The pyrabin defaults are always 
+evaluated as 'default'.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import functools
+import tempfile
+import _pickle
+from concurrent.futures import ThreadPoolExecutor
+
+from storage.chunking import fingerprint_file, validate_chunking
+from storage.fingerprints import match_chunks
+from storage.compression import is_stored_compressed, open_stored_file
+
+PARAMETER_ALIASES = {
+    'window' : 'window_size',
+    'min' : 'min_block_size',
+    'avg' : 'average_block_size',
+    'max' : 'max_block_size',
+}
+
+def parse_profile(value):
+    """ parse 'name:key=value,...' into (name, parameters) """
+
+    name, _, spec = value.partition(':')
+    params = {}
+
+    for item in filter(None, spec.split(',')):
+        key, _, value = item.partition('=')
+        key = PARAMETER_ALIASES.get(key, key)
+        params[key] = value if key == 'algorithm' else int(value)
+
+    try:
+        return name, validate_chunking(params)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("{}: {}".format(name, e))
+
+################################################################################
+##### samples                                                              #####
+################################################################################
+def list_files(paths):
+    """ list all the files in ``paths`` (files or directories) """
+
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            for f in sorted(files):
+                yield os.path.join(root, f)
+
+def list_dataset_dirs(datasets_dir):
+    """ list the directories of all the datasets in ``datasets_dir``, which 
+    may be spread over subdirectories (see Filesystem._sharded_path) """
+
+    for root, dirs, files in os.walk(datasets_dir):
+        dirs.sort()
+        if 'versions' in dirs:
+            dirs[:] = []
+            yield root
+
+def list_version_pairs(base):
+    """ find the files of all the versions in the repository at ``base`` 
+    that were modified with respect to the parent version. Returns a list 
+    of (parent file, file) """
+
+    pairs = []
+    datasets_dir = os.path.join(base, 'datasets')
+
+    for dataset_dir in list_dataset_dirs(datasets_dir):
+        metadata_dir = os.path.join(dataset_dir, 'versions', 'metadata')
+        data_dir = os.path.join(dataset_dir, 'versions', 'data')
+
+        if not os.path.isdir(metadata_dir):
+            continue
+
+        for record_file in sorted(os.listdir(metadata_dir)):
+            if not record_file.endswith('.json'):
+                continue
+
+            with open(os.path.join(metadata_dir, record_file)) as infile:
+                record = json.load(infile)
+
+            parent = record.get('parent_version')
+
+            if parent is None:
+                continue
+
+            version_dir = os.path.join(data_dir, record['id'])
+            parent_dir = os.path.join(data_dir, parent)
+
+            for filepath in list_files([version_dir]):
+                parent_file = os.path.join(parent_dir, os.path.relpath(filepath, version_dir))
+
+                # unchanged files are hard links to the parent's
+                if os.path.isfile(parent_file) and \
+                    not os.path.samefile(parent_file, filepath):
+                    pairs.append((parent_file, filepath))
+
+    return pairs
+
+def list_repository_files(base):
+    """ list the files of all the versions in the repository at ``base``,
+    skipping hard links to files already listed """
+
+    seen = set()
+    datasets_dir = os.path.join(base, 'datasets')
+
+    for filepath in list_files([datasets_dir]):
+        if os.sep + os.path.join('versions', 'data') + os.sep not in filepath:
+            continue
+
+        st = os.stat(filepath)
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            yield filepath
+
+@functools.lru_cache(maxsize=None)
+def dataset_compression(dataset_dir):
+    """ return the codec used to store the files of the dataset at 
+    ``dataset_dir`` (None if they are stored as is) """
+
+    record_file = os.path.join(dataset_dir, os.path.basename(dataset_dir) + '.json')
+
+    try:
+        with open(record_file) as infile:
+            return json.load(infile).get('compression')
+    except (OSError, ValueError):
+        return None
+
+def materialize(filepath, tmp_dir):
+    """ return a path with the original contents of ``filepath``, 
+    decompressing it if it was stored compressed """
+
+    marker = os.sep + os.path.join('versions', 'data') + os.sep
+
+    # files outside a repository are never stored compressed
+    if marker not in filepath:
+        return filepath
+
+    compression = dataset_compression(filepath.split(marker)[0])
+
+    if not is_stored_compressed(filepath, compression):
+        return filepath
+
+    fd, tmp_file = tempfile.mkstemp(dir=tmp_dir)
+
+    with os.fdopen(fd, 'wb') as outfile, open_stored_file(filepath, compression) as infile:
+        shutil.copyfileobj(infile, outfile, 1024*1024)
+
+    return tmp_file
+
+def make_edited_copy(filepath, tmp_dir, edits, rng):
+    """ copy ``filepath`` applying ``edits`` small random edits """
+
+    with open(filepath, 'rb') as infile:
+        data = bytearray(infile.read())
+
+    for _ in range(edits):
+        offset = rng.randrange(len(data) + 1)
+        length = rng.randint(1, 64)
+        kind = rng.choice(['insert', 'delete', 'overwrite'])
+
+        if kind == 'insert':
+            data[offset:offset] = bytes(rng.getrandbits(8) for _ in range(length))
+        elif kind == 'delete':
+            del data[offset:offset+length]
+        else:
+            data[offset:offset+length] = bytes(rng.getrandbits(8) for _ in range(length))
+
+    fd, tmp_file = tempfile.mkstemp(dir=tmp_dir)
+
+    with os.fdopen(fd, 'wb') as outfile:
+        outfile.write(data)
+
+    return tmp_file
+
+################################################################################
+##### evaluation                                                           #####
+################################################################################
+def delta_bytes(new_fps, old_fps):
+    """ bytes of ``new_fps`` that are not in ``old_fps`` """
+
+    return sum(fp[1] for fp, j in zip(new_fps, match_chunks(new_fps, old_fps)) if j < 0)
+
+def evaluate_profile(params, files, pairs, edited, jobs):
+
+    def fingerprint(filepath):
+        return fingerprint_file(filepath, params)[0]
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        file_fps = list(pool.map(fingerprint, files))
+
+        elapsed = time.perf_counter() - start
+
+        pair_fps = list(pool.map(lambda p: (fingerprint(p[0]), fingerprint(p[1])), pairs))
+        edited_fps = list(pool.map(lambda p: (fingerprint(p[0]), fingerprint(p[1])), edited))
+
+    total_bytes = sum(fp[1] for fps in file_fps for fp in fps)
+    chunks = sum(len(fps) for fps in file_fps)
+    metadata_bytes = sum(len(_pickle.dumps(fps)) for fps in file_fps)
+
+    unique = {}
+    for fps in file_fps:
+        for fp in fps:
+            unique[fp[3]] = fp[1]
+
+    result = {
+        'bytes' : total_bytes,
+        'chunks' : chunks,
+        'mean_chunk_size' : total_bytes / chunks if chunks > 0 else 0,
+        'metadata_bytes' : metadata_bytes,
+        'metadata_ratio' : metadata_bytes / total_bytes if total_bytes > 0 else 0,
+        'dedup' : 1.0 - sum(unique.values()) / total_bytes if total_bytes > 0 else 0,
+        'throughput_MBps' : total_bytes / elapsed / 1024**2 if elapsed > 0 else 0,
+    }
+
+    for name, fps_pairs in (('delta', pair_fps), ('edits', edited_fps)):
+        new_bytes = sum(fp[1] for _, new in fps_pairs for fp in new)
+        sent_bytes = sum(delta_bytes(new, old) for old, new in fps_pairs)
+
+        result[name] = 1.0 - sent_bytes / new_bytes if new_bytes > 0 else None
+
+    return result
+
+def print_report(results):
+
+    def percent(value):
+        return '{:.2%}'.format(value) if value is not None else '-'
+
+    columns = [('avg chunk', lambda r: '{:.0f}'.format(r['mean_chunk_size'])),
+               ('chunks', lambda r: str(r['chunks'])),
+               ('metadata', lambda r: percent(r['metadata_ratio'])),
+               ('dedup', lambda r: percent(r['dedup'])),
+               ('delta', lambda r: percent(r['delta'])),
+               ('edits', lambda r: percent(r['edits'])),
+               ('MB/s', lambda r: '{:.1f}'.format(r['throughput_MBps']))]
+
+    print('{:<16}'.format('profile') + ''.join('{:>11}'.format(c[0]) for c in columns))
+
+    for name, r in results.items():
+        print('{:<16}'.format(name) + ''.join('{:>11}'.format(c[1](r)) for c in columns))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Evaluate deduplication against metadata size for chunking profiles")
+
+    parser.add_argument('paths', nargs='*', 
+            help="files or directories to sample")
+    parser.add_argument('--repository', default=None,
+            help="sample the versions stored in this repository location")
+    parser.add_argument('-p', '--profile', type=parse_profile, action='append', 
+            default=[], metavar='NAME:KEY=VALUE,...',
+            help="chunking profile to evaluate (can be repeated)")
+    parser.add_argument('--sample', type=int, default=100,
+            help="number of files (and version pairs) to sample")
+    parser.add_argument('--edits', type=int, default=3,
+            help="random edits applied to each sampled file (0 disables)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None,
+            help="also write the results as JSON to this file")
+
+    args = parser.parse_args(argv)
+
+    if args.repository is None and len(args.paths) == 0:
+        parser.error("nothing to sample: give some paths or --repository")
+
+    return args
+
+def main(argv):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    tmp_dir = tempfile.mkdtemp(prefix='chunking_eval_')
+
+    try:
+        if args.repository is not None:
+            candidates = list(list_repository_files(args.repository))
+            pairs = list_version_pairs(args.repository)
+        else:
+            candidates = list(list_files(args.paths))
+            pairs = []
+
+        files = rng.sample(candidates, min(args.sample, len(candidates)))
+        pairs = rng.sample(pairs, min(args.sample, len(pairs)))
+
+        files = [ materialize(f, tmp_dir) for f in files ]
+        pairs = [ (materialize(a, tmp_dir), materialize(b, tmp_dir)) for a, b in pairs ]
+
+        edited = []
+        if args.edits > 0:
+            edited = [ (f, make_edited_copy(f, tmp_dir, args.edits, rng)) for f in files ]
+
+        print("Sampled {} files ({} bytes), {} modified files with parent versions".format(
+              len(files), sum(os.path.getsize(f) for f in files), len(pairs)))
+        print()
+
+        profiles = [('default', None)] + args.profile
+        results = {}
+
+        for name, params in profiles:
+            results[name] = evaluate_profile(params, files, pairs, edited, args.jobs)
+            results[name]['parameters'] = params
+
+        print_report(results)
+
+        if args.output is not None:
+            with open(args.output, 'w') as outfile:
+                json.dump({ 'parameters' : { k : v for k, v in vars(args).items() 
+                                                if k not in ('output', 'profile') },
+                            'results' : results }, outfile, indent=2)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
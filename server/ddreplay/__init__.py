@@ -28,7 +28,9 @@
 import os
 from flask import Flask
 from ddreplay.config import configure_app
+from ddreplay.encoding import DecodingMiddleware
 from storage.repository import Repository
+from storage.chunking import validate_chunking
 
 # convienience function to allow unit tests to set their own Repository
 def set_repository(usr_repo):
@@ -40,6 +42,11 @@ app = Flask(__name__)
 # configure the app
 configure_app(app)
 
+# transparently decompress request bodies sent with a 'Content-Encoding'
+# (MAX_CONTENT_LENGTH only limits their compressed size)
+app.wsgi_app = DecodingMiddleware(app.wsgi_app, 
+        app.config.get('DD_MAX_DECODED_SIZE') or app.config.get('MAX_CONTENT_LENGTH'))
+
 # create the repository
 if 'DD_REPOSITORY_BASE' in app.config:
 
@@ -59,8 +66,39 @@ if 'DD_REPOSITORY_BASE' in app.config:
     else:
         remove_fps = False
 
-    repo = Repository(backend='filesystem', base_location=app.config['DD_REPOSITORY_BASE'], permanent_remove=permanent_remove, remove_fingerprints=remove_fps)
+    if 'DD_UNPACK_THREADS' in app.config:
+        unpack_threads = app.config['DD_UNPACK_THREADS']
+    else:
+        unpack_threads = None
+
+    trash_config = {
+        'trash_max_age' : app.config.get('DD_TRASH_MAX_AGE'),
+        'trash_max_size' : app.config.get('DD_TRASH_MAX_SIZE'),
+        'trash_throttle' : app.config.get('DD_TRASH_THROTTLE', 0.0),
+        'trash_interval' : app.config.get('DD_TRASH_COLLECT_INTERVAL'),
+    }
+
+    fps_cache_size = app.config.get('DD_FINGERPRINT_CACHE_SIZE', 8)
+
+    batch_threads = app.config.get('DD_BATCH_THREADS', 4)
+
+    backend = app.config.get('DD_STORAGE_BACKEND', 'filesystem')
+
+    backend_config = {}
+
+    if backend == 'objectstore':
+        backend_config = {
+            'object_store' : app.config['DD_OBJECT_STORE'],
+            'cache_size' : app.config.get('DD_OBJECT_STORE_CACHE_SIZE'),
+            'transfer_threads' : app.config.get('DD_OBJECT_STORE_THREADS', 8),
+        }
+
+    repo = Repository(backend=backend, base_location=app.config['DD_REPOSITORY_BASE'], permanent_remove=permanent_remove, remove_fingerprints=remove_fps, unpack_threads=unpack_threads, fingerprint_cache_size=fps_cache_size, batch_threads=batch_threads, **trash_config, **backend_config)
 else:
     repo = None
 
+# check the chunking profiles now, rather than when a draft is created
+for params in (app.config.get('DD_CHUNKING_PROFILES') or {}).values():
+    validate_chunking(params)
+
 from ddreplay import views
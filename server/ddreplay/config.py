@@ -38,6 +38,29 @@ class DevelopmentConfig(BaseConfig):
     DD_REPOSITORY_BASE = 'test_repo'
     DD_REMOVE_OLD_METADATA = True
     DD_REMOVE_OLD_FINGERPRINTS = True
+    DD_UNPACK_THREADS = None # use all available cores
+    DD_STORAGE_COMPRESSION = None # e.g. 'zlib' or 'zstd'
+    DD_WIRE_COMPRESSION = True
+    DD_MAX_DECODED_SIZE = 64*1024**3 # bytes of a decompressed request body
+                                     # (None: MAX_CONTENT_LENGTH, if set)
+    DD_TRASH_MAX_AGE = 7*24*3600 # seconds
+    DD_TRASH_MAX_SIZE = None # bytes
+    DD_TRASH_THROTTLE = 0.01 # seconds slept between removal batches
+    DD_TRASH_COLLECT_INTERVAL = 600 # seconds
+    DD_GC_GRACE_PERIOD = 3600 # seconds
+    DD_FINGERPRINT_CACHE_SIZE = 8 # fingerprint sets kept in memory
+    DD_BATCH_THREADS = 4 # files of a batch upload processed concurrently
+    DD_CHUNKING_PROFILES = {} # chunking parameters selectable for new datasets, e.g.
+                              # {'small-edits' : {'average_block_size' : 4096}}
+    DD_CHUNKING_PROFILE = None # default profile for new datasets (None: pyrabin's defaults)
+    DD_PROFILING_ENABLED = False # allow clients to ask for requests to be profiled
+    DD_PROFILES_MAX_COUNT = 100 # request profiles kept (the oldest are removed)
+    DD_STORAGE_BACKEND = 'filesystem' # or 'objectstore'
+    DD_OBJECT_STORE = None # object store for published datasets, e.g.
+                           # {'type' : 's3', 'bucket' : 'ddreplay', 'endpoint_url' : 'http://localhost:9000'}
+                           # {'type' : 'local', 'root' : 'test_objects'}
+    DD_OBJECT_STORE_CACHE_SIZE = None # bytes of version data cached locally (None: unlimited)
+    DD_OBJECT_STORE_THREADS = 8 # objects transferred concurrently
 
 class TestingConfig(BaseConfig):
     DEBUG = True
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import gzip
+import zlib
+import os
+from werkzeug.exceptions import RequestEntityTooLarge
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+################################################################################
+##### content-encoding negotiation                                         #####
+################################################################################
+
+# encodings supported by the server, in order of preference
+def supported_encodings():
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+def parse_accept_encoding(header):
+    """ This function parses an 'Accept-Encoding' HTTP header and returns a
+    dict mapping each encoding to its quality value.
+    """
+
+    encodings = {}
+
+    if header is None:
+        return encodings
+
+    for item in header.split(','):
+        fields = [f.strip() for f in item.split(';')]
+
+        if fields[0] == '':
+            continue
+
+        q = 1.0
+        for f in fields[1:]:
+            if f.startswith('q='):
+                try:
+                    q = float(f[2:])
+                except ValueError:
+                    q = 0.0
+
+        encodings[fields[0].lower()] = q
+
+    return encodings
+
+def negotiate_encoding(header):
+    """ This function returns the preferred encoding accepted by the client
+    according to the ``header`` sent, or None if the response should not be
+    encoded.
+    """
+
+    accepted = parse_accept_encoding(header)
+
+    for enc in supported_encodings():
+        if accepted.get(enc, accepted.get('*', 0.0)) > 0.0:
+            return enc
+
+    return None
+
+def encode_stream(iterable, encoding, level=6):
+    """ This function compresses the chunks generated by ``iterable`` using
+    ``encoding`` on the fly.
+    """
+
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+    elif encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        raise Exception("Unsupported encoding '{}'".format(encoding))
+
+    for chunk in iterable:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+################################################################################
+##### detection of already compressed data                                 #####
+################################################################################
+
+_compressed_extensions = frozenset([
+    '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.zst', '.lz4', '.zip',
+    '.7z', '.rar', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4',
+    '.mkv', '.avi', '.mov', '.bam', '.cram', '.bcf', '.h5', '.nc', '.npz',
+    '.parquet'
+])
+
+_compressed_magics = (
+    b'\x1f\x8b',                # gzip
+    b'BZh',                     # bzip2
+    b'\xfd7zXZ\x00',            # xz
+    b'\x28\xb5\x2f\xfd',        # zstd
+    b'PK\x03\x04',              # zip
+    b'\x89PNG',                 # png
+    b'\xff\xd8\xff',            # jpeg
+    b'DDRZ',                    # block-compressed repository file
+)
+
+def looks_compressed(filename, head=None):
+    """ This function guesses whether the contents of ``filename`` are 
+    already compressed (and thus not worth compressing again) by checking 
+    its extension and, if provided, its first bytes ``head``.
+    """
+
+    _, ext = os.path.splitext(filename.lower())
+
+    if ext in _compressed_extensions:
+        return True
+
+    if head is not None:
+        return any(head.startswith(m) for m in _compressed_magics)
+
+    return False
+
+################################################################################
+##### request decoding                                                     #####
+################################################################################
+class _RawInput:
+    """ file-like wrapper that reads at most ``length`` bytes of a WSGI 
+    input stream """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, amount):
+        if self.remaining is not None:
+            amount = min(amount, self.remaining)
+
+        data = self.stream.read(amount) if amount > 0 else b''
+
+        if self.remaining is not None:
+            self.remaining -= len(data)
+
+        return data
+
+class _DecodedInput:
+    """ file-like wrapper that decompresses a WSGI input stream. Data is 
+    decompressed in chunks of bounded size, and RequestEntityTooLarge (413)
+    is raised once more than ``max_size`` bytes have been decompressed, so
+    that small bodies can't expand without limit (i.e. 'zip bombs').
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, stream, encoding, length, max_size=None):
+        self.raw = _RawInput(stream, length)
+        self.max_size = max_size
+        self.size = 0
+        self.buffer = b''
+        self.eof = False
+
+        if encoding == 'zstd':
+            self.decompressor = None
+            self.reader = zstandard.ZstdDecompressor().stream_reader(
+                                self.raw, read_size=self.chunk_size)
+        elif encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = zlib.decompressobj()
+
+    def _decompress(self):
+        """ return the next chunk of decompressed data (b'' at the end) """
+
+        if self.decompressor is None:
+            return self.reader.read(self.chunk_size)
+
+        while True:
+            data = self.decompressor.unconsumed_tail
+
+            if not data:
+                data = self.raw.read(self.chunk_size)
+
+                if not data:
+                    return self.decompressor.flush()
+
+            data = self.decompressor.decompress(data, self.chunk_size)
+
+            if data:
+                return data
+
+    def _fill(self, amount):
+        while len(self.buffer) < amount and not self.eof:
+            data = self._decompress()
+
+            if not data:
+                self.eof = True
+                break
+
+            self.size += len(data)
+
+            if self.max_size is not None and self.size > self.max_size:
+                raise RequestEntityTooLarge("The decompressed request body "
+                        "exceeds {} bytes".format(self.max_size))
+
+            self.buffer += data
+
+    def read(self, amount=-1):
+        if amount is None or amount < 0:
+            self._fill(float('inf'))
+            amount = len(self.buffer)
+        else:
+            self._fill(amount)
+
+        data, self.buffer = self.buffer[:amount], self.buffer[amount:]
+        return data
+
+    def readline(self, limit=-1):
+        while b'\n' not in self.buffer and not self.eof:
+            self._fill(len(self.buffer) + 65536)
+
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+
+        if limit is not None and limit >= 0:
+            end = min(end, limit)
+
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+class DecodingMiddleware:
+    """ WSGI middleware that transparently decompresses request bodies sent
+    with a 'Content-Encoding' header (e.g. compressed uploads) before they 
+    reach the application. Decompressed bodies larger than ``max_size`` 
+    bytes are rejected with 413.
+    """
+
+    def __init__(self, wsgi_app, max_size=None):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+
+        if encoding in ('gzip', 'deflate') or (encoding == 'zstd' and zstandard is not None):
+            length = environ.get('CONTENT_LENGTH')
+            length = int(length) if length else None
+
+            environ['wsgi.input'] = _DecodedInput(environ['wsgi.input'], encoding, 
+                                                  length, self.max_size)
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+import io
+import json
+import uuid
+import cProfile
+import pstats
+import datetime as dt
+
+from storage import metrics
+
+################################################################################
+##### per-request profiling                                                #####
+################################################################################
+#
+# When profiling is enabled in the configuration (DD_PROFILING_ENABLED), a
+# client can ask for a specific request to be profiled by adding the 
+# 'profile=true' query argument or the 'X-DDReplay-Profile: 1' header. The 
+# cProfile data and the timing spans of the storage backend are saved as
+# <repo>/profiles/<id>.{prof,json} and the <id> is returned to the client
+# in the 'X-DDReplay-Profile-Id' header. Only the most recent profiles are
+# kept (DD_PROFILES_MAX_COUNT).
+#
+
+PROFILE_HEADER = 'X-DDReplay-Profile'
+PROFILE_ID_HEADER = 'X-DDReplay-Profile-Id'
+
+def profiling_requested(request):
+    flag = request.args.get('profile', request.headers.get(PROFILE_HEADER, ''))
+    return flag.lower() in ('1', 'true', 'yes')
+
+class RequestProfiler:
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.started_at = dt.datetime.now()
+        # (known in advance, since streamed responses are only profiled 
+        # until they are closed, after their headers have been sent)
+        self.id = uuid.uuid4().hex[0:16]
+
+    def start(self):
+        metrics.start_recording_spans()
+        self.profile.enable()
+
+    def cancel(self):
+        """ This function stops profiling without saving the results.
+        """
+
+        self.profile.disable()
+        metrics.stop_recording_spans()
+
+    def stop(self, profiles_path, method, path, status, max_count=None):
+        """ This function stops profiling and saves the results in 
+        ``profiles_path``, returning the identifier of the profile. Only the
+        ``max_count`` most recent profiles are kept (if set).
+        """
+
+        self.profile.disable()
+        spans = metrics.stop_recording_spans()
+
+        profile_id = self.id
+
+        self.profile.dump_stats(os.path.join(profiles_path, profile_id + '.prof'))
+
+        info = {
+            'id' : profile_id,
+            'method' : method,
+            'path' : path,
+            'status' : status,
+            'started_at' : self.started_at.isoformat(),
+            'spans' : [ {'phase' : p, 'seconds' : s} for p, s in spans ],
+        }
+
+        with open(os.path.join(profiles_path, profile_id + '.json'), 'w') as outfile:
+            json.dump(info, outfile)
+
+        if max_count is not None:
+            prune_profiles(profiles_path, max_count)
+
+        return profile_id
+
+def prune_profiles(profiles_path, max_count):
+    """ This function removes the oldest profiles in ``profiles_path`` so 
+    that at most ``max_count`` are kept.
+    """
+
+    found = []
+
+    for entry in os.scandir(profiles_path):
+        profile_id, ext = os.path.splitext(entry.name)
+
+        if ext == '.json' and is_valid_profile_id(profile_id):
+            try:
+                found.append((entry.stat().st_mtime, profile_id))
+            except FileNotFoundError:
+                pass # (pruned concurrently)
+
+    found.sort()
+
+    for _, profile_id in found[:max(0, len(found) - max_count)]:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(profiles_path, profile_id + ext))
+            except FileNotFoundError:
+                pass
+
+def is_valid_profile_id(profile_id):
+    return len(profile_id) == 16 and all(c in '0123456789abcdef' for c in profile_id)
+
+def load_profile_report(profiles_path, profile_id, limit=50):
+    """ This function generates a human-readable report for the profile
+    ``profile_id``, or returns None if it does not exist.
+    """
+
+    info_path = os.path.join(profiles_path, profile_id + '.json')
+    prof_path = os.path.join(profiles_path, profile_id + '.prof')
+
+    if not is_valid_profile_id(profile_id) or not os.path.exists(info_path):
+        return None
+
+    with open(info_path, 'r') as infile:
+        info = json.load(infile)
+
+    out = io.StringIO()
+
+    out.write('{} {} -> {} ({})\n\n'.format(info['method'], info['path'], 
+                                            info['status'], info['started_at']))
+    out.write('Storage phases:\n')
+
+    for s in info['spans']:
+        out.write('    {:<30} {:>12.6f} s\n'.format(s['phase'], s['seconds']))
+
+    out.write('\n')
+
+    stats = pstats.Stats(prof_path, stream=out)
+    stats.sort_stats('cumulative').print_stats(limit)
+
+    return out.getvalue()
@@ -26,7 +26,9 @@
 ###########################################################################
 
 from ddreplay import app
-from flask import jsonify, abort, make_response, request, redirect, Response, send_file
+from flask import jsonify, abort, make_response, request, redirect, Response, send_file, g
+from werkzeug.http import parse_range_header
+from werkzeug.wsgi import ClosingIterator
 from webargs.flaskparser import use_args, use_kwargs, parser
 from marshmallow import fields
 import datetime as dt
@@ -38,6 +40,17 @@ from time import mktime
 from collections import OrderedDict
 import zipstream
 import re
+import os
+import time
+from storage import metrics
+from ddreplay import profiling
+from storage.compression import is_stored_compressed, iter_stored_file, \
+                                open_stored_file, stored_file_size
+from storage.fingerprints import fingerprints_digest, lookup_file_fingerprints, contents_digests
+from storage.chunking import validate_chunking
+from storage.layers import LayeredTree
+from ddreplay.encoding import supported_encodings, parse_accept_encoding, \
+                              negotiate_encoding, encode_stream, looks_compressed
 
 class CustomEncoder(json.JSONEncoder):
 
@@ -59,6 +72,155 @@ def get_repo():
     import ddreplay
     return ddreplay.repo
 
+# header with the chunking parameters of a draft's fingerprints
+CHUNKING_HEADER = 'X-DDReplay-Chunking'
+
+# header that tells clients that all fingerprints are keyed by the path of
+# their file (older servers keyed some files by their name only)
+FINGERPRINT_KEYS_HEADER = 'X-DDReplay-Fingerprint-Keys'
+
+def wire_compression_enabled():
+    return app.config.get('DD_WIRE_COMPRESSION', False)
+
+################################################################################
+##### Instrumentation                                                      #####
+################################################################################
+
+REQUEST_SECONDS = metrics.histogram('ddreplay_http_request_duration_seconds',
+        'Time spent serving HTTP requests (including streaming the response)',
+        ['method', 'route', 'status'])
+REQUEST_BYTES = metrics.counter('ddreplay_http_request_bytes_total',
+        'Bytes received in HTTP request bodies', ['method', 'route'])
+RESPONSE_BYTES = metrics.counter('ddreplay_http_response_bytes_total',
+        'Bytes sent in HTTP response bodies', ['method', 'route'])
+PACKAGE_SECONDS = metrics.histogram('ddreplay_package_duration_seconds',
+        'Time spent building and streaming zip packages for download')
+
+# (the route of the request, for the metrics middleware)
+ROUTE_ENVIRON_KEY = 'ddreplay.route'
+
+class RequestMetricsMiddleware:
+    """ WSGI middleware that records the duration and the request and 
+    response sizes of every request. Unlike after_request handlers, it also
+    sees the requests that fail with an unhandled exception (e.g. 500s).
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+
+        start_time = time.perf_counter()
+        method = environ.get('REQUEST_METHOD', 'GET')
+        # (the size on the wire, before any Content-Encoding is decoded)
+        request_bytes = int(environ.get('CONTENT_LENGTH') or 0)
+        status = [500]
+
+        def done(nbytes):
+            route = environ.get(ROUTE_ENVIRON_KEY, 'unknown')
+
+            REQUEST_BYTES.inc(request_bytes, method=method, route=route)
+            RESPONSE_BYTES.inc(nbytes, method=method, route=route)
+            REQUEST_SECONDS.observe(time.perf_counter() - start_time,
+                    method=method, route=route, status=status[0])
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[0] = int(status_line.split(None, 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, recording_start_response)
+        except Exception:
+            # (only when exceptions are propagated, e.g. when testing)
+            status[0] = 500
+            done(0)
+            raise
+
+        nbytes = [0]
+
+        def counting_iterator():
+            for chunk in body:
+                nbytes[0] += len(chunk)
+                yield chunk
+
+        # streamed responses (e.g. downloads) are only finished once the
+        # last chunk has been sent (the server closes the response even if 
+        # it was never iterated)
+        callbacks = [ body.close ] if hasattr(body, 'close') else []
+        callbacks.append(lambda: done(nbytes[0]))
+
+        return ClosingIterator(counting_iterator(), callbacks)
+
+app.wsgi_app = RequestMetricsMiddleware(app.wsgi_app)
+
+@app.before_request
+def record_request_route():
+    if request.url_rule is not None:
+        request.environ[ROUTE_ENVIRON_KEY] = request.url_rule.rule
+
+@app.before_request
+def start_profiler():
+    if app.config.get('DD_PROFILING_ENABLED', False) and \
+       profiling.profiling_requested(request):
+        g.profiler = profiling.RequestProfiler()
+        g.profiler.start()
+
+@app.after_request
+def stop_profiler(response):
+    profiler = g.get('profiler')
+
+    if profiler is None:
+        return response
+
+    g.profiler = None
+    response.headers[profiling.PROFILE_ID_HEADER] = profiler.id
+
+    # (the request context is gone by the time streamed responses are closed)
+    profiles_path = get_repo().get_profiles_path()
+    method, path, status = request.method, request.full_path, response.status_code
+    max_count = app.config.get('DD_PROFILES_MAX_COUNT')
+
+    def stop():
+        profiler.stop(profiles_path, method, path, status, max_count)
+
+    # streamed responses (e.g. downloads) do most of their work while they 
+    # are being sent, so they are profiled until the server closes them
+    if response.is_streamed:
+        body = response.response
+        callbacks = [ body.close ] if hasattr(body, 'close') else []
+        callbacks.append(stop)
+
+        response.response = ClosingIterator(body, callbacks)
+    else:
+        stop()
+
+    return response
+
+@app.teardown_request
+def cancel_profiler(exception):
+    # after_request handlers are skipped if the request failed with an
+    # unhandled exception, but the profiler must not stay enabled
+    profiler = g.get('profiler')
+
+    if profiler is not None:
+        g.profiler = None
+        profiler.cancel()
+
+@app.route("/metrics")
+def get_metrics():
+    """ expose the repository metrics in Prometheus' text format """
+
+    return Response(metrics.REGISTRY.expose(), 
+                    mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def advertise_encodings(response):
+    # let clients know that they can send us compressed request bodies
+    # (RFC 7694)
+    if wire_compression_enabled():
+        response.headers['Accept-Encoding'] = ', '.join(supported_encodings())
+    return response
+
 ################################################################################
 ##### Error management                                                     #####
 ################################################################################
@@ -94,16 +256,43 @@ def get_draft_list():
 
     return json_response({'drafts' : result}, 200)
 
+create_draft_args = {
+    'compression' : fields.String(required=False, missing=None),
+    'chunking' : fields.String(required=False, missing=None),
+}
+
 @app.route("/api/" + __api_version__ + "/drafts/", methods=['POST'])
-def create_empty_draft():
+@use_kwargs(create_draft_args)
+def create_empty_draft(compression, chunking):
     """ create a new (empty) draft """
 
     repo = get_repo()
 
+    # data compression is opt-in: if the user didn't ask for a specific
+    # codec, use the repository default
+    if compression is None:
+        compression = app.config.get('DD_STORAGE_COMPRESSION')
+
+    if compression is not None and compression not in repo.list_compression_codecs():
+        abort(400)
+
+    # the same goes for the chunking profile, which is chosen among those
+    # defined in the configuration. The dataset created from this draft
+    # keeps its parameters
+    if chunking is None:
+        chunking = app.config.get('DD_CHUNKING_PROFILE')
+
+    profiles = app.config.get('DD_CHUNKING_PROFILES') or {}
+
+    if chunking is not None and chunking not in profiles:
+        abort(400)
+
     new_draft = repo.create_empty_draft({
         "id": repo.generate_DID(),
         "created_at": dt.datetime.now(),
         "PID" : None,
+        "compression" : compression,
+        "chunking" : validate_chunking(profiles.get(chunking)),
         "contents": []
     })
 
@@ -133,11 +322,7 @@ def get_draft_data(DID):
     if(draft is None):
         abort(404)
 
-    pkg = _build_package(data_path)
-
-    response = Response(pkg, mimetype='application/zip')
-    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(DID + '.zip')
-    return response
+    return _package_response(data_path, DID + '.zip', draft.get('compression'))
 
 add_to_draft_args = {
     'unpack' : fields.Boolean(required=False, missing=False),
@@ -179,20 +364,119 @@ def add_to_draft(DID, unpack, replace, usr_path=None):
 
     return json_response({'draft': result}, 200)
 
+@app.route("/api/" + __api_version__ + "/drafts/<DID>/batch", methods=['POST'])
+@app.route("/api/" + __api_version__ + "/drafts/<DID>/batch/<path:usr_path>", methods=['POST'])
+def add_batch_to_draft(DID, usr_path=None):
+    """ add several files (or delta sets for existing files) to an existing 
+        draft in a single request. New files are sent in 'files' fields whose
+        filenames are their paths in the draft (relative to <usr_path>). 
+        Replacements are sent as a 'replace.fingerprints' field (named after
+        the path of the file) plus its 'replace.parts'.
+    """
+
+    app.logger.debug("add_batch_to_draft(DID=%s, usr_path='%s')", DID, usr_path)
+
+    repo = get_repo()
+
+    draft, _, _ = repo.lookup_draft(DID)
+
+    if(draft is None):
+        app.logger.debug("DID: %s not found", DID)
+        abort(404)
+
+    if len(request.files) == 0:
+        abort(400)
+
+    try:
+        result = repo.add_batch_to_draft(draft, request.files, usr_path)
+    except ValueError as e:
+        abort(400, str(e))
+    except Exception as e:
+        abort(409, str(e))
+
+    return json_response({'draft': result}, 200)
+
 @app.route("/api/" + __api_version__ + "/drafts/<DID>", methods=['DELETE'])
 @app.route("/api/" + __api_version__ + "/drafts/<DID>/<path:usr_path>", methods=['DELETE'])
 def delete_draft(DID, usr_path=None):
-    """ remove an existing draft """
+    """ remove an existing draft, or the file or directory <usr_path> from it """
 
     repo = get_repo()
 
     app.logger.debug("delete_draft(DID=%s, usr_path='%s')", DID, usr_path)
 
-    repo.delete_draft(DID)
+    if usr_path is None:
+        repo.delete_draft(DID)
+
+        # This response is special in the sense that it does not send back a
+        # JSON message
+        return ('', 204)
 
-    # This response is special in the sense that it does not send back a JSON
-    # message
-    return ('', 204)
+    draft, _, _ = repo.lookup_draft(DID)
+
+    if(draft is None):
+        app.logger.debug("DID: %s not found", DID)
+        abort(404)
+
+    try:
+        result = repo.remove_path_from_draft(draft, usr_path)
+    except ValueError as e:
+        abort(400, str(e))
+
+    if result is None:
+        abort(404)
+
+    return json_response({'draft': result}, 200)
+
+transfer_path_args = {
+    'source' : fields.String(required=True, missing=None),
+    'destination' : fields.String(required=True, missing=None),
+}
+
+@app.route("/api/" + __api_version__ + "/drafts/<DID>/move", methods=['POST'])
+@use_kwargs(transfer_path_args)
+def move_draft_path(DID, source, destination):
+    """ move (rename) the file or directory <source> of an existing draft to
+        <destination>, without transferring any data """
+
+    app.logger.debug("move_draft_path(DID=%s, source='%s', destination='%s')", 
+                     DID, source, destination)
+
+    return _transfer_draft_path(DID, source, destination, get_repo().move_draft_path)
+
+@app.route("/api/" + __api_version__ + "/drafts/<DID>/copy", methods=['POST'])
+@use_kwargs(transfer_path_args)
+def copy_draft_path(DID, source, destination):
+    """ copy the file or directory <source> of an existing draft to 
+        <destination>, without transferring any data """
+
+    app.logger.debug("copy_draft_path(DID=%s, source='%s', destination='%s')", 
+                     DID, source, destination)
+
+    return _transfer_draft_path(DID, source, destination, get_repo().copy_draft_path)
+
+def _transfer_draft_path(DID, source, destination, transfer):
+
+    if source is None or destination is None:
+        abort(400)
+
+    draft, _, _ = get_repo().lookup_draft(DID)
+
+    if(draft is None):
+        app.logger.debug("DID: %s not found", DID)
+        abort(404)
+
+    try:
+        result = transfer(draft, source, destination)
+    except ValueError as e:
+        abort(400, str(e))
+    except Exception as e:
+        abort(409, str(e))
+
+    if result is None:
+        abort(404)
+
+    return json_response({'draft': result}, 200)
 
 
 publish_draft_args = {
@@ -233,17 +517,68 @@ def get_fingerprints(DID):
 
     repo = get_repo()
 
-    draft, _, fps_path = repo.lookup_draft(DID, fetch_fingerprints=True)
+    draft, _, _ = repo.lookup_draft(DID)
 
     if(draft is None):
         abort(404)
 
-    response = Response(open(fps_path, "rb"))#, "application/octet-stream")
+    # drafts created from a dataset share the fingerprints of its current
+    # version and only store their changes: the backend merges them
+    fps_file = repo.open_draft_fingerprints(DID)
+
+    encoding = None
+
+    if wire_compression_enabled():
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+
+    if encoding is None:
+        response = Response(fps_file)#, "application/octet-stream")
+    else:
+        response = Response(encode_stream(fps_file, encoding))
+        response.headers['Content-Encoding'] = encoding
+
+    response.headers['Vary'] = 'Accept-Encoding'
     response.headers['Content-Disposition'] = 'attachment; filename={}'.format(DID + '.fps')
 
+    # clients must compute the fingerprints of their files with the same 
+    # chunking parameters for deltas to work
+    if draft.get('chunking') is not None:
+        response.headers[CHUNKING_HEADER] = json.dumps(draft['chunking'], sort_keys=True)
+
+    response.headers[FINGERPRINT_KEYS_HEADER] = 'path'
+
     return response
 
 
+@app.route("/api/" + __api_version__ + "/drafts/<DID>/files/", methods=['GET'])
+def get_draft_file_list(DID):
+    """ generate a JSON record with the files contained in the draft """
+
+    repo = get_repo()
+
+    draft, data_path, _ = repo.lookup_draft(DID, fetch_data=True)
+
+    if(draft is None):
+        abort(404)
+
+    return _file_list_response(data_path, repo.lookup_draft_fingerprints(DID),
+                               contents_digests(draft['contents']),
+                               draft.get('compression'))
+
+@app.route("/api/" + __api_version__ + "/drafts/<DID>/files/<path:filepath>", methods=['GET'])
+def get_draft_file(DID, filepath):
+    """ download a single file from the draft (supports Range requests) """
+
+    repo = get_repo()
+
+    draft, data_path, _ = repo.lookup_draft(DID, fetch_data=True)
+
+    if(draft is None):
+        abort(404)
+
+    return _file_response(data_path, filepath, draft.get('compression'))
+
+
 ################################################################################
 ##### API (datasets + versions)                                            #####
 ################################################################################
@@ -287,11 +622,8 @@ def get_current_version_data(PID):
     if(version is None):
         abort(404)
 
-    pkg = _build_package(data_path)
-
-    response = Response(pkg, mimetype='application/zip')
-    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(PID + '.zip')
-    return response
+    return _release_when_sent(repo, data_path, lambda: 
+            _package_response(data_path, PID + '.zip', _dataset_compression(repo, PID)))
 
 @app.route("/api/" + __api_version__ + "/datasets/<PID>/versions/<VID>/record")
 def get_version_record(PID, VID):
@@ -317,11 +649,51 @@ def get_version_data(PID, VID):
     if(version is None):
         abort(404)
 
-    pkg = _build_package(data_path)
+    return _release_when_sent(repo, data_path, lambda: 
+            _package_response(data_path, VID + '.zip', _dataset_compression(repo, PID)))
 
-    response = Response(pkg, mimetype='application/zip')
-    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(VID + '.zip')
-    return response
+@app.route("/api/" + __api_version__ + "/datasets/<PID>/files/", methods=['GET'])
+@app.route("/api/" + __api_version__ + "/datasets/<PID>/versions/<VID>/files/", methods=['GET'])
+def get_version_file_list(PID, VID=None):
+    """ generate a JSON record with the files contained in the version 
+        identified by PID + VID (by default, the current version)
+    """
+
+    repo = get_repo()
+
+    if VID is None:
+        version, data_path = repo.lookup_current_version(PID, fetch_data=True)
+    else:
+        version, data_path = repo.lookup_version(PID, VID, fetch_data=True)
+
+    if(version is None):
+        abort(404)
+
+    return _release_when_sent(repo, data_path, lambda: 
+            _file_list_response(data_path, 
+                repo.lookup_version_fingerprints(PID, version['id']),
+                contents_digests(version['contents']),
+                _dataset_compression(repo, PID)))
+
+@app.route("/api/" + __api_version__ + "/datasets/<PID>/files/<path:filepath>", methods=['GET'])
+@app.route("/api/" + __api_version__ + "/datasets/<PID>/versions/<VID>/files/<path:filepath>", methods=['GET'])
+def get_version_file(PID, filepath, VID=None):
+    """ download a single file from the version identified by PID + VID (by
+        default, the current version). Supports Range requests.
+    """
+
+    repo = get_repo()
+
+    if VID is None:
+        version, data_path = repo.lookup_current_version(PID, fetch_data=True)
+    else:
+        version, data_path = repo.lookup_version(PID, VID, fetch_data=True)
+
+    if(version is None):
+        abort(404)
+
+    return _release_when_sent(repo, data_path, lambda: 
+            _file_response(data_path, filepath, _dataset_compression(repo, PID)))
 
 @app.route("/api/" + __api_version__ + "/datasets/<PID>/versions/")
 def get_version_list(PID):
@@ -352,24 +724,248 @@ def create_draft_from_dataset(PID):
     return json_response({'draft': draft}, 201)
 
 
+################################################################################
+##### API (maintenance)                                                    #####
+################################################################################
+
+@app.route("/api/" + __api_version__ + "/trash/", methods=['GET'])
+def get_trash_stats():
+    """ generate a JSON record with statistics about the repository's trash
+        and the space reclaimed by the trash collector
+    """
+
+    repo = get_repo()
+
+    return json_response({'trash' : repo.get_trash_stats()}, 200)
+
+collect_garbage_args = {
+    'dry_run' : fields.Boolean(required=False, missing=True),
+    'max_entries' : fields.Integer(required=False, missing=None),
+}
+
+profile_args = {
+    'format' : fields.String(required=False, missing='text'),
+}
+
+@app.route("/api/" + __api_version__ + "/profiles/<profile_id>", methods=['GET'])
+@use_kwargs(profile_args)
+def get_profile(profile_id, format):
+    """ retrieve a request profile, either as a text report or as raw
+        cProfile data (format=raw) for tools such as snakeviz
+    """
+
+    if not app.config.get('DD_PROFILING_ENABLED', False):
+        abort(404)
+
+    profiles_path = get_repo().get_profiles_path()
+
+    if format == 'raw':
+        prof_path = os.path.join(profiles_path, profile_id + '.prof')
+
+        if not profiling.is_valid_profile_id(profile_id) or not os.path.exists(prof_path):
+            abort(404)
+
+        return send_file(prof_path, mimetype='application/octet-stream',
+                         as_attachment=True, attachment_filename=profile_id + '.prof')
+
+    report = profiling.load_profile_report(profiles_path, profile_id)
+
+    if report is None:
+        abort(404)
+
+    return Response(report, mimetype='text/plain')
+
+@app.route("/api/" + __api_version__ + "/gc/", methods=['POST'])
+@use_kwargs(collect_garbage_args)
+def collect_garbage(dry_run, max_entries):
+    """ find data not referenced by any draft or version and (unless 
+        dry_run is set) remove it
+    """
+
+    repo = get_repo()
+
+    report = repo.collect_garbage(dry_run, max_entries, 
+            app.config.get('DD_GC_GRACE_PERIOD', 3600))
+
+    return json_response({'gc' : report}, 200)
+
+
 ################################################################################
 ##### Utility functions                                                    #####
 ################################################################################
-def _build_package(data_path):
-    """ This function collects all files contained in directory ``data_path``
-    and packs them into a zipstream object that can be streamed back to the
-    client.
+def _data_tree(data_path):
+    """ This function returns the data of a draft or version as a 
+    LayeredTree (the data of drafts is layered on top of their parent 
+    version, while versions are plain directories) """
+
+    if isinstance(data_path, LayeredTree):
+        return data_path
+
+    return LayeredTree([data_path])
+
+def _dataset_compression(repo, PID):
+    """ This function returns the codec used to store the files of dataset
+    ``PID`` (None if they are stored as is) """
+
+    dataset = repo.lookup_dataset(PID)
+
+    return dataset.get('compression') if dataset is not None else None
+
+def _release_when_sent(repo, data_path, build_response):
+    """ This function returns the response generated by ``build_response()``
+    for the data of a version at ``data_path``, which is released (see 
+    Repository.release_version_data()) once the response has been sent,
+    since it may be streamed lazily """
+
+    try:
+        response = build_response()
+    except BaseException:
+        repo.release_version_data(data_path)
+        raise
+
+    if not response.is_streamed:
+        repo.release_version_data(data_path)
+        return response
+
+    response.response = ClosingIterator(response.response, 
+            lambda: repo.release_version_data(data_path))
+
+    return response
+
+def _file_list_response(data_path, fps=None, digests=None, compression=None):
+    """ This function generates a JSON response with the path and (original)
+    size of all files contained in ``data_path``, so that clients can fetch 
+    them individually. If the fingerprints ``fps`` of the files are known, a
+    digest of them is included to allow clients to verify their downloads, 
+    as well as their SHA-256 ``digests`` (when known). Files are stored 
+    with the ``compression`` codec of their draft or dataset.
+    """
+
+    files = []
+
+    for relpath, file_path in _data_tree(data_path).walk():
+        file_fps = lookup_file_fingerprints(fps, relpath)
+
+        files.append(OrderedDict([
+            ('path', relpath),
+            ('size', stored_file_size(file_path, compression)),
+            ('fingerprints', fingerprints_digest(file_fps) 
+                                if file_fps is not None else None),
+            ('sha256', (digests or {}).get(relpath))
+        ]))
+
+    return json_response({'files' : files, 
+                          'total_size' : sum(f['size'] for f in files)}, 200)
+
+def _file_response(data_path, filepath, compression=None):
+    """ This function generates a response that streams back the file 
+    ``filepath`` from ``data_path``, honoring single-range Range requests so
+    that clients can download large files using several connections. Files 
+    stored compressed (with the ``compression`` codec of their draft or 
+    dataset) are decompressed on the fly.
     """
 
-    import os
+    full_path = _data_tree(data_path).resolve(filepath)
+
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+
+    size = stored_file_size(full_path, compression)
+    start, stop = 0, size
+    status = 200
+
+    ranges = parse_range_header(request.headers.get('Range'))
+
+    if ranges is not None:
+        r = ranges.range_for_length(size)
+
+        if r is not None:
+            start, stop = r
+            status = 206
+        elif len(ranges.ranges) == 1:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        # multiple ranges are not supported: send the whole file
+
+    if status == 200 and not is_stored_compressed(full_path, compression):
+        response = send_file(full_path, mimetype='application/octet-stream')
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    def generate(chunk_size=1024*1024):
+        with open_stored_file(full_path, compression) as infile:
+            infile.seek(start)
+            remaining = stop - start
+
+            while remaining > 0:
+                data = infile.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    response = Response(generate(), status=status, mimetype='application/octet-stream')
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    if status == 206:
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+
+    return response
+
+def _package_response(data_path, filename, compression=None):
+    """ This function generates a response that streams back the contents of 
+    ``data_path`` as a zip file. If the client accepts compressed responses,
+    the members of the zip file are deflated.
+    """
+
+    compress = False
+
+    if wire_compression_enabled():
+        accepted = parse_accept_encoding(request.headers.get('Accept-Encoding'))
+        compress = any(accepted.get(e, 0.0) > 0.0 for e in ('gzip', 'deflate', 'zstd'))
+
+    start_time = time.perf_counter()
+
+    pkg = _build_package(data_path, compress, compression)
+
+    # the package is built lazily while it is sent, so it is timed until
+    # the response is closed
+    pkg = ClosingIterator(pkg, lambda: 
+            PACKAGE_SECONDS.observe(time.perf_counter() - start_time))
+
+    response = Response(pkg, mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def _build_package(data_path, compress=False, compression=None):
+    """ This function collects all files contained in ``data_path`` (a 
+    directory or a LayeredTree) and packs them into a zipstream object that
+    can be streamed back to the client. If ``compress`` is True, members are
+    deflated unless their contents are already compressed. Files stored with
+    the ``compression`` codec are decompressed on the fly.
+    """
 
     pkg = zipstream.ZipFile(mode='w')
 
-    for root, dir, files in os.walk(data_path):
-        for f in files:
-            file_path = os.path.join(root, f)
-            file_alias = os.path.relpath(file_path, data_path)
-            pkg.write(file_path, file_alias)
+    for file_alias, file_path in _data_tree(data_path).walk():
+        compress_type = zipstream.ZIP_STORED
+
+        if compress:
+            with open_stored_file(file_path, compression) as infile:
+                head = infile.read(8)
+
+            if not looks_compressed(file_path, head):
+                compress_type = zipstream.ZIP_DEFLATED
+
+        # files stored compressed need to be decompressed on the fly
+        if is_stored_compressed(file_path, compression):
+            pkg.write_iter(file_alias, iter_stored_file(file_path, compression), 
+                           compress_type=compress_type)
+        else:
+            pkg.write(file_path, file_alias, compress_type=compress_type)
 
     return pkg
 
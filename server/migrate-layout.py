@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+
+""" Migrate a repository to the sharded layout.
+
+Older versions of the repository stored all drafts and datasets at the top 
+level of the drafts/data, drafts/metadata and datasets folders, which makes
+directory operations slow when there are many of them. New entries are 
+spread over subdirectories named after the hash of their ID (e.g. 
+datasets/ab/cd/<PID>), and this script moves the existing ones there:
+
+    ./migrate-layout.py /path/to/repository
+
+Each entry is moved with a single rename and the server keeps finding
+entries in both locations, so the repository can stay online while it is
+migrated (requests on an entry being moved may fail and need to be retried).
+"""
+
+import os
+import sys
+import argparse
+
+from storage.backends.filesystem import Filesystem
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=
+            "Move the drafts and datasets of a repository to the sharded layout")
+
+    parser.add_argument('repository', help="repository location")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help="only show the entries that would be moved")
+    parser.add_argument('-q', '--quiet', action='store_true')
+
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+
+    if not os.path.isdir(os.path.join(args.repository, 'datasets')):
+        print("ERROR: '{}' is not a repository".format(args.repository))
+        sys.exit(1)
+
+    backend = Filesystem(args.repository, permanent_remove=False, 
+                         remove_fingerprints=False)
+
+    try:
+        count = 0
+        for src, dst in backend.migrate_layout(args.dry_run):
+            count += 1
+            if not args.quiet:
+                print("{} -> {}".format(os.path.relpath(src, args.repository),
+                                        os.path.relpath(dst, args.repository)))
+
+        print("{} entries {}".format(count, "to migrate" if args.dry_run else "migrated"))
+    finally:
+        backend.trash.stop()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
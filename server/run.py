@@ -30,4 +30,4 @@
 from ddreplay import app
 
 if __name__ == "__main__":
-    app.run()
+    app.run(threaded=True)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import gzip, bz2, lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+################################################################################
+##### decompressors for the archive formats supported by 'unpack'          #####
+################################################################################
+class Decompressor:
+    """ Base class for the decompressors used when unpacking archives into a
+    draft. A decompressor first tries to delegate the work to one of the
+    (multi-threaded) external ``tools`` available in the system and, if none
+    of them is installed, falls back to the single-threaded Python module
+    returned by ``_open_fallback()``.
+
+    Each tool is described as a tuple ``(program, args)`` where ``args`` may
+    contain the ``{threads}`` placeholder.
+    """
+
+    suffixes = ()
+    tools = ()
+
+    def matches(self, filename):
+        return any(filename.endswith(s) for s in self.suffixes)
+
+    def open(self, filename, threads, stderr=None):
+        """ This function returns a (file object, process) pair, where the
+        file object is a stream with the decompressed contents of
+        ``filename`` and process is the external process that produces it
+        (or None if the Python fallback was used). The error messages of the
+        process are written to the file object ``stderr`` (or discarded).
+        """
+
+        if stderr is None:
+            stderr = subprocess.DEVNULL
+
+        for program, args in self._select_tools(filename):
+            if shutil.which(program) is None:
+                continue
+
+            cmd = [program] + [a.format(threads=threads) for a in args]
+            cmd.append(filename)
+
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=stderr, bufsize=1024*1024)
+            return proc.stdout, proc
+
+        return self._open_fallback(filename), None
+
+    def _select_tools(self, filename):
+        return self.tools
+
+    def _open_fallback(self, filename):
+        raise NotImplementedError()
+
+class GzipDecompressor(Decompressor):
+
+    suffixes = ('.tar.gz', '.tgz')
+    tools = (
+        ('pigz', ['-d', '-c', '-p', '{threads}']),
+    )
+
+    # BGZF files (as generated by htslib's bgzip) are made of independent
+    # gzip blocks and can be decompressed in parallel
+    bgzf_tools = (
+        ('bgzip', ['-d', '-c', '-@', '{threads}']),
+    )
+
+    @staticmethod
+    def is_bgzf(filename):
+        """ check the gzip header for the 'BC' extra subfield used by BGZF """
+
+        with open(filename, "rb") as infile:
+            header = infile.read(16)
+
+        return (len(header) == 16 and header[0:2] == b'\x1f\x8b' and 
+                header[3] & 0x04 and header[12:14] == b'BC')
+
+    def _select_tools(self, filename):
+        if self.is_bgzf(filename):
+            return self.bgzf_tools + self.tools
+        return self.tools
+
+    def _open_fallback(self, filename):
+        return gzip.open(filename, "rb")
+
+class Bzip2Decompressor(Decompressor):
+
+    suffixes = ('.tar.bz2', '.tbz2', '.tbz')
+    tools = (
+        # lbzip2 decompresses any bzip2 file in parallel, while pbzip2 only 
+        # does so for files that it has compressed itself (multi-stream)
+        ('lbzip2', ['-d', '-c', '-n', '{threads}']),
+        ('pbzip2', ['-d', '-c', '-p{threads}']),
+    )
+
+    def _open_fallback(self, filename):
+        return bz2.open(filename, "rb")
+
+class XzDecompressor(Decompressor):
+
+    suffixes = ('.tar.xz', '.txz')
+    tools = (
+        # xz >= 5.4 decompresses multi-block files in parallel
+        ('xz', ['-d', '-c', '-T', '{threads}']),
+    )
+
+    def _open_fallback(self, filename):
+        return lzma.open(filename, "rb")
+
+class ZstdDecompressor(Decompressor):
+
+    suffixes = ('.tar.zst', '.tar.zstd', '.tzst')
+    tools = (
+        # '--long=31' allows archives compressed with long-distance matching
+        # (i.e. large windows) to be decompressed
+        ('zstd', ['-d', '-c', '-q', '--long=31', '-T{threads}']),
+    )
+
+    def _open_fallback(self, filename):
+        if zstandard is None:
+            raise Exception("No zstd decompressor available")
+
+        dctx = zstandard.ZstdDecompressor(max_window_size=2**31)
+        return dctx.stream_reader(open(filename, "rb"), closefd=True)
+
+class PlainDecompressor(Decompressor):
+
+    suffixes = ('.tar',)
+
+    def _open_fallback(self, filename):
+        return open(filename, "rb")
+
+# NOTE: order is important, since suffixes are checked sequentially
+_decompressors = [
+    GzipDecompressor(),
+    Bzip2Decompressor(),
+    XzDecompressor(),
+    ZstdDecompressor(),
+    PlainDecompressor(),
+]
+
+def register_decompressor(decompressor):
+    """ This function registers a new ``decompressor``. Decompressors 
+    registered later take precedence over the built-in ones.
+    """
+    _decompressors.insert(0, decompressor)
+
+def find_decompressor(filename):
+    """ This function returns the decompressor able to handle ``filename``
+    or None if the file is not a supported archive.
+    """
+
+    for d in _decompressors:
+        if d.matches(filename):
+            return d
+
+    return None
+
+def is_archive(filename):
+    return find_decompressor(filename) is not None
+
+################################################################################
+##### extraction                                                           #####
+################################################################################
+def _check_member(member, destination):
+    """ make sure that ``member`` will not be extracted outside of 
+    ``destination`` and that it is a regular file or directory """
+
+    if not (member.isfile() or member.isdir()):
+        raise Exception("Archive member '{}' is not a regular file or "
+                        "directory".format(member.name))
+
+    target = os.path.realpath(os.path.join(destination, member.name))
+    
+    if os.path.isabs(member.name) or \
+       os.path.commonpath([destination, target]) != destination:
+        raise Exception("Archive member '{}' points outside of the "
+                        "destination directory".format(member.name))
+
+def extract_archive(filename, destination, threads=None):
+    """ This function extracts the contents of the archive ``filename`` into
+    the ``destination`` directory. The archive is read as a stream so that
+    the decompression (which may happen in a separate multi-threaded process)
+    overlaps with the writing of the extracted files.
+    """
+
+    decompressor = find_decompressor(filename)
+
+    if decompressor is None:
+        raise Exception("Unsupported archive format")
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    destination = os.path.realpath(destination)
+
+    # the error messages of the decompressor go to a temporary file rather 
+    # than to a pipe, which would block it once full since it is only read
+    # at the end
+    with tempfile.TemporaryFile() as errors:
+        stream, proc = decompressor.open(filename, threads, errors)
+
+        try:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                for member in tar:
+                    _check_member(member, destination)
+                    tar.extract(member, path=destination, set_attrs=False)
+        except:
+            stream.close()
+            if proc is not None:
+                proc.kill()
+                proc.wait()
+            raise
+
+        stream.close()
+
+        if proc is not None:
+            proc.wait()
+            if proc.returncode != 0:
+                errors.seek(0)
+                raise Exception("Failed to decompress archive: {}".format(
+                                errors.read().decode(errors='replace').strip()))
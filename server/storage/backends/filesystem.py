@@ -25,13 +25,26 @@
 #                                                                         #
 ###########################################################################
 
-import os, glob, shutil, tempfile, tarfile
+import os, io, glob, shutil, tempfile, tarfile, time, threading
 import json
-from collections import OrderedDict
+import hashlib
+from collections import OrderedDict, ChainMap
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from marshmallow import Schema, fields, pre_load, post_dump
 from werkzeug.utils import secure_filename
 import rabin as librp
 import _pickle
+from storage.archives import extract_archive, is_archive
+from storage.compression import compress_file, open_stored_file
+from storage.chunking import fingerprint_file
+from storage.trash import Trash
+from storage.layers import LayeredTree, normalize_relpath
+from storage.fingerprints import (lookup_file_fingerprints, chunk_digest,
+        plan_rebuild, contents_digests, annotate_contents, contents_files,
+        find_in_contents, insert_into_contents, remove_from_contents,
+        rekey_legacy_fingerprints, RekeyedFingerprints)
+from storage import metrics
 
 ################################################################################
 ##### schemas for serialization/deserialization                            #####
@@ -42,6 +55,7 @@ class DirectorySchema(Schema):
     name = fields.String()
     path = fields.String()
     type = fields.String()
+    sha256 = fields.String()
     children = fields.Nested('self', exclude=(), default=[], many=True)
 
     class Meta:
@@ -54,6 +68,9 @@ class DraftSchema(Schema):
     PID = fields.String(required=True, default=None, missing=None)
     parent_version = fields.String(required=True, default=None, missing=None)
     created_at = fields.DateTime(required=True)
+    compression = fields.String(default=None, missing=None)
+    chunking = fields.Dict(default=None, missing=None)
+    whiteouts = fields.List(fields.String(), default=[], missing=[])
     contents = fields.Nested(DirectorySchema, required=True, default=[], many=True)
 
     @pre_load(pass_many=True)
@@ -76,6 +93,8 @@ class DatasetSchema(Schema):
 
     PID = fields.String(required=True)
     current = fields.String(required=True)
+    compression = fields.String(default=None, missing=None)
+    chunking = fields.Dict(default=None, missing=None)
 
 class VersionSchema(Schema):
     """ schema to serialize/deserialize a version descriptor """
@@ -109,6 +128,7 @@ class Filesystem:
     default_config = {
         'TMP_FOLDER'                : 'tmp',
         'TRASH_FOLDER'              : 'trash',
+        'PROFILES_FOLDER'           : 'profiles',
         'DRAFTS_FOLDER'             : 'drafts',
         'DRAFTS_METADATA_FOLDER'    : os.path.join('drafts', 'metadata'),
         'DRAFTS_DATA_FOLDER'        : os.path.join('drafts', 'data'),
@@ -117,6 +137,10 @@ class Filesystem:
         'VERSIONS_METADATA_PREFIX'  : os.path.join('versions', 'metadata'),
         'VERSIONS_DATA_PREFIX'      : os.path.join('versions', 'data')
     }
+
+    # number of levels of subdirectories used to spread the drafts and 
+    # datasets of the repository (each level has up to 256 entries)
+    SHARD_LEVELS = 2
     
     def _build(self):
         """ This function initializes the configuration options of the backend,
@@ -136,43 +160,66 @@ class Filesystem:
             if not os.path.exists(rd):
                 os.makedirs(rd)
 
-    def __init__(self, base_location, permanent_remove, remove_fingerprints):
+    def __init__(self, base_location, permanent_remove, remove_fingerprints,
+                 unpack_threads=None, trash_max_age=None, trash_max_size=None, 
+                 trash_throttle=0.0, trash_interval=None, fingerprint_cache_size=8,
+                 batch_threads=4):
         """This function creates the necessary structures in the filesystem to
         represent the repository metadta and data contents. The repository 
         organization will eventually end up as follows:
 
         <base_location>
         ├── datasets
-        │   ├── 01f96f238278463c
-        │   │   ├── 01f96f238278463c.json
-        │   │   └── versions
-        │   │       ├── data
-        │   │       │   └── 00c63abb
-        │   │       │       └── foo
-        │   │       │           └── bar
-        │   │       │               └── data_00.tar.gz
-        │   │       └── metadata
-        │   │           └── 00c63abb.json
+        │   └── a9
+        │       └── af
+        │           └── 01f96f238278463c
+        │               ├── 01f96f238278463c.json
+        │               └── versions
+        │                   ├── data
+        │                   │   └── 00c63abb
+        │                   │       └── foo
+        │                   │           └── bar
+        │                   │               └── data_00.tar.gz
+        │                   └── metadata
+        │                       └── 00c63abb.json
         ├── drafts
         │   ├── data
-        │   │   └── fe5c2d9f
-        │   │       └── foo
-        │   │           └── bar
-        │   │               └── data_00.tar.gz
+        │   │   └── 60
+        │   │       └── d9
+        │   │           └── fe5c2d9f
+        │   │               └── foo
+        │   │                   └── bar
+        │   │                       └── data_00.tar.gz
         │   └── metadata
-        │       └── fe5c2d9f.json
+        │       └── 60
+        │           └── d9
+        │               └── fe5c2d9f.json
+        ├── profiles
         ├── tmp
         └── trash
 
         ... though this function only creates the main directories of this
-        configuration.
+        configuration. Drafts and datasets are spread over subdirectories 
+        named after the hash of their ID (see _sharded_path()).
         """
 
         self.base_location = base_location
         self.permanent_remove = permanent_remove
         self.remove_fps = remove_fingerprints
+        self.unpack_threads = unpack_threads
+        self.batch_threads = batch_threads
         self.config = dict()
 
+        # cache for recently used (unpickled) fingerprints, which are 
+        # expensive to load for large datasets
+        self.fps_cache = OrderedDict()
+        self.fps_cache_size = fingerprint_cache_size
+        self.fps_cache_lock = threading.Lock()
+
+        # per-draft locks to serialize updates to a draft's metadata
+        self.draft_locks = {}
+        self.draft_locks_lock = threading.Lock()
+
         # make sure that the base_location is used
         for key in self.default_config:
             if '_FOLDER' in key:
@@ -191,11 +238,124 @@ class Filesystem:
 
         self._build()
 
+        # repositories created by older versions keep all their drafts and
+        # datasets at the top level of their folders. They are still found 
+        # there until they are migrated (see migrate_layout())
+        self.legacy_layout = self._has_legacy_entries()
+
+        # discarded data is kept in the TRASH folder until it expires, and
+        # it is removed in the background (if ``trash_interval`` is set)
+        self.trash = Trash(self.config['TRASH_FOLDER'], 
+                           max_age=trash_max_age, max_size=trash_max_size,
+                           throttle=trash_throttle, interval=trash_interval)
+        self.trash.start()
+
     def destroy(self):
         """This function destroys the repository.
         """
+        self.trash.stop()
         shutil.rmtree(self.base_location)
 
+    def collect_trash(self):
+        """This function removes all expired entries from the TRASH folder
+        and returns the number of bytes reclaimed.
+        """
+        return self.trash.collect()
+
+    def get_trash_stats(self):
+        return self.trash.stats()
+
+    def get_profiles_path(self):
+        """This function returns the path to the folder where request profiles
+        are saved, creating it if needed. It is kept out of the TMP folder, 
+        whose old entries are removed by find_garbage().
+        """
+
+        path = self.config['PROFILES_FOLDER']
+        os.makedirs(path, exist_ok=True)
+
+        return path
+
+    def discard(self, path, namespace, purge=False):
+        """This function moves ``path`` to the TRASH folder under 
+        ``namespace``. If ``purge`` is True it will be removed in the next
+        trash collection.
+        """
+        return self.trash.discard(path, namespace, purge)
+
+    def find_garbage(self, grace_period=0):
+        """This function generates a (path, namespace, reason) tuple for each
+        piece of data in the repository that is not referenced by any draft
+        or version record and that has not been modified in the last
+        ``grace_period`` seconds.
+        """
+
+        now = time.time()
+
+        def is_old(path):
+            try:
+                return now - os.lstat(path).st_mtime > grace_period
+            except OSError:
+                return False
+
+        # draft data and fingerprints without a draft record
+        dd_path = self.config['DRAFTS_DATA_FOLDER']
+
+        for entry in self._iter_entries(dd_path):
+            DID = entry.name
+            _, record_path, _ = self._get_draft_metadata_paths(DID)
+            data_path = entry.path
+
+            if not os.path.exists(record_path) and is_old(data_path):
+                yield data_path, self.default_config['DRAFTS_DATA_FOLDER'], \
+                      'draft data without record'
+
+        dm_path = self.config['DRAFTS_METADATA_FOLDER']
+
+        # (both the overlays, <DID>.fps, and the base sets, <DID>.base.fps)
+        for entry in self._iter_entries(dm_path):
+            if not entry.name.endswith('.fps'):
+                continue
+
+            fps_path = entry.path
+            DID = entry.name.split('.')[0]
+            _, record_path, _ = self._get_draft_metadata_paths(DID)
+
+            if not os.path.exists(record_path) and is_old(fps_path):
+                yield fps_path, self.default_config['DRAFTS_METADATA_FOLDER'], \
+                      'draft fingerprints without record'
+
+        # version data without a version record
+        for entry in self._iter_entries(self.config['DATASETS_FOLDER']):
+            PID = entry.name
+            dataset_path = entry.path
+
+            if not entry.is_dir():
+                continue
+
+            vd_path = os.path.join(dataset_path, self.config['VERSIONS_DATA_PREFIX'])
+
+            if not os.path.isdir(vd_path):
+                continue
+
+            for VID in os.listdir(vd_path):
+                _, record_path, _ = self._get_version_metadata_paths(PID, VID)
+                data_path = self._get_version_data_path(PID, VID)
+
+                if not os.path.exists(record_path) and is_old(data_path):
+                    yield data_path, os.path.join(
+                            self.default_config['DATASETS_FOLDER'], PID, 'data'), \
+                          'version data without record'
+
+        # leftovers from interrupted uploads
+        tmp_path = self.config['TMP_FOLDER']
+
+        for entry in os.listdir(tmp_path):
+            path = os.path.join(tmp_path, entry)
+
+            if is_old(path):
+                yield path, self.default_config['TMP_FOLDER'], 'stale temporary data'
+
     def load_draft_record(self, DID, fetch_data=False, fetch_fingerprints=False):
         """This function loads the JSON record for draft ``DID`` from the 
         filesystem.
@@ -210,8 +370,10 @@ class Filesystem:
 
         data_path = None
 
+        # the data of a draft is a layered view of its own files and those
+        # of its parent version
         if fetch_data:
-            data_path = self._get_draft_data_path(DID)
+            data_path = self._get_draft_tree(draft)
 
         return draft, data_path, fps_path
 
@@ -232,14 +394,20 @@ class Filesystem:
         # if this is the first time that the record is saved we need to create
         # the directory structure
         if not os.path.exists(data_dir) or not os.path.exists(dst_file):
-            self._create_draft_record_tree(data_dir)
+            self._create_draft_record_tree(DID)
 
         # serialize 'dict' -> 'json'
         data_out = self.draft_serializer.dump(draft)
 
-        # store the info about the draft as a JSON file
-        with open (dst_file, 'w') as outfile:
-            json.dump(data_out.data, outfile)
+        # store the info about the draft as a JSON file. The record is read
+        # by every request on the draft (e.g. to resolve its layers), so it
+        # is replaced atomically rather than rewritten in place
+        with metrics.span('save_draft_record'):
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(dst_file), 
+                                             suffix='.tmp', delete=False) as outfile:
+                json.dump(data_out.data, outfile)
+
+            os.replace(outfile.name, dst_file)
 
         return data_out.data
 
@@ -252,20 +420,16 @@ class Filesystem:
         # remove metadata record
         _, src_file, _ = self._get_draft_metadata_paths(DID)
 
-        if self.permanent_remove:
-            self._remove_file(src_file)
-        else:
-            self._move_file(src_file, self.config['TRASH_FOLDER'])
+        self._discard(src_file, self.default_config['DRAFTS_METADATA_FOLDER'])
         
         if remove_data:
             # remove draft data
             src_path = self._get_draft_data_path(DID)
 
-            if self.permanent_remove:
-                self._remove_directory(src_path)
-            else:
-                self._move_directory(src_path, self.config['TRASH_FOLDER'])
+            self._discard(src_path, self.default_config['DRAFTS_DATA_FOLDER'])
 
+        with self.draft_locks_lock:
+            self.draft_locks.pop(DID, None)
 
     def load_draft_records(self):
         """This function generates a list of all draft records currently 
@@ -274,19 +438,37 @@ class Filesystem:
 
         src_path = self.config['DRAFTS_METADATA_FOLDER']
 
-        for f in glob.glob(os.path.join(src_path, "*.json")):
-            draft = self._read_draft_from_file(f)
-            yield draft
+        for entry in self._iter_entries(src_path):
+            if entry.name.endswith('.json'):
+                draft = self._read_draft_from_file(entry.path)
+                yield draft
 
-    def _create_file(self, draft, stream_iterator, filename, usr_path):
+    def _create_file(self, draft, stream_iterator, filename, usr_path, unpack=False):
 
         # create a temporary directory to save the user-provided file until
         # we determine its final location
         tmp_dir = tempfile.mkdtemp(dir=self.config['TMP_FOLDER'])
 
+        try:
+            return self._store_new_file(draft, stream_iterator, tmp_dir, usr_path, unpack)
+        finally:
+            # remove the temporary directory (and anything left in it if the
+            # upload failed)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _store_new_file(self, draft, stream_iterator, tmp_dir, usr_path, unpack):
+        """ This function implements _create_file(), using ``tmp_dir`` to 
+        save the uploaded file """
+
         payload = stream_iterator.get("file")
         tmp_filename = self._mktemp(payload.filename, tmp_dir)
-        payload.save(tmp_filename)
+
+        with metrics.span('save_upload'):
+            payload.save(tmp_filename)
+
+        # if the user asked for the file to be unpacked, do so
+        if unpack and is_archive(tmp_filename):
+            return self._unpack_file_to_draft(draft, tmp_filename, tmp_dir, usr_path)
 
         # if the user provided a destination path we need to honor it
         DID = draft['id']
@@ -295,49 +477,55 @@ class Filesystem:
 
         if usr_path is not None:
             dst_path = os.path.join(dst_path, usr_path)
-            if not os.path.exists(dst_path):
-                os.makedirs(dst_path)
+            # (concurrent uploads may be creating it too)
+            os.makedirs(dst_path, exist_ok=True)
 
         # generate and store fingerprints for the new file
         # XXX this should be multithreaded
-        new_fps = { filename: librp.get_file_fingerprints(tmp_filename) }
-
-        old_fps = self._load_draft_fingerprints(DID)
+        file_fps, digest = self._compute_fingerprints(tmp_filename, draft.get('chunking'))
 
-        merged_fps = self._merge_fingerprints(old_fps, new_fps)
+        file_size = os.path.getsize(tmp_filename)
+        metrics.UPLOAD_FILE_BYTES.inc(file_size, mode='create')
+        metrics.UPLOAD_TRANSFERRED_BYTES.inc(file_size, mode='create')
 
         # try to move the file to its final location (this will raise
-        # an exception if the destination already exists)
+        # an exception if the destination already exists, either in the 
+        # draft or in its parent version)
         try:
-            self._move_file(tmp_filename, dst_path)
+            dst_file = os.path.join(dst_path, os.path.basename(tmp_filename))
+
+            if self._get_draft_tree(draft).exists(os.path.relpath(dst_file, base_path)):
+                raise shutil.Error("Destination path '{}' already exists".format(dst_file))
+
+            self._store_file(tmp_filename, dst_file, draft.get('compression'))
         except shutil.Error as e:
-            # remove the temporary file, since the upload failed and re-raise
-            # the exception
-            self._remove_file(tmp_filename)
-            os.rmdir(tmp_dir)
             raise Exception("Destination path already exists")
 
-        # if the move succeeded, store the fingerprints
-        self._save_draft_fingerprints(DID, merged_fps)
+        # if the move succeeded, store the fingerprints (keyed by the path of
+        # the file in the draft). Updates to the draft's metadata must be 
+        # serialized, since there may be concurrent uploads to the same draft
+        relpath = os.path.relpath(dst_file, base_path).replace(os.sep, '/')
+        new_fps = { relpath : file_fps }
+
+        with self._draft_lock(DID):
+            old_fps = self._load_draft_overlay(DID)
 
-        # FIXME we could be smarter with this and update only what has changed
-        contents = self._load_draft_contents(DID)
+            merged_fps = self._merge_fingerprints(old_fps, new_fps)
 
-        # add the 'contents' to the draft descriptor and 
-        # update it in the repository
-        # NOTE: 'draft' is already an entry in cached_drafts
-        # and we can modify it in place
-        draft['contents'] = contents
+            self._save_draft_fingerprints(DID, merged_fps)
 
-        # also update it in the backend
-        self.save_draft_record(draft)
+            # FIXME we could be smarter with this and update only what has changed
+            # NOTE: 'draft' is already an entry in cached_drafts
+            # and we can modify it in place
+            self._update_draft_contents(draft, { relpath : digest })
 
-        # remove the temporary directory (which should now be empty)
-        os.rmdir(tmp_dir)
+            # also update it in the backend
+            self.save_draft_record(draft)
 
         return draft
 
-    def _rebuild_file(self, out_filename, new_fps, old_fps, orig_filepath, new_parts):
+    def _rebuild_file(self, out_filename, new_fps, old_fps, orig_filepath, new_parts,
+                      compression=None):
 
         # get size information from the provided new_parts
         # (order is important)
@@ -359,145 +547,474 @@ class Filesystem:
 
             patches_size += sz
 
-        old_hashes = {hv:(offset,size) for offset,size,hv in old_fps}
+        # we need to build a map to see how to reconstruct it and from where:
+        # runs of consecutive chunks that are also consecutive in the original
+        # file are copied with a single read. Chunks that are not in the 
+        # original file (including those whose Rabin hash collides with that 
+        # of a different chunk) must have been sent by the client
+        with metrics.span('plan_rebuild'):
+            runs = plan_rebuild(new_fps, old_fps)
 
-        # we need to build a map to see how to reconstruct it and from where
         rebuild_map = []
 
-        expected_size = 0
-        for fps in new_fps:
+        for first, last, old_offset in runs:
+            if old_offset is not None:
+                rebuild_map.append((first, last, orig_filepath, old_offset))
+                continue
 
-            new_offset = fps[0]
-            new_size = fps[1]
-            hv = fps[2]
+            # find the appropriate part file that matches the required offset
+            new_offset = new_fps[first][0]
+            if new_offset not in patches:
+                assert(False)
 
-            expected_size += new_size
+            part_file, part_size = patches[new_offset]
 
-            if hv in old_hashes:
-                old_offset, old_size = old_hashes[hv]
-                assert(old_size == new_size)
+            assert(new_fps[first][1] == part_size)
 
-                rebuild_map.append((new_offset, new_size, orig_filepath, old_offset, old_size))
-            else:
-                # find the appropriate part file that matches the required offset
-                if new_offset not in patches:
-                    assert(False)
+            rebuild_map.append((first, last, part_file, 0))
 
-                part_file, part_size = patches[new_offset]
+        # check that the new fingerprints are consistent:
+        # first entry must have offset 0
+        expected_size = 0
 
-                assert(new_size == part_size)
+        for fps in new_fps:
+            assert(fps[0] == expected_size)
+            expected_size += fps[1]
 
-                rebuild_map.append((new_offset, new_size, part_file, 0, part_size))
+        # everything looks ok: rebuild the file, computing the digest of each
+        # chunk as it is written and checking it against the one sent by the
+        # client (if any)
+        rebuilt_fps = []
+        file_hash = hashlib.sha256()
 
-        # check that the rebuild_map is consistent:
-        # first entry must have offset 0
-        assert(rebuild_map[0][0] == 0)
-        prev_offset = 0
-        prev_size = rebuild_map[0][1]
-        rebuild_size = prev_size
+        with open(out_filename, "wb") as outfile:
+            for first, last, part_file, part_offset in rebuild_map:
+                
+                # (only the original file is stored, maybe compressed with 
+                # the draft's ``compression``)
+                with open_stored_file(part_file, compression if part_file == orig_filepath 
+                                                             else None) as infile:
+                    infile.seek(part_offset)
 
-        for entry in rebuild_map[1:]:
-            part_offset = entry[0]
-            part_size = entry[1]
+                    for fps in new_fps[first:last]:
+                        data = infile.read(fps[1])
 
-            assert(part_offset == (prev_offset + prev_size))
+                        digest = chunk_digest(data)
 
-            prev_offset = part_offset
-            prev_size = part_size
-            rebuild_size += prev_size
+                        if len(fps) > 3 and fps[3] != digest:
+                            raise ValueError("Chunk at offset {} does not match its "
+                                             "digest".format(fps[0]))
 
-        assert(expected_size == rebuild_size)
+                        outfile.write(data)
+                        file_hash.update(data)
 
-        # everything looks ok: rebuild the file
-        with open(out_filename, "wb") as outfile:
-            for entry in rebuild_map:
-                part_file = entry[2]
-                part_offset = entry[3]
-                part_size = entry[4]
-                
-                with open(part_file, "rb") as infile:
-                    infile.seek(part_offset)
-                    outfile.write(infile.read(part_size))
+                        rebuilt_fps.append((fps[0], fps[1], fps[2], digest))
 
         # check that the output size matches what is expected
         assert(os.stat(out_filename).st_size == expected_size)
 
-        # XXX: paranoia mode, check that the fingerprints for the generated file
-        # match those sent by the client. This can take a long time for
-        # really large files
+        # XXX: paranoia mode, check that the Rabin fingerprints for the 
+        # generated file match those sent by the client. This can take a long
+        # time for really large files, and chunks are already identified by
+        # their digests
         # assert(librp.get_file_fingerprints(out_filename) == new_fps)
 
+        return rebuilt_fps, file_hash.hexdigest()
 
     def _replace_file(self, draft, stream_iterator, filename, usr_path):
 
-        # check that the file actually exists in the repository
-        DID = draft['id']
-        base_path = self._get_draft_data_path(DID)
-        dst_path = base_path
-
         # if the user has provided a destination path we need to honor it
         if usr_path is not None:
-            dst_path = os.path.join(dst_path, usr_path)
-
-        orig_filepath = os.path.join(dst_path, filename)
-
-        if not os.path.exists(orig_filepath):
-            raise Exception("Replacement target does not exist")
+            relpath = os.path.join(usr_path, filename)
+        else:
+            relpath = filename
 
         # create a temporary directory to rebuild the file
         tmp_dir = tempfile.mkdtemp(dir=self.config['TMP_FOLDER'])
 
+        try:
+            return self._store_replaced_file(draft, stream_iterator, tmp_dir, 
+                                             filename, relpath)
+        finally:
+            # remove the temporary directory (and anything left in it if the
+            # replace failed)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _store_replaced_file(self, draft, stream_iterator, tmp_dir, filename, relpath):
+        """ This function implements _replace_file(), using ``tmp_dir`` to 
+        save the uploaded parts and rebuild the file """
+
+        DID = draft['id']
+        base_path = self._get_draft_data_path(DID)
+
+        # check that the file actually exists in the repository (it may be
+        # in the draft or in its parent version) and that its fingerprints 
+        # are known
+        server_fps = self._load_draft_fingerprints(DID)
+        stored_file_fps = lookup_file_fingerprints(server_fps, relpath)
+        orig_filepath = self._get_draft_tree(draft).resolve(relpath)
+
+        if stored_file_fps is None or orig_filepath is None:
+            raise Exception("Replacement target does not exist")
+
         # fetch the fingerprints sent by the client
         stream = stream_iterator.get("fingerprints")
 
-        client_file_fps = _pickle.loads(stream.read())
+        with metrics.span('load_client_fingerprints'):
+            client_file_fps = _pickle.loads(stream.read())
 
         # now fetch the parts sent by the client and save them to disk, since
         # they may not fit into memory
         new_parts = []
-        for part in stream_iterator.getlist("parts"):
-            tmp_filename = self._mktemp(part.filename, tmp_dir)
-            part.save(tmp_filename)
-            new_parts.append(tmp_filename)
+        with metrics.span('save_upload'):
+            for part in stream_iterator.getlist("parts"):
+                tmp_filename = self._mktemp(part.filename, tmp_dir)
+                part.save(tmp_filename)
+                new_parts.append(tmp_filename)
 
-        _, _, fps_path = self.load_draft_record(draft['id'], False, True)
+        tmp_output = self._mktemp(filename + ".rebuilt", tmp_dir) 
 
-        with open(fps_path, "rb") as infile:
-            server_fps = _pickle.load(infile)
+        with metrics.span('rebuild_file'), metrics.REBUILD_SECONDS.time():
+            file_fps, digest = self._rebuild_file(tmp_output, client_file_fps, 
+                                                  stored_file_fps, orig_filepath, new_parts,
+                                                  draft.get('compression'))
 
-        stored_file_fps = server_fps[filename]
+        with self._draft_lock(DID):
+            # the file may have been replaced by another upload while it was
+            # rebuilt: rebuild it again from its new contents
+            server_fps = self._load_draft_fingerprints(DID)
 
-        tmp_output = self._mktemp(filename + ".rebuilt", tmp_dir) 
+            if lookup_file_fingerprints(server_fps, relpath) != stored_file_fps:
+                stored_file_fps = lookup_file_fingerprints(server_fps, relpath)
+                orig_filepath = self._get_draft_tree(draft).resolve(relpath)
+
+                if stored_file_fps is None or orig_filepath is None:
+                    raise Exception("Replacement target does not exist")
+
+                with metrics.span('rebuild_stale_file'):
+                    file_fps, digest = self._rebuild_file(tmp_output, client_file_fps, 
+                                                          stored_file_fps, orig_filepath, 
+                                                          new_parts, draft.get('compression'))
+
+            # move the rebuilt file to its final location, which is always in 
+            # the draft's own layer
+            dst_file = os.path.join(base_path, relpath)
+
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+            self._store_file(tmp_output, dst_file, draft.get('compression'), overwrite=True)
+
+            # update the fingerprints
+
+            # XXX: paranoia mode, we are taking the client sent Rabin hashes at 
+            # face value, though the digests of all chunks have been verified (or
+            # computed) while rebuilding the file
+            new_fps = { relpath: file_fps }
+
+            old_fps = self._load_draft_overlay(DID)
+
+            merged_fps = self._merge_fingerprints(old_fps, new_fps)
+
+            self._save_draft_fingerprints(DID, merged_fps)
+        
+            # the file has the same name and type, but its digest has changed
+            self._update_draft_contents(draft, { relpath : digest })
+
+            self.save_draft_record(draft)
 
-        self._rebuild_file(tmp_output, client_file_fps, stored_file_fps, orig_filepath, new_parts)
+        file_size = sum(fp[1] for fp in client_file_fps)
+        transferred = sum(os.path.getsize(p) for p in new_parts)
 
-        # move the rebuilt file to its final location
-        self._move_file(tmp_output, orig_filepath, overwrite=True)
+        metrics.UPLOAD_FILE_BYTES.inc(file_size, mode='replace')
+        metrics.UPLOAD_TRANSFERRED_BYTES.inc(transferred, mode='replace')
 
-        # update the fingerprints
+        if file_size > 0:
+            metrics.UPLOAD_DEDUP_RATIO.observe(1.0 - transferred / file_size)
+
+        return draft
+
+    @staticmethod
+    def _batch_relpath(name, usr_path=None):
+        """ This function validates and normalizes the path ``name`` of a 
+        file in a batch (relative to ``usr_path`` in the draft) """
 
         if usr_path is not None:
-            relpath = os.path.join(usr_path, filename)
+            name = usr_path.strip('/') + '/' + name
+
+        relpath = os.path.normpath(name.replace('\\', '/')).lstrip('/')
+
+        if relpath in ('', '.') or relpath.startswith('..') or \
+           '..' in relpath.split(os.sep):
+            raise ValueError("Invalid path '{}'".format(name))
+
+        return relpath
+
+    def _save_batch(self, stream_iterator, tmp_dir, usr_path):
+        """ This function saves the payloads of a batch upload into 
+        ``tmp_dir`` and returns a list of items describing them """
+
+        items = []
+        seen = set()
+
+        def new_item(kind, relpath):
+            if relpath in seen:
+                raise ValueError("Path '{}' appears more than once in the batch".format(relpath))
+            seen.add(relpath)
+
+            item_dir = os.path.join(tmp_dir, str(len(items)))
+            os.mkdir(item_dir)
+
+            item = {'kind' : kind, 'relpath' : relpath, 'dir' : item_dir, 'parts' : []}
+            items.append(item)
+            return item
+
+        with metrics.span('save_upload'):
+            # new files
+            for payload in stream_iterator.getlist("files"):
+                item = new_item('create', self._batch_relpath(payload.filename, usr_path))
+                item['file'] = self._mktemp(os.path.basename(item['relpath']), item['dir'])
+                payload.save(item['file'])
+
+            # delta sets: client fingerprints + missing parts for each file
+            replacements = {}
+            for payload in stream_iterator.getlist("replace.fingerprints"):
+                item = new_item('replace', self._batch_relpath(payload.filename, usr_path))
+                item['fps'] = _pickle.loads(payload.read())
+                replacements[payload.filename] = item
+
+            for payload in stream_iterator.getlist("replace.parts"):
+                target = payload.filename.rsplit('.__part_', 1)[0]
+
+                if target not in replacements:
+                    raise ValueError("Part '{}' doesn't belong to any file in the "
+                                     "batch".format(payload.filename))
+
+                item = replacements[target]
+                part_filename = self._mktemp(os.path.basename(payload.filename), item['dir'])
+                payload.save(part_filename)
+                item['parts'].append(part_filename)
+
+        return items
+
+    def _process_batch_item(self, draft, tree, item, server_fps):
+        """ This function prepares a file of a batch so that it can be moved
+        into the draft: it computes the fingerprints of new files, rebuilds
+        replaced ones and compresses them if required. It is run concurrently
+        for all the files in a batch.
+        """
+
+        base_path = self._get_draft_data_path(draft['id'])
+        dst_file = os.path.join(base_path, item['relpath'])
+        stored_file_fps = None
+
+        if item['kind'] == 'create':
+            staged = item['file']
+            fps, digest = self._compute_fingerprints(staged, draft.get('chunking'))
+
+            file_size = os.path.getsize(staged)
+            metrics.UPLOAD_FILE_BYTES.inc(file_size, mode='create')
+            metrics.UPLOAD_TRANSFERRED_BYTES.inc(file_size, mode='create')
         else:
-            relpath = filename
+            stored_file_fps = lookup_file_fingerprints(server_fps, item['relpath'])
+            orig_file = tree.resolve(item['relpath'])
 
-        # XXX: paranoia mode, we are taking the client sent FPS at face value.
-        # for security reasons, it would be better to recompute them, though
-        # this may take a long time
-        new_fps = { relpath: client_file_fps }
-        old_fps = self._load_draft_fingerprints(DID)
+            if stored_file_fps is None or orig_file is None:
+                raise Exception("Replacement target '{}' does not exist".format(
+                                item['relpath']))
 
-        merged_fps = self._merge_fingerprints(old_fps, new_fps)
+            staged = self._mktemp(os.path.basename(item['relpath']) + ".rebuilt", item['dir'])
+            with metrics.span('rebuild_file'), metrics.REBUILD_SECONDS.time():
+                fps, digest = self._rebuild_file(staged, item['fps'], stored_file_fps, 
+                                                 orig_file, item['parts'], 
+                                                 draft.get('compression'))
 
-        self._save_draft_fingerprints(DID, merged_fps)
-        
-        # NOTE: there is no need to update the 'contents' since the file
-        # has the same name and type
+            file_size = sum(fp[1] for fp in fps)
+            transferred = sum(os.path.getsize(p) for p in item['parts'])
+            metrics.UPLOAD_FILE_BYTES.inc(file_size, mode='replace')
+            metrics.UPLOAD_TRANSFERRED_BYTES.inc(transferred, mode='replace')
+
+            if file_size > 0:
+                metrics.UPLOAD_DEDUP_RATIO.observe(1.0 - transferred / file_size)
+
+        if draft.get('compression') is not None:
+            compress_file(staged, staged + ".compressed", draft['compression'])
+            staged = staged + ".compressed"
+
+        return item['relpath'], staged, dst_file, fps, digest, stored_file_fps
+
+    @staticmethod
+    def _check_batch_paths(tree, items):
+        """ This function checks that all the files of a batch can be moved
+        into the draft whose data is ``tree``: new files must not exist, and
+        no file can be placed under another file of the batch or under a
+        file that is already in the draft.
+        """
+
+        relpaths = set(item['relpath'] for item in items)
+
+        for item in items:
+            parts = item['relpath'].split('/')
+
+            for i in range(1, len(parts)):
+                parent = '/'.join(parts[:i])
+
+                if parent in relpaths:
+                    raise ValueError("'{}' cannot be both a file and a directory "
+                                     "in the batch".format(parent))
+
+                if tree.resolve(parent) is not None:
+                    raise shutil.Error("Destination path '{}' is a file".format(parent))
+
+            if item['kind'] == 'create' and tree.exists(item['relpath']):
+                raise shutil.Error("Destination path '{}' already exists".format(
+                                   item['relpath']))
+
+    def _move_batch_files(self, results, replaced, backup_dir):
+        """ This function moves the files of a batch into the draft. If any
+        of them fails, the files already moved are removed (or restored from
+        the hard links kept in ``backup_dir``, if they replaced another file)
+        and the exception is raised again. It returns a function that undoes
+        the moves.
+        """
+
+        moved = []
+        created_dirs = []
+
+        def undo():
+            for dst_file, backup in reversed(moved):
+                if backup is not None:
+                    os.replace(backup, dst_file)
+                else:
+                    self._remove_file(dst_file)
+
+            # only the directories left empty are removed, since concurrent
+            # uploads may have added files to them
+            for top in reversed(created_dirs):
+                for root, _, _ in os.walk(top, topdown=False):
+                    try:
+                        os.rmdir(root)
+                    except OSError:
+                        pass
+
+        try:
+            for i, (relpath, staged, dst_file, _, _, _) in enumerate(results):
+                parent = os.path.dirname(dst_file)
+
+                if not os.path.isdir(parent):
+                    top = parent
+                    while not os.path.isdir(os.path.dirname(top)):
+                        top = os.path.dirname(top)
+
+                    os.makedirs(parent, exist_ok=True)
+                    created_dirs.append(top)
+
+                backup = None
+
+                if relpath in replaced and os.path.exists(dst_file):
+                    backup = os.path.join(backup_dir, 'backup_{}'.format(i))
+                    self._link_file(dst_file, backup)
 
-        # remove the temporary directory
-        shutil.rmtree(tmp_dir)
+                self._move_file(staged, dst_file, overwrite=relpath in replaced)
+                moved.append((dst_file, backup))
+        except Exception:
+            undo()
+            raise
+
+        return undo
+
+    def _commit_batch_files(self, draft, results, undo):
+        """ This function updates the fingerprints and the contents of the 
+        draft with the files of a batch once they have been moved into it 
+        (see _move_batch_files()). If the metadata cannot be saved, the moves
+        are undone with ``undo`` and the previous fingerprints are restored.
+        The draft must be locked by the caller.
+        """
+
+        DID = draft['id']
+
+        new_fps = {}
+        digests = {}
+        for relpath, _, _, fps, digest, _ in results:
+            new_fps[relpath] = fps
+            digests[relpath] = digest
+
+        old_fps = self._load_draft_overlay(DID)
+
+        try:
+            merged_fps = self._merge_fingerprints(old_fps, new_fps)
+
+            self._save_draft_fingerprints(DID, merged_fps)
+
+            self._update_draft_contents(draft, digests)
+
+            self.save_draft_record(draft)
+        except Exception:
+            undo()
+
+            if old_fps is not None:
+                self._save_draft_fingerprints(DID, old_fps)
+            else:
+                _, _, fps_path = self._get_draft_metadata_paths(DID)
+
+                if os.path.exists(fps_path):
+                    self._remove_file(fps_path)
+            raise
+
+    def add_batch_to_draft(self, draft, stream_iterator, usr_path=None):
+        """This function adds all the files and delta sets contained in 
+        ``stream_iterator`` to the draft. New files are sent as 'files' 
+        payloads named after their path in the draft, while replacements are
+        sent as 'replace.fingerprints' payloads (named after the path of the
+        file to replace) and 'replace.parts' payloads (named 
+        '<path>.__part_<offset>_<size>__'). Payloads are processed 
+        concurrently and the draft's metadata is updated only once. If any 
+        file in the batch fails, the draft is left untouched. Files replaced
+        concurrently by other uploads while the batch was processed are
+        rebuilt again from their new contents.
+        """
+
+        DID = draft['id']
+
+        tmp_dir = tempfile.mkdtemp(dir=self.config['TMP_FOLDER'])
+
+        try:
+            items = self._save_batch(stream_iterator, tmp_dir, usr_path)
+
+            tree = self._get_draft_tree(draft)
+
+            self._check_batch_paths(tree, items)
+
+            server_fps = self._load_draft_fingerprints(DID)
+
+            with ThreadPoolExecutor(max_workers=max(1, self.batch_threads)) as pool:
+                results = list(pool.map(metrics.bind_spans(
+                    lambda item: self._process_batch_item(draft, tree, item, server_fps)), 
+                    items))
+
+            replaced = set(i['relpath'] for i in items if i['kind'] == 'replace')
+
+            # commit: move all files into place and update the metadata once
+            with self._draft_lock(DID):
+                # other uploads may have changed the draft meanwhile
+                tree = self._get_draft_tree(draft)
+
+                self._check_batch_paths(tree, items)
+
+                server_fps = self._load_draft_fingerprints(DID)
+
+                for i, item in enumerate(items):
+                    if item['kind'] == 'replace' and results[i][5] != \
+                            lookup_file_fingerprints(server_fps, item['relpath']):
+                        with metrics.span('rebuild_stale_file'):
+                            results[i] = self._process_batch_item(draft, tree, item, server_fps)
+
+                undo = self._move_batch_files(results, replaced, tmp_dir)
+
+                self._commit_batch_files(draft, results, undo)
+
+        finally:
+            shutil.rmtree(tmp_dir)
 
-        # TODO exceptions, return, etc
         return draft
 
     def add_file_to_draft(self, draft, stream_iterator, filename, usr_path, unpack, replace):
@@ -506,7 +1023,7 @@ class Filesystem:
         """
 
         if not replace:
-            return self._create_file(draft, stream_iterator, filename, usr_path)
+            return self._create_file(draft, stream_iterator, filename, usr_path, unpack)
 
         return self._replace_file(draft, stream_iterator, filename, usr_path)
 
@@ -569,6 +1086,176 @@ class Filesystem:
 
         ### return draft#self.draft_serializer.dump(draft)
 
+    def remove_path_from_draft(self, draft, usr_path):
+        """This function removes the file or directory ``usr_path`` from the
+        draft. The draft's own files are discarded, while those of its parent
+        version are hidden by a whiteout. The 'contents' and the fingerprints 
+        of the draft are updated in place, without scanning its data. Returns
+        None if there is no such path in the draft.
+        """
+
+        DID = draft['id']
+        relpath = normalize_relpath(usr_path)
+
+        if relpath is None:
+            raise ValueError("Invalid path '{}'".format(usr_path))
+
+        with self._draft_lock(DID):
+            tree = self._get_draft_tree(draft)
+
+            if not tree.exists(relpath):
+                return None
+
+            overlay = self._load_draft_overlay(DID)
+            new_fps = dict(overlay or {})
+
+            self._remove_draft_path(draft, tree, relpath, new_fps)
+
+            if overlay is not None or new_fps:
+                self._save_draft_fingerprints(DID, new_fps)
+
+            self.save_draft_record(draft)
+
+        return draft
+
+    def move_draft_path(self, draft, src_path, dst_path):
+        """This function moves (renames) the file or directory ``src_path``
+        of the draft to ``dst_path``. Files are never copied: the draft's own
+        files are renamed, while those of its parent version are linked into
+        the draft and hidden at their old path. Returns None if there is no 
+        such path in the draft.
+        """
+
+        return self._transfer_draft_path(draft, src_path, dst_path, keep_source=False)
+
+    def copy_draft_path(self, draft, src_path, dst_path):
+        """This function copies the file or directory ``src_path`` of the 
+        draft to ``dst_path``. Stored files are immutable, so the copies are
+        hard links to the original files. Returns None if there is no such
+        path in the draft.
+        """
+
+        return self._transfer_draft_path(draft, src_path, dst_path, keep_source=True)
+
+    def _transfer_draft_path(self, draft, src_path, dst_path, keep_source):
+
+        DID = draft['id']
+        src = normalize_relpath(src_path)
+        dst = normalize_relpath(dst_path)
+
+        if src is None or dst is None:
+            raise ValueError("Invalid path '{}'".format(src_path if src is None else dst_path))
+
+        if dst == src or dst.startswith(src + '/'):
+            raise ValueError("Cannot move or copy '{}' into itself".format(src))
+
+        with self._draft_lock(DID):
+            tree = self._get_draft_tree(draft)
+
+            if not tree.exists(src):
+                return None
+
+            # the destination must not exist, and none of its parents can 
+            # be a file
+            parts = dst.split('/')
+
+            if tree.exists(dst) or any(tree.resolve('/'.join(parts[:i])) is not None 
+                                            for i in range(1, len(parts))):
+                raise Exception("Destination path already exists")
+
+            upper_src = os.path.join(tree.upper, src)
+            upper_dst = os.path.join(tree.upper, dst)
+
+            in_lower = not tree.is_whiteout(src) and any(
+                    os.path.lexists(os.path.join(layer, src)) for layer in tree.layers[1:])
+
+            os.makedirs(os.path.dirname(upper_dst), exist_ok=True)
+
+            with metrics.span('transfer_draft_path'):
+                if not keep_source and not in_lower:
+                    # the path only exists in the draft's own layer
+                    os.rename(upper_src, upper_dst)
+                elif tree.resolve(src) is not None:
+                    self._link_file(tree.resolve(src), upper_dst)
+                else:
+                    files, directories = tree.entries(src)
+
+                    os.makedirs(upper_dst, exist_ok=True)
+
+                    for relpath in sorted(directories):
+                        os.makedirs(os.path.join(upper_dst, relpath[len(src) + 1:]), 
+                                    exist_ok=True)
+
+                    for relpath, path in files.items():
+                        self._link_file(path, os.path.join(upper_dst, relpath[len(src) + 1:]))
+
+            # the fingerprints of the files are rekeyed rather than recomputed
+            server_fps = self._load_draft_fingerprints(DID)
+            overlay = self._load_draft_overlay(DID)
+            new_fps = dict(overlay or {})
+
+            if draft.get('contents') is None:
+                draft['contents'] = []
+
+            entry = find_in_contents(draft['contents'], src)
+
+            for relpath in contents_files([ entry ] if entry is not None else []):
+                file_fps = lookup_file_fingerprints(server_fps, relpath)
+
+                if file_fps is not None:
+                    new_fps[dst + relpath[len(src):]] = file_fps
+
+            if entry is not None:
+                insert_into_contents(draft['contents'], dst, entry)
+
+            if not keep_source:
+                self._remove_draft_path(draft, tree, src, new_fps)
+
+            if overlay is not None or new_fps:
+                self._save_draft_fingerprints(DID, new_fps)
+
+            self.save_draft_record(draft)
+
+        return draft
+
+    def _remove_draft_path(self, draft, tree, relpath, new_fps):
+        """ This function removes ``relpath`` from the data and the 'contents'
+        of ``draft`` and its fingerprints from ``new_fps`` (a copy of the 
+        draft's overlay). It must be called with the draft's lock held.
+        """
+
+        DID = draft['id']
+
+        upper_path = os.path.join(tree.upper, relpath)
+
+        if os.path.lexists(upper_path):
+            self._discard(upper_path, self.default_config['DRAFTS_DATA_FOLDER'])
+
+        # hide the path in the parent version (any whiteouts below it are
+        # now redundant)
+        if not tree.is_whiteout(relpath) and any(
+                os.path.lexists(os.path.join(layer, relpath)) 
+                    for layer in tree.layers[1:]):
+            draft['whiteouts'] = [ w for w in draft.get('whiteouts') or [] 
+                                    if not w.startswith(relpath + '/') ]
+            draft['whiteouts'].append(relpath)
+
+        # the removed files are found in the draft's 'contents' rather
+        # than in its data, which may be large
+        entry = remove_from_contents(draft.get('contents'), relpath)
+        removed = list(contents_files([ entry ] if entry is not None else []))
+
+        base = self._load_draft_base(DID) or {}
+
+        for key in removed:
+            # the fingerprints of the parent version are shared and never 
+            # modified: its removed files are hidden by a tombstone (None)
+            # in the overlay instead
+            if key in base:
+                new_fps[key] = None
+            else:
+                new_fps.pop(key, None)
+
     def load_dataset_record(self, PID):
         """ load a dataset record from the backend """
 
@@ -613,6 +1300,12 @@ class Filesystem:
 
         return record, data_path
 
+    def release_version_data(self, data_path):
+        """ This function is called once the data of a version returned by
+        load_version_record() is no longer used. Nothing needs to be done 
+        here, since the data of versions is never evicted (see ObjectStorage).
+        """
+
     def save_version_record(self, pPID, record):
         """ This function stores the version record ``record`` in the backend,
         associating it to the dataset referenced by ``pPID``.
@@ -634,14 +1327,13 @@ class Filesystem:
 
         src_path = self.config['DATASETS_FOLDER']
 
-        for sd in os.listdir(src_path):
-
-            subdir = os.path.join(src_path, sd)
+        for entry in self._iter_entries(src_path):
 
-            if os.path.isdir(subdir):
-                PID = sd
+            if entry.is_dir():
+                PID = entry.name
 
-                dataset = self.load_dataset_record(PID)
+                dataset = self._read_dataset_from_file(
+                                os.path.join(entry.path, PID + '.json'))
 
                 yield dataset
 
@@ -656,6 +1348,19 @@ class Filesystem:
             version = self._read_version_from_file(f)
             yield version
 
+    def load_version_fingerprints(self, PID, VID):
+        """ This function returns the fingerprints associated to the version
+        identified by ``PID`` and ``VID`` or None if there are none.
+        """
+
+        _, _, fps_path = self._get_version_metadata_paths(PID, VID)
+
+        def contents():
+            version, _ = self.load_version_record(PID, VID)
+            return version.get('contents') if version is not None else None
+
+        return self._load_fingerprints(fps_path, contents)
+
     def remove_fingerprints_from_version(self, PID, VID):
         """ This function removes the fingerprints associated to the version
         identified by ``PID`` and ``VID``.
@@ -663,54 +1368,242 @@ class Filesystem:
         _, _, src_fps_path = self._get_version_metadata_paths(PID, VID)
 
         if self.remove_fps:
-            if self.permanent_remove:
-                self._remove_file(src_fps_path)
-            else:
-                self._move_file(src_fps_path, self.config['TRASH_FOLDER'])
+            self._discard(src_fps_path, os.path.join(
+                        self.default_config['DATASETS_FOLDER'], PID, 'fingerprints'))
 
 
     def transfer_fingerprints_from_draft(self, DID, pPID, VID):
         """ This function retrieves the fingerprints associated to draft ``DID``
         and stores them in the backend, associating it to the dataset version
-        identified by ``<pPID+VID>``.
+        identified by ``<pPID+VID>``. The fingerprints of a draft created from
+        a dataset are its base set plus its overlay, and they are compacted 
+        into a new set for the version (unless the overlay is empty, in which
+        case the base set is shared).
         """
 
         _, _, src_fps_path = self._get_draft_metadata_paths(DID)
+        base_fps_path = self._get_draft_base_fingerprints_path(DID)
         _, _, dst_fps_path = self._get_version_metadata_paths(pPID, VID)
 
-        self._move_file(src_fps_path, dst_fps_path)
+        if not os.path.exists(base_fps_path):
+            if os.path.exists(src_fps_path):
+                self._move_file(src_fps_path, dst_fps_path)
+            return
+
+        overlay = self._load_draft_overlay(DID)
+
+        if overlay:
+            fps = dict(self._load_draft_base(DID))
+            fps.update(overlay)
+
+            # drop the tombstones of the files removed from the draft
+            fps = { k : v for k, v in fps.items() if v is not None }
+
+            with metrics.span('save_fingerprints'), open(dst_fps_path, 'wb') as outfile:
+                _pickle.dump(fps, outfile) 
+        else:
+            self._link_file(base_fps_path, dst_fps_path)
+
+        self._remove_file(base_fps_path)
+
+        if overlay is not None:
+            self._remove_file(src_fps_path)
 
     def transfer_fingerprints_to_draft(self, DID, pPID, VID):
-        """ This function retrieves the fingerprints associated to version 
-        ``<pPID+VID>`` and copies them to the draft ``DID``.
+        """ This function associates the fingerprints of version ``<pPID+VID>``
+        to the draft ``DID``. Version fingerprints are never modified, so the
+        draft shares them as its base set (by means of a hard link, which 
+        keeps them available even if they are removed from the version) and 
+        stores its own changes in an overlay.
         """
 
         _, _, src_fps_path = self._get_version_metadata_paths(pPID, VID)
-        _, _, dst_fps_path = self._get_draft_metadata_paths(DID)
+        base_fps_path = self._get_draft_base_fingerprints_path(DID)
 
-        self._copy_file(src_fps_path, dst_fps_path)
+        if os.path.exists(src_fps_path):
+            os.makedirs(os.path.dirname(base_fps_path), exist_ok=True)
+            self._link_file(src_fps_path, base_fps_path)
 
 
     def transfer_data_from_draft(self, DID, pPID, VID):
         """ This function retrieves all data associated with draft ``DID``
         and stores it in the backend, associating it to the dataset version
-        identified by ``<pPID+VID>``.
+        identified by ``<pPID+VID>``. The draft's own files are moved to the
+        version, while the files of its parent version that were neither 
+        replaced nor removed in the draft are shared by means of hard links.
         """
 
+        draft, _, _ = self.load_draft_record(DID)
+
         src_path = self._get_draft_data_path(DID)
         dst_path = self._get_version_data_path(pPID, VID)
 
+        # compute the contents of the new version before moving anything
+        files, directories = self._get_draft_tree(draft).entries()
+
         self._move_directory(src_path, dst_path)
 
+        with metrics.span('link_parent_files'):
+            for relpath in sorted(directories):
+                os.makedirs(os.path.join(dst_path, relpath), exist_ok=True)
+
+            for relpath, path in files.items():
+                dst_file = os.path.join(dst_path, relpath)
+
+                if not os.path.exists(dst_file):
+                    self._link_file(path, dst_file)
+
     def transfer_data_to_draft(self, DID, pPID, VID):
-        """ This function retrieves all data associated with version 
-        ``<pPID+VID>`` and associates it to the draft ``DID``.
+        """ This function associates all data of version ``<pPID+VID>`` with
+        the draft ``DID``. Nothing is copied: the data of the version is the 
+        lower layer of the draft (see storage.layers), whose own directory 
+        only holds the files added or replaced in it.
         """
 
-        src_path = self._get_version_data_path(pPID, VID)
         dst_path = self._get_draft_data_path(DID)
 
-        self._copy_directory(src_path, dst_path)
+        os.makedirs(dst_path, exist_ok=True)
+
+    def migrate_layout(self, dry_run=False):
+        """ This function moves all the drafts and datasets stored with the
+        flat layout of older versions of the repository to their sharded 
+        location (see _sharded_path()), generating a (src, dst) tuple for
+        each path moved (nothing is moved if ``dry_run`` is True). Each entry
+        is moved with a rename, and the repository can be used while it is 
+        migrated: paths are looked up in both locations until the migration
+        is complete. The entries of a draft are moved while holding its lock,
+        so that its metadata is not rewritten at its old location while it
+        is being moved.
+        """
+
+        folders = [ 
+            (self.config['DATASETS_FOLDER'], lambda name: name, False),
+            (self.config['DRAFTS_DATA_FOLDER'], lambda name: name, True),
+            # a draft's record is moved last, since it is what makes it visible
+            (self.config['DRAFTS_METADATA_FOLDER'], lambda name: name.split('.')[0], True),
+        ]
+
+        for folder, get_key, is_draft in folders:
+            entries = sorted((e.name for e in self._legacy_entries(folder)), 
+                             key=lambda name: name.endswith('.json'))
+
+            for name in entries:
+                src = os.path.join(folder, name)
+                dst = os.path.join(folder, *self._shard(get_key(name)), name)
+
+                if dry_run:
+                    yield src, dst
+                    continue
+
+                if is_draft:
+                    with self._draft_lock(get_key(name)):
+                        moved = self._migrate_entry(src, dst)
+                else:
+                    moved = self._migrate_entry(src, dst)
+
+                if moved:
+                    yield src, dst
+
+        self.legacy_layout = self._has_legacy_entries()
+
+    ############################################################################
+    ##### private functions for the layout of the repository               #####
+    ############################################################################
+
+    @staticmethod
+    def _migrate_entry(src, dst):
+        """ This function moves the entry ``src`` of the flat layout to its
+        sharded location ``dst`` and returns True if it was moved """
+
+        if not os.path.exists(src):
+            # e.g. a draft removed while the repository was migrated
+            return False
+
+        if os.path.exists(dst):
+            if os.path.isdir(dst):
+                return False
+            # the file was written at both locations, the newest one wins
+            if os.stat(src).st_mtime_ns <= os.stat(dst).st_mtime_ns:
+                os.remove(src)
+                return True
+            os.replace(src, dst)
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(src, dst)
+
+        # a request that resolved the old location before the rename may 
+        # have written the file back there
+        if os.path.exists(src) and not os.path.isdir(src):
+            os.replace(src, dst)
+
+        return True
+
+    @classmethod
+    def _shard(cls, key):
+        """ This function returns the names of the subdirectories where the
+        draft or dataset ``key`` is stored """
+
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        return [ digest[2*i:2*i+2] for i in range(cls.SHARD_LEVELS) ]
+
+    @staticmethod
+    def _is_shard(name):
+        return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+    def _sharded_path(self, folder, key, *names):
+        """ This function returns the path of ``names`` (which belong to the
+        draft or dataset ``key``) in the repository ``folder``. Entries are 
+        spread over subdirectories named after the hash of their key (e.g. 
+        datasets/ab/cd/<PID>), so that no directory grows too large, but 
+        those stored by older versions of the repository at the top level of
+        ``folder`` are used while they exist.
+        """
+
+        path = os.path.join(folder, *self._shard(key), *names)
+
+        if self.legacy_layout and not os.path.exists(path):
+            legacy_path = os.path.join(folder, *names)
+
+            if os.path.exists(legacy_path):
+                return legacy_path
+
+        return path
+
+    def _iter_entries(self, folder):
+        """ This function generates the entries (os.DirEntry) for all the 
+        drafts or datasets in the repository ``folder``, in both layouts """
+
+        def scan(path, level):
+            with os.scandir(path) as it:
+                for entry in it:
+                    if level < self.SHARD_LEVELS and self._is_shard(entry.name) \
+                            and entry.is_dir():
+                        yield from scan(entry.path, level + 1)
+                    elif level in (0, self.SHARD_LEVELS):
+                        yield entry
+
+        if os.path.isdir(folder):
+            yield from scan(folder, 0)
+
+    def _legacy_entries(self, folder):
+        """ This function generates the entries stored at the top level of
+        the repository ``folder`` (i.e. with the flat layout) """
+
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not self._is_shard(entry.name) and not entry.name.endswith('.tmp'):
+                    yield entry
+
+    def _has_legacy_entries(self):
+
+        for folder in (self.config['DATASETS_FOLDER'], 
+                       self.config['DRAFTS_DATA_FOLDER'],
+                       self.config['DRAFTS_METADATA_FOLDER']):
+            for _ in self._legacy_entries(folder):
+                return True
+
+        return False
 
     ############################################################################
     ##### private functions for file management                            #####
@@ -721,7 +1614,28 @@ class Filesystem:
         if not overwrite:
             shutil.move(src_filename, dst_filename)
         else:
-            shutil.copy(src_filename, dst_filename)
+            # IMPORTANT: never write into 'dst_filename' since its data may be
+            # shared (hard linked) with other drafts or versions. Replacing
+            # it creates a new inode and leaves the shared one untouched
+            os.replace(src_filename, dst_filename)
+
+    @classmethod
+    def _store_file(cls, src_filename, dst_filename, compression=None, overwrite=False):
+        """ This function moves ``src_filename`` to ``dst_filename``, 
+        compressing it with the ``compression`` codec if required.
+        """
+
+        if not overwrite and os.path.exists(dst_filename):
+            raise shutil.Error("Destination path '{}' already exists".format(dst_filename))
+
+        with metrics.span('store_file'):
+            if compression is not None:
+                compressed_filename = src_filename + ".compressed"
+                compress_file(src_filename, compressed_filename, compression)
+                cls._remove_file(src_filename)
+                src_filename = compressed_filename
+
+            cls._move_file(src_filename, dst_filename, overwrite)
 
     @staticmethod
     def _remove_file(filename):
@@ -739,6 +1653,13 @@ class Filesystem:
     def _copy_file(src_filename, dst_filename):
         shutil.copy(src_filename, dst_filename)
 
+    @staticmethod
+    def _link_file(src_filename, dst_filename):
+        try:
+            os.link(src_filename, dst_filename)
+        except OSError:
+            shutil.copy2(src_filename, dst_filename)
+
     @staticmethod
     def _copy_directory(src_path, dst_path):
 
@@ -752,6 +1673,22 @@ class Filesystem:
 
         shutil.copytree(src_path, dst_path)
 
+    def _discard(self, path, namespace):
+        """ This function removes ``path`` from the repository, either 
+        permanently or by moving it to the TRASH folder under ``namespace``.
+        Permanent removals are also done through the TRASH if the background
+        collector is running, so that large removals do not block requests.
+        """
+
+        if self.permanent_remove and not self.trash.running:
+            if os.path.isdir(path):
+                self._remove_directory(path)
+            else:
+                self._remove_file(path)
+            return
+
+        self.trash.discard(path, namespace, purge=self.permanent_remove)
+
     def _mktemp(self, filename, parent=None):
 
         if parent is None:
@@ -762,92 +1699,73 @@ class Filesystem:
 
         return tmp_filename
 
-    def _unpack_file(self, filename, destination, overwrite):
-
-        if overwrite:
-            # FIXME: for improved security check that no absolute paths or paths with
-            # '..' exist in the compressed file 
-            if(filename.endswith('tar.gz')):
-                tar = tarfile.open(filename, "r:gz")
-                tar.extractall(path=destination)
-                tar.close()
-            elif(filename.endswith('tar.bz2')):
-                tar = tarfile.open(filename, "r:bz")
-                tar.extractall(path=destination)
-                tar.close()
-            elif(filename.endswith('tar')):
-                tar = tarfile.open(filename, "r:")
-                tar.extractall(path=destination)
-                tar.close()
-        else:
-            ### # FIXME: the following code is not working yet
-            ### # uncompress to a temporary directory so that we can check
-            ### # file by file if they can be copied or not
-            ### tmp_dir = tempfile.mkdtemp(dir=self.config['TMP_FOLDER'])
-
-            ### if filename.endswith('tar.gz'):
-            ###     mode = "r:gz"
-            ### elif filename.endswith('tar.bz'):
-            ###     mode = "r:bz"
-            ### elif filename.endswith('tar'):
-            ###     mode = "r:"
+    def _unpack_file(self, filename, destination):
+        """ This function extracts the archive ``filename`` into 
+        ``destination``. Decompression is delegated to the multi-threaded
+        tools available in the system (e.g. pigz, lbzip2, xz, zstd) if 
+        possible.
+        """
 
-            ### if mode is not None:
-            ###     with tarfile.open(filename, mode) as tar:
-            ###         tar.extractall(path=tmp_dir)
+        extract_archive(filename, destination, self.unpack_threads)
 
-            ### for root, dirs, files in os.walk(tmp_dir):
-            ###     for filename in files:
-            ###         subdir = os.path.relpath(root, tmp_dir)
-            ###         relpath = os.path.join(subdir, filename)
+    def _unpack_file_to_draft(self, draft, tmp_filename, tmp_dir, usr_path):
+        """ This function unpacks the archive ``tmp_filename`` into the draft,
+        refusing to overwrite any files that already exist in it.
+        """
 
-            ###         target_path = os.path.join(destination, relpath)
+        DID = draft['id']
+        base_path = self._get_draft_data_path(DID)
+        dst_path = base_path
 
-            ###         print(relpath, '->', target_path, os.path.exists(target_path))
+        if usr_path is not None:
+            dst_path = os.path.join(dst_path, usr_path)
 
-            ###         try:
-            ###             shutil.copy(relpath, target_path)
-            ###         except shutil.Error as e:
-            ###             print(e)
-            ###             conflicts.append(relpath)
+        unpack_dir = tempfile.mkdtemp(dir=tmp_dir)
+        self._unpack_file(tmp_filename, unpack_dir)
 
-            ###         print(relpath)
+        extracted = []
+        for root, dirs, files in os.walk(unpack_dir):
+            for f in files:
+                extracted.append(os.path.relpath(os.path.join(root, f), unpack_dir))
 
+        def check_conflicts(tree):
+            for relpath in extracted:
+                dst_file = os.path.join(dst_path, relpath)
 
-            ### os.rmdir(tmp_dir)
-            pass
+                if tree.exists(os.path.relpath(dst_file, base_path)):
+                    raise Exception("Destination path already exists")
 
-    @staticmethod
-    def _path_to_dict_v2(rootdir):
+        # check for conflicts before doing any work, so that a failed
+        # upload leaves the draft untouched
+        check_conflicts(self._get_draft_tree(draft))
 
-        # inner function to generate subtrees
-        def subtree_to_dict(path):
+        # generate fingerprints for all files (and compress them if required)
+        # XXX this should probably be multithreaded
+        results = []
 
-            relpath = os.path.relpath(path, rootdir)
+        for relpath in extracted:
+            src_file = os.path.join(unpack_dir, relpath)
+            dst_file = os.path.join(dst_path, relpath)
 
-            subtree = OrderedDict([
-                ('name', os.path.basename(path)),
-                ('path', relpath)
-            ])
+            fps, digest = self._compute_fingerprints(src_file, draft.get('chunking'))
 
-            if(os.path.isdir(path)):
-                subtree['type'] = 'directory'
-                subtree['children'] = [ subtree_to_dict(os.path.join(path, dir_entries)) 
-                                            for dir_entries in os.listdir(path) ]
-            else:
-                subtree['type'] = 'file'
+            if draft.get('compression') is not None:
+                compress_file(src_file, src_file + ".compressed", draft['compression'])
+                src_file = src_file + ".compressed"
 
-            return subtree
+            results.append((os.path.relpath(dst_file, base_path), src_file, dst_file, 
+                            fps, digest, None))
 
-        # for later convenience, the first level should just be a list
-        tree = []
-        for entry in sorted(os.listdir(rootdir)):
-            subtree = subtree_to_dict(os.path.join(rootdir, entry))
+        # commit: move all files into place (see add_batch_to_draft())
+        with self._draft_lock(DID):
+            # other uploads may have added the same files meanwhile
+            check_conflicts(self._get_draft_tree(draft))
 
-            tree.append(subtree)
+            undo = self._move_batch_files(results, set(), tmp_dir)
 
-        return tree
+            self._commit_batch_files(draft, results, undo)
 
+        return draft
 
     ############################################################################
     ##### private functions for managing drafts                            #####
@@ -860,11 +1778,35 @@ class Filesystem:
 
         dm_path = self.config['DRAFTS_METADATA_FOLDER']
 
-        record_path = os.path.join(dm_path, DID + ".json")
+        record_path = self._sharded_path(dm_path, DID, DID + ".json")
 
-        fps_path = os.path.join(dm_path, DID + ".fps")
+        fps_path = self._get_draft_metadata_file(DID, record_path, DID + ".fps")
+
+        return os.path.dirname(record_path), record_path, fps_path
+
+    def _get_draft_base_fingerprints_path(self, DID):
+        """This function computes the path to the base fingerprints of the 
+        draft identified by ``DID`` (i.e. those of its parent version).
+        """
 
-        return dm_path, record_path, fps_path
+        _, record_path, _ = self._get_draft_metadata_paths(DID)
+
+        return self._get_draft_metadata_file(DID, record_path, DID + ".base.fps")
+
+    def _get_draft_metadata_file(self, DID, record_path, name):
+        """This function computes the path to the metadata file ``name`` of
+        the draft identified by ``DID``. Metadata files are kept next to the
+        draft's record (at ``record_path``), which may still be in the flat
+        layout, unless they have already been moved to their sharded
+        location (see migrate_layout()).
+        """
+
+        path = self._sharded_path(self.config['DRAFTS_METADATA_FOLDER'], DID, name)
+
+        if os.path.exists(path):
+            return path
+
+        return os.path.join(os.path.dirname(record_path), name)
 
     def _get_draft_data_path(self, DID):
         """This function computes and returns the path for the base directory
@@ -872,26 +1814,34 @@ class Filesystem:
         """ 
 
         dd_path = self.config['DRAFTS_DATA_FOLDER']
-        dd_path = os.path.join(dd_path, DID)
 
-        return dd_path
+        return self._sharded_path(dd_path, DID, DID)
 
-    def _create_draft_record_tree(self, data_dir):
+    def _create_draft_record_tree(self, DID):
         """This function creates the following directory representation of 
         a draft's data and metadata:
 
         <base_location>
         └── drafts
             ├── data
-            │   └── fe5c2d9f
+            │   └── 60
+            │       └── d9
+            │           └── fe5c2d9f
             └── metadata
-                ├── fe5c2d9f.json
-                └── fe5c2d9f.fps
-
+                └── 60
+                    └── d9
+                        ├── fe5c2d9f.json
+                        ├── fe5c2d9f.fps
+                        └── fe5c2d9f.base.fps
 
+        (see _sharded_path())
         """
 
-        os.makedirs(data_dir)
+        os.makedirs(self._get_draft_data_path(DID))
+
+        dm_path, _, _ = self._get_draft_metadata_paths(DID)
+
+        os.makedirs(dm_path, exist_ok=True)
 
     def _read_draft_from_file(self, src_file):
         """This function reads a draft record from the JSON file ``src_file``.
@@ -905,37 +1855,224 @@ class Filesystem:
 
         return record
 
-    def _load_draft_contents(self, DID):
+    def _get_draft_tree(self, draft):
+        """ This function returns a LayeredTree with the data of ``draft``:
+        its own files on top of those of its parent version (if any).
+        """
 
-        dst_path = self._get_draft_data_path(DID)
+        layers = [ self._get_draft_data_path(draft['id']) ]
+
+        if draft.get('parent_version') is not None:
+            layers.append(self._get_version_data_path(draft['PID'], 
+                                                      draft['parent_version']))
 
-        if(not os.path.exists(dst_path)):
+        return LayeredTree(layers, draft.get('whiteouts') or ())
+
+    def _load_draft_contents(self, draft):
+
+        if(not os.path.exists(self._get_draft_data_path(draft['id']))):
             return None
 
-        contents = self._path_to_dict_v2(dst_path)
+        with metrics.span('load_draft_contents'):
+            contents = self._get_draft_tree(draft).to_dict()
 
         return contents
 
+    def _update_draft_contents(self, draft, new_digests):
+        """ This function refreshes the 'contents' of ``draft`` from its data
+        (see _get_draft_tree()). The SHA-256 digests of the files that were 
+        already in the draft are kept, unless they are updated by 
+        ``new_digests``.
+        """
+
+        digests = contents_digests(draft.get('contents'))
+        digests.update(new_digests)
+
+        draft['contents'] = annotate_contents(self._load_draft_contents(draft), digests)
+
     def _load_draft_fingerprints(self, DID):
+        """ This function loads the fingerprints for draft ``DID``, i.e. its
+        base set with the changes in its overlay. Files of the base set that
+        were removed from the draft have None fingerprints in the overlay.
+        NOTE: the returned mapping may be shared with the fingerprints cache 
+        and must not be modified in place (see _merge_fingerprints()).
+        """
 
-        _, _, fps_path = self._get_draft_metadata_paths(DID)
+        overlay = self._load_draft_overlay(DID)
+        base = self._load_draft_base(DID)
+
+        if base is None:
+            return overlay
+
+        if not overlay:
+            return base
+
+        return ChainMap(overlay, base)
+
+    def _load_draft_overlay(self, DID):
+        """ This function loads the fingerprints of the files added to draft
+        ``DID`` since it was created (all of them for drafts not created from
+        a dataset).
+        NOTE: as in _load_draft_fingerprints(), the returned dict must not be
+        modified in place.
+        """
+
+        _, record_path, fps_path = self._get_draft_metadata_paths(DID)
+
+        def contents():
+            draft = self._read_draft_from_file(record_path)
+            return draft.get('contents') if draft is not None else None
+
+        return self._load_fingerprints(fps_path, contents)
+
+    def _load_draft_base(self, DID):
+        """ This function loads the base fingerprints of draft ``DID`` (i.e.
+        those of its parent version, if any).
+        NOTE: as in _load_draft_fingerprints(), the returned dict must not be
+        modified in place.
+        """
+
+        _, record_path, _ = self._get_draft_metadata_paths(DID)
+
+        def contents():
+            draft = self._read_draft_from_file(record_path)
+
+            if draft is None or draft.get('parent_version') is None:
+                return None
+
+            version, _ = self.load_version_record(draft['PID'], draft['parent_version'])
+            return version.get('contents') if version is not None else None
+
+        return self._load_fingerprints(self._get_draft_base_fingerprints_path(DID), contents)
+
+    def _load_fingerprints(self, fps_path, contents=None):
+        """ This function loads the fingerprints stored in ``fps_path`` (if
+        any), using the fingerprints cache. ``contents`` is a function that 
+        returns the 'contents' of the draft or version they belong to, which
+        are used to rekey legacy sets when they are read from disk (see 
+        rekey_legacy_fingerprints()).
+        """
 
         fps = None
 
         if not os.path.exists(fps_path):
             return None
 
-        with open(fps_path, 'rb') as infile:
+        key = self._fps_cache_key(fps_path)
+
+        with self.fps_cache_lock:
+            if key in self.fps_cache:
+                self.fps_cache.move_to_end(key)
+                metrics.CACHE_REQUESTS.inc(cache='fingerprints', result='hit')
+                return self.fps_cache[key]
+
+        metrics.CACHE_REQUESTS.inc(cache='fingerprints', result='miss')
+
+        with metrics.span('load_fingerprints'), open(fps_path, 'rb') as infile:
             fps = _pickle.load(infile) 
 
+        if contents is not None:
+            fps = rekey_legacy_fingerprints(fps, contents_files(contents()))
+
+        self._fps_cache_insert(key, fps)
+
         return fps
 
+    def load_draft_fingerprints(self, DID):
+        """ This function returns the fingerprints associated to the draft
+        identified by ``DID`` or None if there are none.
+        """
+
+        return self._load_draft_fingerprints(DID)
+
+    def open_draft_fingerprints(self, DID):
+        """ This function returns a binary file object with the pickled 
+        fingerprints of the draft identified by ``DID`` (an empty set if 
+        there are none). If they are stored in a single file (with all its
+        keys being paths), it is returned as is.
+        """
+
+        _, _, fps_path = self._get_draft_metadata_paths(DID)
+        base_fps_path = self._get_draft_base_fingerprints_path(DID)
+        paths = [ p for p in (fps_path, base_fps_path) if os.path.exists(p) ]
+
+        fps = self._load_draft_fingerprints(DID) or {}
+
+        if len(paths) == 1 and not isinstance(fps, RekeyedFingerprints):
+            return open(paths[0], 'rb')
+
+        return io.BytesIO(_pickle.dumps({ k : v for k, v in fps.items() 
+                                              if v is not None }))
+
     def _save_draft_fingerprints(self, DID, fps):
 
         _, _, fps_path = self._get_draft_metadata_paths(DID)
 
-        with open(fps_path, 'wb') as outfile:
-            _pickle.dump(fps, outfile) 
+        os.makedirs(os.path.dirname(fps_path), exist_ok=True)
+
+        # the fingerprints are read without holding the draft's lock (e.g. 
+        # by GET /fingerprints), so they are replaced atomically rather than
+        # rewritten in place. This also gives the new file a new inode (see
+        # _fps_cache_key())
+        with metrics.span('save_fingerprints'):
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(fps_path), 
+                                             suffix='.tmp', delete=False) as outfile:
+                _pickle.dump(fps, outfile) 
+
+            os.replace(outfile.name, fps_path)
+
+        self._fps_cache_insert(self._fps_cache_key(fps_path), fps)
+
+    @staticmethod
+    def _fps_cache_key(fps_path):
+        # the fingerprints file is rewritten whenever it changes, so its
+        # inode+mtime+size identifies its contents. Using the inode rather 
+        # than the path lets drafts share the cached sets of their versions
+        st = os.stat(fps_path)
+        return ((st.st_dev, st.st_ino), st.st_mtime_ns, st.st_size)
+
+    @contextmanager
+    def _draft_lock(self, DID):
+        """ This function serializes read-modify-write updates of the 
+        metadata (record and fingerprints) of draft ``DID`` """
+
+        with self.draft_locks_lock:
+            lock = self.draft_locks.setdefault(DID, threading.Lock())
+
+        with lock:
+            yield
+
+    def _fps_cache_insert(self, key, fps):
+
+        if self.fps_cache_size <= 0:
+            return
+
+        with self.fps_cache_lock:
+            # remove stale entries for the same file
+            for k in [k for k in self.fps_cache if k[0] == key[0]]:
+                del self.fps_cache[k]
+
+            self.fps_cache[key] = fps
+
+            while len(self.fps_cache) > self.fps_cache_size:
+                self.fps_cache.popitem(last=False)
+
+    def _compute_fingerprints(self, filepath, chunking=None):
+        """ This function computes the fingerprints of ``filepath`` (using 
+        the ``chunking`` parameters of its dataset) and the digests of its 
+        chunks. It returns the fingerprints and the SHA-256 digest of the 
+        file.
+        """
+
+        start = time.perf_counter()
+
+        with metrics.span('compute_fingerprints'):
+            fps, digest = fingerprint_file(filepath, chunking)
+
+        metrics.FINGERPRINT_SECONDS.inc(time.perf_counter() - start)
+        metrics.FINGERPRINT_BYTES.inc(os.path.getsize(filepath))
+
+        return fps, digest
 
     def _merge_fingerprints(self, old_fps, new_fps):
 
@@ -960,7 +2097,7 @@ class Filesystem:
         metadata JSON record for the dataset identified by ``PID``.
         """ 
 
-        dataset_path = os.path.join(self.config['DATASETS_FOLDER'], PID)
+        dataset_path = self._sharded_path(self.config['DATASETS_FOLDER'], PID, PID)
 
         record_path = os.path.join(dataset_path, PID + '.json')
 
@@ -972,11 +2109,13 @@ class Filesystem:
 
             <base_location>
             └── datasets
-                └── 52e7fb62d0ad4e87
-                    ├── 52e7fb62d0ad4e87.json
-                    └── versions
-                        ├── data
-                        └── metadata
+                └── e4
+                    └── 77
+                        └── 52e7fb62d0ad4e87
+                            ├── 52e7fb62d0ad4e87.json
+                            └── versions
+                                ├── data
+                                └── metadata
         """
 
         if dst_dir is None or dst_file is None:
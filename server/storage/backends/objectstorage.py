@@ -0,0 +1,756 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from storage.backends.filesystem import Filesystem
+from storage.fingerprints import contents_directories
+from storage.objectstore import open_object_store, ConflictError
+from storage import metrics
+
+################################################################################
+##### main class                                                           #####
+################################################################################
+class ObjectStorage(Filesystem):
+    """ This backend keeps the published datasets in an object store (see 
+    storage.objectstore), so that the storage of the repository can grow
+    independently of the nodes serving the API:
+
+        datasets/<PID>.json                 dataset records
+        versions/<PID>/<VID>.json           version records
+        versions/<PID>/<VID>.fps            version fingerprints
+        data/<PID>/<VID>/<relpath>          version data
+
+    Drafts are still kept in the local filesystem of the node where they are
+    created, with the same layout as the Filesystem backend. The local 
+    'datasets' folder is used as a read cache for the (immutable) versions:
+    their records and fingerprints are fetched when they are first used, and
+    their data is fetched as a whole when it is served or a draft is created
+    from them, since drafts are layered over it (see storage.layers). 
+    Version data is evicted from the cache (least recently used first) when 
+    it exceeds ``cache_size`` bytes, unless it is in use (e.g. while it is 
+    streamed, see release_version_data()) or there are drafts based on it.
+    Destroying the repository only removes its local part.
+
+    Dataset records are the only objects that are modified, and they are 
+    always read from the store. When a version is published, its data, 
+    record and fingerprints are uploaded before the dataset record that 
+    points to it, so that other nodes never see incomplete versions. Files
+    inherited unchanged from the parent version are copied within the store
+    rather than uploaded again.
+
+    Since several nodes may publish versions of the same dataset, its record
+    is only uploaded if the version it pointed to is still the parent of the
+    new one, with a conditional write. Otherwise the publication is undone
+    and ConflictError is raised.
+    """
+
+    def __init__(self, base_location, permanent_remove, remove_fingerprints,
+                 object_store, cache_size=None, transfer_threads=8, **kwargs):
+
+        # 'object_store' is either a client or its configuration
+        if isinstance(object_store, dict):
+            object_store = open_object_store(object_store)
+
+        self.store = object_store
+        self.cache_size = cache_size
+        self.transfer_threads = transfer_threads
+
+        # version data in the local cache {path : size}, in LRU order
+        self.data_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+        # version data that must not be evicted: the data in use {path : count}
+        # and the parent versions of drafts {DID : path}, {path : count}
+        self.data_users = Counter()
+        self.draft_parents = {}
+        self.pinned_versions = Counter()
+
+        # per-version locks to fetch each version only once
+        self.fetch_locks = {}
+        self.fetch_locks_lock = threading.Lock()
+
+        # datasets whose record must not be uploaded until the version they
+        # point to is complete
+        self.pending_datasets = set()
+        self.pending_lock = threading.Lock()
+
+        super().__init__(base_location, permanent_remove, remove_fingerprints,
+                         **kwargs)
+
+        self._scan_data_cache()
+        self._scan_draft_parents()
+
+    ############################################################################
+    ##### drafts                                                           #####
+    ############################################################################
+    def save_draft_record(self, draft):
+
+        result = super().save_draft_record(draft)
+
+        if result is not None:
+            self._pin_parent_version(draft)
+
+        return result
+
+    def remove_draft_record(self, DID, remove_data=True):
+
+        super().remove_draft_record(DID, remove_data)
+
+        self._unpin_parent_version(DID)
+
+    ############################################################################
+    ##### datasets                                                         #####
+    ############################################################################
+    def load_dataset_record(self, PID):
+        """ This function fetches the record of dataset ``PID`` from the object
+        store, refreshing its local copy, and returns it (or None).
+        """
+
+        try:
+            data = self.store.get(self._dataset_key(PID))
+        except KeyError:
+            data = None
+
+        with self.pending_lock:
+            # the local copy is newer while a version is being published
+            if PID not in self.pending_datasets:
+                if data is None:
+                    return None
+
+                self._cache_dataset_record(PID, data)
+
+        return super().load_dataset_record(PID)
+
+    def save_dataset_record(self, dataset):
+        """ This function saves the record ``dataset`` locally and uploads it
+        to the object store, once the version it points to has been uploaded
+        (see transfer_fingerprints_from_draft()).
+        """
+
+        PID = dataset['PID']
+
+        with self.pending_lock:
+            super().save_dataset_record(dataset)
+
+            if self.store.size(self._version_key(PID, dataset['current'], '.json')) is None:
+                self.pending_datasets.add(PID)
+                return
+
+        try:
+            self._upload_dataset_record(PID, force=True)
+        except ConflictError:
+            self._restore_dataset_record(PID)
+            raise
+
+    def load_dataset_records(self):
+        """This function generates a list of all dataset records currently 
+        stored in the repository.
+        """
+
+        for key in self.store.list('datasets/'):
+            if key.endswith('.json'):
+                dataset = self.load_dataset_record(key[len('datasets/'):-len('.json')])
+
+                if dataset is not None:
+                    yield dataset
+
+    ############################################################################
+    ##### versions                                                         #####
+    ############################################################################
+    def save_version_record(self, pPID, record):
+        """ This function stores the version record ``record`` locally and in
+        the object store. It raises ConflictError (before anything is stored)
+        if another version of the dataset has been published since the 
+        parent of ``record``.
+        """
+
+        try:
+            self._check_dataset_record(pPID, record['id'], record['parent_version'])
+        except ConflictError:
+            self._restore_dataset_record(pPID)
+            raise
+
+        data_out = super().save_version_record(pPID, record)
+
+        if data_out is not None:
+            _, record_path, _ = self._get_version_metadata_paths(pPID, record['id'])
+            self.store.upload_file(self._version_key(pPID, record['id'], '.json'), 
+                                   record_path)
+
+        return data_out
+
+    def load_version_record(self, pPID, VID, fetch_data=False):
+        """ This function searches for the version record referenced by ``pPID``
+        and ``VID``, fetching it from the object store if it is not in the
+        local cache, and returns it. The data of the version is also fetched
+        if ``fetch_data`` is True, and it is not evicted from the cache until
+        it is released with release_version_data().
+        """
+
+        _, record_path, _ = self._get_version_metadata_paths(pPID, VID)
+
+        if not self._fetch_object(self._version_key(pPID, VID, '.json'), record_path):
+            return None, None
+
+        record = self._read_version_from_file(record_path)
+
+        data_path = None
+
+        if fetch_data:
+            data_path = self._fetch_version_data(pPID, VID, record, acquire=True)
+
+        return record, data_path
+
+    def release_version_data(self, data_path):
+        """ This function releases the version data at ``data_path`` returned
+        by load_version_record(), which can be evicted from then on (i.e. 
+        the next time the cache is full).
+        """
+
+        if data_path is None:
+            return
+
+        with self.cache_lock:
+            self.data_users[data_path] -= 1
+
+            if self.data_users[data_path] <= 0:
+                del self.data_users[data_path]
+
+    def load_version_records(self, PID):
+        """This function generates a list of all version records currently 
+        stored in the repository for the dataset identified by ``PID``.
+        """
+
+        prefix = self._version_key(PID, '', '')
+
+        for key in self.store.list(prefix):
+            if key.endswith('.json'):
+                version, _ = self.load_version_record(PID, key[len(prefix):-len('.json')])
+
+                if version is not None:
+                    yield version
+
+    def load_version_fingerprints(self, PID, VID):
+
+        _, _, fps_path = self._get_version_metadata_paths(PID, VID)
+
+        self._fetch_object(self._version_key(PID, VID, '.fps'), fps_path)
+
+        return super().load_version_fingerprints(PID, VID)
+
+    def remove_fingerprints_from_version(self, PID, VID):
+
+        if not self.remove_fps:
+            return
+
+        _, _, fps_path = self._get_version_metadata_paths(PID, VID)
+
+        if os.path.exists(fps_path):
+            super().remove_fingerprints_from_version(PID, VID)
+
+        self.store.delete(self._version_key(PID, VID, '.fps'))
+
+    def transfer_fingerprints_from_draft(self, DID, pPID, VID):
+        """ This function stores the fingerprints of draft ``DID`` as those of
+        version ``<pPID+VID>`` (see Filesystem) and uploads them. This is the
+        last step of the publication of a version, so the dataset record that
+        points to it is uploaded too (or the publication is undone, if 
+        another version of the dataset was published meanwhile).
+        """
+
+        super().transfer_fingerprints_from_draft(DID, pPID, VID)
+
+        _, _, fps_path = self._get_version_metadata_paths(pPID, VID)
+
+        if os.path.exists(fps_path):
+            self.store.upload_file(self._version_key(pPID, VID, '.fps'), fps_path)
+
+        try:
+            self._upload_dataset_record(pPID)
+        except ConflictError:
+            self._abort_publication(DID, pPID, VID)
+            raise
+
+    def transfer_fingerprints_to_draft(self, DID, pPID, VID):
+
+        _, _, fps_path = self._get_version_metadata_paths(pPID, VID)
+
+        self._fetch_object(self._version_key(pPID, VID, '.fps'), fps_path)
+
+        super().transfer_fingerprints_to_draft(DID, pPID, VID)
+
+    def transfer_data_from_draft(self, DID, pPID, VID):
+        """ This function moves the data of draft ``DID`` to version 
+        ``<pPID+VID>`` (see Filesystem), which remains in the local cache, 
+        and uploads it to the object store.
+        """
+
+        draft, _, _ = self.load_draft_record(DID)
+
+        files, _ = self._get_draft_tree(draft).entries()
+
+        parent_path = None
+
+        if draft.get('parent_version') is not None:
+            parent_path = self._get_version_data_path(draft['PID'], 
+                                                      draft['parent_version'])
+
+        super().transfer_data_from_draft(DID, pPID, VID)
+
+        dst_path = self._get_version_data_path(pPID, VID)
+        uploads = []
+        copies = []
+
+        for relpath, path in files.items():
+            key = self._data_key(pPID, VID, relpath)
+
+            if parent_path is not None and path.startswith(parent_path + os.sep):
+                parent_relpath = os.path.relpath(path, parent_path).replace(os.sep, '/')
+                copies.append((self._data_key(draft['PID'], draft['parent_version'], 
+                                              parent_relpath), key))
+            else:
+                uploads.append((key, os.path.join(dst_path, relpath)))
+
+        with metrics.span('upload_version_data'):
+            self._run_transfers(self.store.upload_file, uploads)
+            self._run_transfers(self.store.copy, copies)
+
+        self._cache_touch(dst_path)
+
+    def transfer_data_to_draft(self, DID, pPID, VID):
+        """ This function associates all data of version ``<pPID+VID>`` with
+        the draft ``DID`` (see Filesystem), fetching it from the object store
+        if it is not in the local cache.
+        """
+
+        self._fetch_version_data(pPID, VID)
+
+        super().transfer_data_to_draft(DID, pPID, VID)
+
+    ############################################################################
+    ##### private functions for the object store                           #####
+    ############################################################################
+    @staticmethod
+    def _dataset_key(PID):
+        return 'datasets/' + PID + '.json'
+
+    @staticmethod
+    def _version_key(PID, VID, ext):
+        return 'versions/' + PID + '/' + VID + ext
+
+    @staticmethod
+    def _data_key(PID, VID, relpath=''):
+        return 'data/' + PID + '/' + VID + '/' + relpath
+
+    def _run_transfers(self, function, items):
+        """ This function calls ``function(*item)`` for each of the ``items``
+        concurrently (the parts of each object are transferred concurrently
+        too, see storage.objectstore).
+        """
+
+        if len(items) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=max(1, self.transfer_threads)) as pool:
+            function = metrics.bind_spans(function)
+
+            for f in [ pool.submit(function, *item) for item in items ]:
+                f.result()
+
+    def _mkstemp(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.config['TMP_FOLDER'], suffix='.fetch')
+        os.close(fd)
+        return tmp_path
+
+    def _fetch_object(self, key, dst_file):
+        """ This function downloads the object ``key`` into ``dst_file``, 
+        unless it has already been downloaded, and returns False if there is
+        no such object. Only immutable objects can be cached this way.
+        """
+
+        if os.path.exists(dst_file):
+            return True
+
+        tmp_path = self._mkstemp()
+
+        try:
+            self.store.download_file(key, tmp_path)
+        except KeyError:
+            self._remove_file(tmp_path)
+            return False
+
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        self._move_file(tmp_path, dst_file, overwrite=True)
+
+        return True
+
+    def _cache_dataset_record(self, PID, data):
+        """ This function stores ``data`` as the local copy of the record of
+        dataset ``PID``, along with the structure of the dataset (see 
+        _create_dataset_record_tree()).
+        """
+
+        dst_dir, dst_file = self._get_dataset_paths(PID)
+
+        for prefix in ('VERSIONS_METADATA_PREFIX', 'VERSIONS_DATA_PREFIX'):
+            os.makedirs(os.path.join(dst_dir, self.config[prefix]), exist_ok=True)
+
+        tmp_path = self._mkstemp()
+
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(data)
+
+        self._move_file(tmp_path, dst_file, overwrite=True)
+
+    def _check_dataset_record(self, PID, VID, parent_version):
+        """ This function checks that the current version of dataset ``PID``
+        in the object store is still ``parent_version`` (or already ``VID``),
+        i.e. that version ``VID`` can be published, and returns the ETag of
+        its record (None if the dataset does not exist). It raises 
+        ConflictError otherwise.
+        """
+
+        try:
+            data, etag = self.store.get_with_etag(self._dataset_key(PID))
+        except KeyError:
+            data, etag = None, None
+
+        current = json.loads(data.decode())['current'] if data is not None else None
+
+        if current not in (parent_version, VID):
+            raise ConflictError(self._dataset_key(PID))
+
+        return etag
+
+    def _upload_dataset_record(self, PID, force=False):
+        """ This function uploads the local copy of the record of dataset 
+        ``PID`` if it was pending (or if ``force`` is True). The record is 
+        only replaced if no other node published a version of the dataset 
+        since the parent of its current one, otherwise ConflictError is 
+        raised.
+        """
+
+        with self.pending_lock:
+            if not force and PID not in self.pending_datasets:
+                return
+
+            _, record_path = self._get_dataset_paths(PID)
+            dataset = self._read_dataset_from_file(record_path)
+            version, _ = self.load_version_record(PID, dataset['current'])
+
+            etag = self._check_dataset_record(PID, dataset['current'], 
+                                              version['parent_version'])
+
+            with open(record_path, 'rb') as infile:
+                self.store.put_if_match(self._dataset_key(PID), infile.read(), etag)
+
+            self.pending_datasets.discard(PID)
+
+    def _restore_dataset_record(self, PID):
+        """ This function replaces the local copy of the record of dataset
+        ``PID`` with the one in the object store, discarding its pending 
+        changes.
+        """
+
+        with self.pending_lock:
+            self.pending_datasets.discard(PID)
+
+            try:
+                data = self.store.get(self._dataset_key(PID))
+            except KeyError:
+                data = None
+
+            if data is not None:
+                self._cache_dataset_record(PID, data)
+            else:
+                _, record_path = self._get_dataset_paths(PID)
+
+                if os.path.exists(record_path):
+                    self._remove_file(record_path)
+
+    def _abort_publication(self, DID, pPID, VID):
+        """ This function undoes the publication of draft ``DID`` as version
+        ``<pPID+VID>`` when the record of its dataset could not be updated: 
+        the data and fingerprints of the version are returned to the draft,
+        and the version is removed from the local cache and the store.
+        """
+
+        data_path = self._get_version_data_path(pPID, VID)
+        _, record_path, fps_path = self._get_version_metadata_paths(pPID, VID)
+        _, _, draft_fps_path = self._get_draft_metadata_paths(DID)
+
+        with self.cache_lock:
+            self.data_cache.pop(data_path, None)
+
+        # (the files linked from the parent version become files of the 
+        # draft itself, which does not change its contents)
+        if os.path.isdir(data_path):
+            self._move_directory(data_path, self._get_draft_data_path(DID))
+
+        # (the complete set of the version, so no base set is needed)
+        if os.path.exists(fps_path):
+            os.makedirs(os.path.dirname(draft_fps_path), exist_ok=True)
+            self._move_file(fps_path, draft_fps_path, overwrite=True)
+
+        if os.path.exists(record_path):
+            self._remove_file(record_path)
+
+        keys = [ self._version_key(pPID, VID, '.json'), 
+                 self._version_key(pPID, VID, '.fps') ]
+        keys.extend(self.store.list(self._data_key(pPID, VID)))
+
+        self._run_transfers(self.store.delete, [ (key,) for key in keys ])
+
+        self._restore_dataset_record(pPID)
+
+    @contextmanager
+    def _fetch_lock(self, data_path):
+
+        with self.fetch_locks_lock:
+            lock = self.fetch_locks.setdefault(data_path, threading.Lock())
+
+        with lock:
+            yield
+
+    def _fetch_version_data(self, pPID, VID, record=None, acquire=False):
+        """ This function returns the path to the data of version 
+        ``<pPID+VID>`` in the local cache, fetching it from the object store
+        if needed. If ``acquire`` is True, the data is in use until it is 
+        released (see release_version_data()).
+        """
+
+        data_path = self._get_version_data_path(pPID, VID)
+        acquired = False
+
+        # (in use from now on, so that it is not evicted once it is found)
+        with self.cache_lock:
+            self.data_users[data_path] += 1
+
+        try:
+            if not self._download_version_data(pPID, VID, data_path, record):
+                return None
+
+            self._cache_touch(data_path)
+            acquired = acquire
+        finally:
+            if not acquired:
+                self.release_version_data(data_path)
+
+        return data_path
+
+    def _download_version_data(self, pPID, VID, data_path, record=None):
+        """ This function fetches the data of version ``<pPID+VID>`` into 
+        ``data_path`` unless it is already there, and returns False if the 
+        version does not exist. The data is fetched into a temporary 
+        directory which is then renamed, so that incomplete versions are 
+        never served.
+        """
+
+        with self._fetch_lock(data_path):
+            if not os.path.isdir(data_path):
+                if record is None:
+                    record, _ = self.load_version_record(pPID, VID)
+
+                if record is None:
+                    return False
+
+                tmp_path = tempfile.mkdtemp(dir=self.config['TMP_FOLDER'], suffix='.fetch')
+
+                try:
+                    prefix = self._data_key(pPID, VID)
+                    downloads = []
+
+                    for key in self.store.list(prefix):
+                        dst_file = os.path.join(tmp_path, *key[len(prefix):].split('/'))
+                        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+                        downloads.append((key, dst_file))
+
+                    # (directories are not stored, empty ones must be created)
+                    for relpath in contents_directories((record or {}).get('contents')):
+                        os.makedirs(os.path.join(tmp_path, relpath), exist_ok=True)
+
+                    with metrics.span('fetch_version_data'):
+                        self._run_transfers(self.store.download_file, downloads)
+
+                    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+                    self._move_directory(tmp_path, data_path)
+                except Exception:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    raise
+
+        return True
+
+    ############################################################################
+    ##### private functions for the local cache                            #####
+    ############################################################################
+    def _scan_data_cache(self):
+        """ This function adds the version data found in the local cache when
+        the repository is opened to the LRU list (oldest first) """
+
+        if self.cache_size is None:
+            return
+
+        found = []
+
+        for entry in self._iter_entries(self.config['DATASETS_FOLDER']):
+            vd_path = os.path.join(entry.path, self.config['VERSIONS_DATA_PREFIX'])
+
+            if not os.path.isdir(vd_path):
+                continue
+
+            for VID in os.listdir(vd_path):
+                data_path = os.path.join(vd_path, VID)
+                found.append((os.stat(data_path).st_mtime, data_path))
+
+        for _, data_path in sorted(found):
+            self.data_cache[data_path] = self._tree_size(data_path)
+
+    def _scan_draft_parents(self):
+        """ This function pins the parent versions of the drafts found when 
+        the repository is opened (see _pin_parent_version()) """
+
+        if self.cache_size is None:
+            return
+
+        for draft in self.load_draft_records():
+            if draft is not None:
+                self._pin_parent_version(draft)
+
+    def _pin_parent_version(self, draft):
+        """ This function prevents the parent version of ``draft`` from being
+        evicted, since its data is the lower layer of the draft """
+
+        if self.cache_size is None or draft.get('parent_version') is None:
+            return
+
+        with self.cache_lock:
+            if draft['id'] in self.draft_parents:
+                return
+
+            path = self._get_version_data_path(draft['PID'], draft['parent_version'])
+
+            self.draft_parents[draft['id']] = path
+            self.pinned_versions[path] += 1
+
+    def _unpin_parent_version(self, DID):
+
+        with self.cache_lock:
+            path = self.draft_parents.pop(DID, None)
+
+            if path is None:
+                return
+
+            self.pinned_versions[path] -= 1
+
+            if self.pinned_versions[path] <= 0:
+                del self.pinned_versions[path]
+
+    @staticmethod
+    def _tree_size(path):
+        # (files shared by several versions are counted once per version)
+        size = 0
+
+        for root, _, files in os.walk(path):
+            for name in files:
+                size += os.lstat(os.path.join(root, name)).st_size
+
+        return size
+
+    def _cache_touch(self, data_path):
+        """ This function marks the version data at ``data_path`` as the most
+        recently used and evicts the least recently used versions if the 
+        cache is full """
+
+        if self.cache_size is None:
+            return
+
+        with self.cache_lock:
+            cached = data_path in self.data_cache
+
+            if cached:
+                self.data_cache.move_to_end(data_path)
+
+        # (the lock is shared by all the requests, so neither the size of new
+        # versions nor the removal of evicted ones are done while holding it)
+        if not cached:
+            size = self._tree_size(data_path)
+
+            with self.cache_lock:
+                self.data_cache[data_path] = size
+
+        evicted = []
+
+        with self.cache_lock:
+            total = sum(self.data_cache.values())
+
+            # versions in use are never evicted, and neither are the parent 
+            # versions of drafts (see _pin_parent_version())
+            for path in list(self.data_cache):
+                if total <= self.cache_size:
+                    break
+
+                if path == data_path or path in self.data_users or \
+                   path in self.pinned_versions:
+                    continue
+
+                size = self.data_cache.pop(path)
+                total -= size
+                evicted.append((path, size))
+
+        for path, size in evicted:
+            self._evict(path, size)
+
+    def _evict(self, path, size):
+        """ This function removes the version data at ``path`` evicted from
+        the cache, unless it has been fetched again since it was evicted """
+
+        # (fetches of the version wait until it is removed, see 
+        # _download_version_data())
+        with self._fetch_lock(path):
+            with self.cache_lock:
+                if path in self.data_cache:
+                    return
+
+                if path in self.data_users or path in self.pinned_versions:
+                    self.data_cache[path] = size
+                    return
+
+            if not os.path.exists(path):
+                return
+
+            if self.trash.running:
+                self.trash.discard(path, 'cache', purge=True)
+            else:
+                self._remove_directory(path)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+import json
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import rabin as librp
+
+from storage import fastcdc
+from storage.fingerprints import add_chunk_digests
+
+################################################################################
+##### chunking parameters                                                  #####
+################################################################################
+#
+# Files are split into content-defined chunks by one of the chunkers below
+# (pyrabin by default). The parameters of the chunker (the chunking 'profile'
+# of a dataset) can be tuned: small chunks improve deduplication of small 
+# edits but inflate the fingerprints (and the time needed to compare them), 
+# while large chunks do the opposite. A profile is a dict with some of the 
+# following parameters (missing ones keep the chunker's defaults):
+#
+#   { 'algorithm' : 'fastcdc', 'min_block_size' : 2048, 
+#     'average_block_size' : 8192, 'max_block_size' : 65536 }
+#
+# The profile is stored with the dataset, so the algorithm that produced its
+# fingerprints is always known: datasets without an 'algorithm' (including 
+# all those created before it could be chosen) use Rabin fingerprints.
+
+DEFAULT_ALGORITHM = 'rabin'
+
+class RabinChunker:
+    """ Rabin fingerprints computed by pyrabin.
+
+    pyrabin keeps its parameters as global state, so fingerprints for 
+    non-default profiles are computed in worker processes configured for 
+    them: the parameters used by the server process itself are never changed.
+    """
+
+    name = 'rabin'
+    parameters = ('window_size', 'min_block_size', 'average_block_size', 
+                  'max_block_size')
+
+    def validate(self, params):
+        for name in params:
+            if not hasattr(librp, 'set_' + name):
+                raise ValueError("The installed pyrabin does not support "
+                                 "setting '{}'".format(name))
+
+    def get_file_fingerprints(self, filepath, params):
+        if not params:
+            return librp.get_file_fingerprints(filepath)
+
+        return _get_pool(params).submit(librp.get_file_fingerprints, 
+                                        filepath).result()
+
+    def fingerprint_file(self, filepath, params):
+        # XXX pyrabin only fingerprints whole files, so the chunks need to
+        # be read again to compute their digests (the file should still be
+        # in the page cache at this point)
+        return add_chunk_digests(filepath, 
+                                 self.get_file_fingerprints(filepath, params))
+
+class FastCDCChunker:
+    """ FastCDC (gear hash) chunking, see storage.fastcdc """
+
+    name = 'fastcdc'
+    parameters = ('min_block_size', 'average_block_size', 'max_block_size')
+
+    def validate(self, params):
+        fastcdc.validate_parameters(params)
+
+    def get_file_fingerprints(self, filepath, params):
+        return self.fingerprint_file(filepath, params)[0]
+
+    def fingerprint_file(self, filepath, params):
+        return fastcdc.fingerprint_file(filepath, params)
+
+_chunkers = {
+    RabinChunker.name : RabinChunker(),
+    FastCDCChunker.name : FastCDCChunker(),
+}
+
+CHUNKING_PARAMETERS = ('algorithm',) + RabinChunker.parameters
+
+def _split(params):
+    """ split ``params`` into the chunker and its own parameters """
+
+    params = dict(params or {})
+    return _chunkers[params.pop('algorithm', DEFAULT_ALGORITHM)], params
+
+def validate_chunking(params):
+    """ This function checks the chunking parameters ``params`` and returns
+    them in canonical form (None for the defaults). Raises ValueError if they
+    are not valid.
+    """
+
+    if not params:
+        return None
+
+    if not isinstance(params, dict):
+        raise ValueError("Chunking parameters must be a dict")
+
+    algorithm = params.get('algorithm', DEFAULT_ALGORITHM)
+
+    if algorithm not in _chunkers:
+        raise ValueError("Unknown chunking algorithm '{}'".format(algorithm))
+
+    chunker = _chunkers[algorithm]
+    canonical = {}
+
+    for name, value in params.items():
+        if name == 'algorithm':
+            continue
+
+        if name not in chunker.parameters:
+            raise ValueError("Unknown {} chunking parameter "
+                             "'{}'".format(algorithm, name))
+
+        if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+            raise ValueError("Chunking parameter '{}' must be a positive "
+                             "integer".format(name))
+
+        canonical[name] = value
+
+    sizes = [ canonical[n] for n in ('min_block_size', 'average_block_size', 
+                                     'max_block_size') if n in canonical ]
+
+    if sizes != sorted(sizes):
+        raise ValueError("Chunk sizes must satisfy min <= average <= max")
+
+    chunker.validate(canonical)
+
+    # the default algorithm is implied, so that the parameters of existing
+    # datasets keep their canonical form
+    if algorithm != DEFAULT_ALGORITHM:
+        canonical['algorithm'] = algorithm
+
+    return canonical or None
+
+def chunking_key(params):
+    """ This function returns a string that identifies the chunking 
+    parameters ``params`` (e.g. to use as a cache key) """
+
+    if not params:
+        return 'default'
+
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+def _configure_worker(params):
+    for name, value in params.items():
+        getattr(librp, 'set_' + name)(value)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# forking a multithreaded server is unsafe: start workers from a clean process
+try:
+    _mp_context = multiprocessing.get_context('forkserver')
+except ValueError:
+    _mp_context = multiprocessing.get_context('spawn')
+
+def _get_pool(params):
+    key = chunking_key(params)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ProcessPoolExecutor(max_workers=os.cpu_count(), 
+                                              mp_context=_mp_context,
+                                              initializer=_configure_worker,
+                                              initargs=(params,))
+        return _pools[key]
+
+def get_file_fingerprints(filepath, params=None):
+    """ This function computes the fingerprints of ``filepath`` using the 
+    chunking parameters ``params`` (Rabin fingerprints with pyrabin's 
+    defaults if None). Depending on the algorithm, fingerprints may already
+    include the digests of the chunks.
+    """
+
+    chunker, params = _split(params)
+    return chunker.get_file_fingerprints(filepath, params)
+
+def fingerprint_file(filepath, params=None):
+    """ This function computes the fingerprints of ``filepath`` using the 
+    chunking parameters ``params``, including the digests of its chunks. It
+    returns the fingerprints and the SHA-256 (hex) digest of the file.
+    """
+
+    chunker, params = _split(params)
+    return chunker.fingerprint_file(filepath, params)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+import io
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+################################################################################
+##### block-compressed storage format                                      #####
+################################################################################
+#
+# Files stored with compression enabled are split into fixed-size blocks that
+# are compressed independently, so that any range of the original contents
+# can be read by decompressing only the blocks that overlap it:
+#
+#   +--------+----------+----------+-----+----------+-------+--------+
+#   | header | block 0  | block 1  | ... | block N  | index | footer |
+#   +--------+----------+----------+-----+----------+-------+--------+
+#
+#   header: MAGIC, format version, codec id, block size
+#   index:  compressed size of each block
+#   footer: offset of the index, number of blocks, original size, MAGIC
+#
+
+MAGIC = b'DDRZ'
+FORMAT_VERSION = 1
+DEFAULT_BLOCK_SIZE = 1024*1024
+
+_header = struct.Struct('<4sBBI')
+_footer = struct.Struct('<QQQ4s')
+_index_entry = struct.Struct('<I')
+
+class ZlibCodec:
+
+    id = 1
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class ZstdCodec:
+
+    id = 2
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise Exception("zstd compression requires the 'zstandard' module")
+
+        self.level = level
+        self.cctx = zstandard.ZstdCompressor(level=level)
+        self.dctx = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.cctx.compress(data)
+
+    def decompress(self, data):
+        return self.dctx.decompress(data)
+
+_codecs = {
+    ZlibCodec.name : ZlibCodec,
+    ZstdCodec.name : ZstdCodec,
+}
+
+_codecs_by_id = { c.id : c for c in _codecs.values() }
+
+def available_codecs():
+    """ This function returns the names of the compression codecs that can
+    be used in this system.
+    """
+
+    names = [ZlibCodec.name]
+
+    if zstandard is not None:
+        names.append(ZstdCodec.name)
+
+    return names
+
+def get_codec(name):
+    if name not in _codecs:
+        raise Exception("Unknown compression codec '{}'".format(name))
+
+    return _codecs[name]()
+
+def is_compressed(filename):
+    """ check if ``filename`` was stored using the block-compressed format """
+
+    with open(filename, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            return False
+
+        # raw files may start with MAGIC by chance, check the footer too
+        if os.fstat(infile.fileno()).st_size < _header.size + _footer.size:
+            return False
+
+        infile.seek(-len(MAGIC), os.SEEK_END)
+        return infile.read(len(MAGIC)) == MAGIC
+
+def is_stored_compressed(filename, compression):
+    """ check if ``filename``, which belongs to a draft or dataset whose
+    files are stored with the ``compression`` codec (None if they are stored
+    as is), must be decompressed when it is read. The format is only 
+    checked for compressed drafts and datasets, since the raw files of other
+    datasets may look like compressed ones.
+    """
+
+    return compression is not None and is_compressed(filename)
+
+def compress_file(src_filename, dst_filename, codec_name, 
+                  block_size=DEFAULT_BLOCK_SIZE):
+    """ This function stores the contents of ``src_filename`` into 
+    ``dst_filename`` using the block-compressed format and the compression
+    codec ``codec_name``.
+    """
+
+    codec = get_codec(codec_name)
+
+    index = []
+    original_size = 0
+
+    with open(src_filename, "rb") as infile, open(dst_filename, "wb") as outfile:
+        outfile.write(_header.pack(MAGIC, FORMAT_VERSION, codec.id, block_size))
+
+        while True:
+            data = infile.read(block_size)
+
+            if not data:
+                break
+
+            cdata = codec.compress(data)
+            outfile.write(cdata)
+
+            index.append(len(cdata))
+            original_size += len(data)
+
+        index_offset = outfile.tell()
+
+        for size in index:
+            outfile.write(_index_entry.pack(size))
+
+        outfile.write(_footer.pack(index_offset, len(index), original_size, MAGIC))
+
+class CompressedFile(io.RawIOBase):
+    """ A read-only, seekable file object that decompresses on the fly the 
+    blocks of a file stored using the block-compressed format.
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, "rb")
+
+        magic, version, codec_id, self.block_size = \
+                _header.unpack(self.fh.read(_header.size))
+
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.fh.close()
+            raise Exception("'{}' is not a compressed file".format(filename))
+
+        self.codec = _codecs_by_id[codec_id]()
+
+        self.fh.seek(-_footer.size, os.SEEK_END)
+        index_offset, nblocks, self.size, _ = \
+                _footer.unpack(self.fh.read(_footer.size))
+
+        self.fh.seek(index_offset)
+        raw_index = self.fh.read(nblocks * _index_entry.size)
+
+        # compute the offset of each block in the compressed file
+        self.blocks = []
+        offset = _header.size
+        for (csize,) in _index_entry.iter_unpack(raw_index):
+            self.blocks.append((offset, csize))
+            offset += csize
+
+        self.position = 0
+        self.cached_block = (None, None)
+
+    def close(self):
+        if not self.closed:
+            self.fh.close()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.position = offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        elif whence == os.SEEK_END:
+            self.position = self.size + offset
+
+        return self.position
+
+    def _read_block(self, n):
+        if self.cached_block[0] != n:
+            offset, csize = self.blocks[n]
+            self.fh.seek(offset)
+            self.cached_block = (n, self.codec.decompress(self.fh.read(csize)))
+
+        return self.cached_block[1]
+
+    def read(self, amount=-1):
+        if amount is None or amount < 0:
+            amount = self.size - self.position
+
+        amount = max(0, min(amount, self.size - self.position))
+
+        parts = []
+        while amount > 0:
+            n, block_offset = divmod(self.position, self.block_size)
+            data = self._read_block(n)[block_offset:block_offset + amount]
+
+            parts.append(data)
+            self.position += len(data)
+            amount -= len(data)
+
+        return b''.join(parts)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+def open_stored_file(filename, compression=None):
+    """ This function opens ``filename`` for reading, transparently 
+    decompressing its contents if it was stored compressed (see 
+    is_stored_compressed()).
+    """
+
+    if is_stored_compressed(filename, compression):
+        return CompressedFile(filename)
+
+    return open(filename, "rb")
+
+def stored_file_size(filename, compression=None):
+    """ This function returns the original (i.e. uncompressed) size of 
+    ``filename`` (see is_stored_compressed()).
+    """
+
+    if is_stored_compressed(filename, compression):
+        with CompressedFile(filename) as infile:
+            return infile.size
+
+    return os.path.getsize(filename)
+
+def iter_stored_file(filename, compression=None, chunk_size=DEFAULT_BLOCK_SIZE):
+    """ This function generates the (uncompressed) contents of ``filename``
+    in chunks of ``chunk_size`` bytes (see is_stored_compressed()).
+    """
+
+    with open_stored_file(filename, compression) as infile:
+        while True:
+            data = infile.read(chunk_size)
+
+            if not data:
+                break
+
+            yield data
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+
+""" FastCDC content-defined chunking.
+
+Chunk boundaries are found with a 'gear' rolling hash, which only needs a 
+shift and an addition (and a table lookup) per byte:
+
+    h = (h << 1) + GEAR[byte]     (mod 2**32)
+
+Bit k of ``h`` depends on the last k+1 bytes only, so the hash is a function 
+of a 32-byte window. A position is a candidate boundary when the top bits of
+the hash are zero. Following FastCDC, chunks are 'normalized': boundaries
+need more zero bits (MASK_S) before the average chunk size and fewer (MASK_L)
+after it, which narrows the distribution of chunk sizes around the average,
+and the first ``min_block_size`` bytes of a chunk are never cut.
+
+Since h_i = sum(GEAR[b_(i-k)] << k for k < 32), the hash of every position of
+a block can be computed at once with NumPy by doubling the number of terms in
+5 vectorized steps. Without NumPy, the hash is rolled byte by byte (same 
+boundaries, much slower).
+
+Chunks are identified by their SHA-256 digest, which is computed while 
+chunking: the 'hash' of a chunk is the first 8 bytes of its digest.
+"""
+
+import hashlib
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_PARAMETERS = {
+    'min_block_size' : 2048,
+    'average_block_size' : 8192,
+    'max_block_size' : 65536,
+}
+
+WINDOW_SIZE = 32
+
+# size of the reads (and of the blocks hashed at once)
+READ_SIZE = 64*1024
+
+GEAR = tuple(int.from_bytes(hashlib.sha256(b'ddreplay-gear' + bytes([i])).digest()[:4], 
+                            'little') for i in range(256))
+
+if np is not None:
+    _gear_table = np.array(GEAR, dtype=np.uint32)
+
+def validate_parameters(params):
+    """ This function checks the FastCDC parameters ``params``. Raises 
+    ValueError if they are not valid.
+    """
+
+    p = dict(DEFAULT_PARAMETERS, **params)
+
+    if p['min_block_size'] < WINDOW_SIZE:
+        raise ValueError("FastCDC chunks must be at least {} bytes "
+                         "long".format(WINDOW_SIZE))
+
+    if not 256 <= p['average_block_size'] <= 2**30:
+        raise ValueError("The average FastCDC chunk size must be between 256 "
+                         "bytes and 1GiB")
+
+    if not p['min_block_size'] <= p['average_block_size'] <= p['max_block_size']:
+        raise ValueError("Chunk sizes must satisfy min <= average <= max")
+
+def _masks(average):
+    bits = average.bit_length() - 1
+    strict = ((1 << (bits + 2)) - 1) << (32 - bits - 2)
+    loose = ((1 << (bits - 2)) - 1) << (32 - bits + 2)
+    return strict, loose
+
+class _GearScanner:
+    """ Finds the candidate boundaries of a stream, fed block by block """
+
+    def __init__(self, average):
+        self.strict_mask, self.loose_mask = _masks(average)
+        self.tail = b''         # last bytes of the previous block
+        self.h = 0
+        self.buffers = None
+
+    def scan(self, block, offset):
+        """ returns the end offsets of the candidate chunks that end in 
+        ``block`` (which starts at ``offset``), for each mask """
+
+        if np is None:
+            return self._scan_python(block, offset)
+
+        return self._scan_numpy(block, offset)
+
+    def _scan_numpy(self, block, offset):
+        t = len(self.tail)
+        n = t + len(block)
+
+        if self.buffers is None or len(self.buffers[0]) < n:
+            self.buffers = (np.empty(n, dtype=np.uint8), np.empty(n, dtype=np.uint32),
+                            np.empty(n, dtype=np.uint32))
+
+        data, h, tmp = (b[:n] for b in self.buffers)
+        data[:t] = np.frombuffer(self.tail, dtype=np.uint8)
+        data[t:] = np.frombuffer(block, dtype=np.uint8)
+        np.take(_gear_table, data, out=h)
+
+        s = 1
+        while s < WINDOW_SIZE and s < n:
+            np.left_shift(h[:n-s], s, out=tmp[:n-s])
+            np.add(h[s:], tmp[:n-s], out=h[s:])
+            s *= 2
+
+        self.tail = data[-(WINDOW_SIZE - 1):].tobytes()
+
+        # strict candidates are also loose candidates (MASK_L is a subset of 
+        # MASK_S), and there are few of them
+        np.bitwise_and(h[t:], self.loose_mask, out=tmp[t:])
+        loose = np.flatnonzero(tmp[t:] == 0)
+        strict = loose[(h[t:][loose] & self.strict_mask) == 0]
+
+        ends = offset + 1
+
+        return (strict + ends).tolist(), (loose + ends).tolist()
+
+    def _scan_python(self, block, offset):
+        strict, loose = [], []
+        strict_mask, loose_mask = self.strict_mask, self.loose_mask
+        h = self.h
+
+        for i, b in enumerate(block, offset + 1):
+            h = ((h << 1) + GEAR[b]) & 0xFFFFFFFF
+
+            if not h & loose_mask:
+                loose.append(i)
+
+                if not h & strict_mask:
+                    strict.append(i)
+
+        self.h = h
+
+        return strict, loose
+
+def iter_chunks(infile, params=None):
+    """ This function splits the contents of the binary file object 
+    ``infile`` into chunks. It yields (offset, data) for each chunk.
+    """
+
+    p = dict(DEFAULT_PARAMETERS, **(params or {}))
+    min_size = p['min_block_size']
+    avg_size = p['average_block_size']
+    max_size = p['max_block_size']
+
+    scanner = _GearScanner(avg_size)
+    strict, loose = [], []
+    buf = bytearray()
+    buf_offset = 0
+    scanned = 0
+    eof = False
+    start = 0
+
+    while True:
+        # make sure that all the possible ends of the chunk have been scanned
+        while not eof and scanned < start + max_size:
+            block = infile.read(READ_SIZE)
+
+            if not block:
+                eof = True
+                break
+
+            s, l = scanner.scan(block, scanned)
+            strict.extend(s)
+            loose.extend(l)
+            buf += block
+            scanned += len(block)
+
+        if start == scanned:
+            return
+
+        limit = min(start + max_size, scanned)
+        end = limit
+
+        i = bisect_left(strict, start + min_size)
+
+        if i < len(strict) and strict[i] <= min(start + avg_size, limit):
+            end = strict[i]
+        else:
+            i = bisect_right(loose, start + avg_size)
+
+            if i < len(loose) and loose[i] <= limit:
+                end = loose[i]
+
+        yield start, buf[start - buf_offset:end - buf_offset]
+
+        del buf[:end - buf_offset]
+        del strict[:bisect_right(strict, end)]
+        del loose[:bisect_right(loose, end)]
+        buf_offset = start = end
+
+def fingerprint_file(filepath, params=None):
+    """ This function splits ``filepath`` into chunks and returns their
+    fingerprints (offset, size, hash, digest), along with the SHA-256 (hex)
+    digest of the whole file. The file is only read once.
+    """
+
+    file_hash = hashlib.sha256()
+    fps = []
+
+    with open(filepath, 'rb') as infile:
+        for offset, data in iter_chunks(infile, params):
+            file_hash.update(data)
+            digest = hashlib.sha256(data).digest()
+            fps.append((offset, len(data), int.from_bytes(digest[:8], 'little'), digest))
+
+    return fps, file_hash.hexdigest()
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+""" Helper functions to work with the Rabin fingerprints of stored files.
+
+The fingerprints of a file are a list of (offset, size, hash[, digest]) 
+tuples, one per content-defined chunk. Since the Rabin hashes are only 64 bits
+long, chunks also carry the SHA-256 ``digest`` of their contents, which is 
+what identifies them when both sides know it (fingerprints computed by older
+clients and servers may lack it).
+
+Comparing the fingerprints of large files (millions of chunks) is done with
+NumPy arrays when NumPy is available.
+"""
+
+import struct
+import hashlib
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_entry = struct.Struct('<QQ')
+
+def fingerprints_digest(fps):
+    """ This function returns a (hex) digest that summarizes the fingerprints
+    ``fps`` of a file. Two files have the same digest if they are made of the
+    same chunks, which allows clients to verify a downloaded file by 
+    computing its fingerprints, without transferring them.
+    """
+
+    h = hashlib.sha256()
+
+    for fp in fps:
+        h.update(_entry.pack(fp[1], fp[2] & 0xFFFFFFFFFFFFFFFF))
+
+    return h.hexdigest()
+
+def lookup_file_fingerprints(fps, relpath):
+    """ This function returns the fingerprints for the file at ``relpath`` 
+    from the fingerprints ``fps`` of a draft or version (or None). They are
+    keyed by the path of the file (see rekey_legacy_fingerprints() for the
+    sets stored by older versions of the repository).
+    """
+
+    if fps is None:
+        return None
+
+    return fps.get(relpath)
+
+class RekeyedFingerprints(dict):
+    """ The fingerprints of a legacy set, rekeyed by the path of its files 
+    (see rekey_legacy_fingerprints()). They are pickled as a plain dict. """
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+def rekey_legacy_fingerprints(fps, paths):
+    """ This function rekeys the fingerprints ``fps`` of a draft or version 
+    whose files are at ``paths``. Older versions of the repository keyed the
+    files created by a single upload by their name only: such a name is 
+    replaced by the path of the only file with that name that has no 
+    fingerprints of its own (ambiguous names are left as they are). It 
+    returns ``fps`` itself if no key needs to be changed.
+    """
+
+    paths = set(paths)
+    names = [ k for k in fps if '/' not in k and k not in paths ]
+
+    if len(names) == 0:
+        return fps
+
+    candidates = {}
+    for path in paths:
+        if '/' in path and path not in fps:
+            candidates.setdefault(path.rsplit('/', 1)[-1], []).append(path)
+
+    names = [ n for n in names if len(candidates.get(n, ())) == 1 ]
+
+    if len(names) == 0:
+        return fps
+
+    rekeyed = RekeyedFingerprints(fps)
+
+    for name in names:
+        rekeyed[candidates[name][0]] = rekeyed.pop(name)
+
+    return rekeyed
+
+def chunk_digest(data):
+    """ This function returns the strong (SHA-256) digest of a chunk """
+
+    return hashlib.sha256(data).digest()
+
+def add_chunk_digests(filepath, fps):
+    """ This function reads ``filepath`` sequentially and returns its 
+    fingerprints ``fps`` extended with the digest of each chunk, along with
+    the SHA-256 (hex) digest of the whole file.
+    """
+
+    file_hash = hashlib.sha256()
+    strong_fps = []
+
+    with open(filepath, 'rb') as infile:
+        for fp in fps:
+            data = infile.read(fp[1])
+            file_hash.update(data)
+            strong_fps.append((fp[0], fp[1], fp[2], chunk_digest(data)))
+
+    return strong_fps, file_hash.hexdigest()
+
+def same_chunk(fp, other):
+    """ This function checks if the fingerprints ``fp`` and ``other`` refer
+    to the same chunk. Digests are compared whenever both are known, so that
+    colliding Rabin hashes are not taken as duplicates.
+    """
+
+    if fp[1] != other[1] or fp[2] != other[2]:
+        return False
+
+    if len(fp) < 4 or len(other) < 4:
+        return True
+
+    return fp[3] == other[3]
+
+def contents_digests(contents):
+    """ This function returns a dict with the SHA-256 digests of the files 
+    described by the ``contents`` tree of a draft or version, keyed by their
+    path.
+    """
+
+    digests = {}
+
+    for entry in contents or []:
+        if entry.get('type') == 'directory':
+            digests.update(contents_digests(entry.get('children')))
+        elif entry.get('sha256') is not None:
+            digests[entry['path']] = entry['sha256']
+
+    return digests
+
+def annotate_contents(contents, digests):
+    """ This function sets the 'sha256' field of all the file entries in the
+    ``contents`` tree whose digest is known """
+
+    for entry in contents or []:
+        if entry.get('type') == 'directory':
+            annotate_contents(entry.get('children'), digests)
+        elif entry['path'] in digests:
+            entry['sha256'] = digests[entry['path']]
+
+    return contents
+
+def contents_files(contents):
+    """ This function generates the paths of all the files in the 
+    ``contents`` tree of a draft or version """
+
+    for entry in contents or []:
+        if entry.get('type') == 'directory':
+            yield from contents_files(entry.get('children'))
+        else:
+            yield entry['path']
+
+def contents_directories(contents):
+    """ This function generates the paths of all the directories in the 
+    ``contents`` tree of a draft or version """
+
+    for entry in contents or []:
+        if entry.get('type') == 'directory':
+            yield entry['path']
+            yield from contents_directories(entry.get('children'))
+
+def _locate_in_contents(contents, relpath):
+    """ This function returns the list of entries of the ``contents`` tree
+    that should hold ``relpath`` and its index in it (or None) """
+
+    parts = relpath.split('/')
+
+    for name in parts[:-1]:
+        for entry in contents or []:
+            if entry.get('name') == name and entry.get('type') == 'directory':
+                contents = entry.setdefault('children', [])
+                break
+        else:
+            return None, None
+
+    for i, entry in enumerate(contents or []):
+        if entry.get('name') == parts[-1]:
+            return contents, i
+
+    return contents, None
+
+def find_in_contents(contents, relpath):
+    """ This function returns the entry for ``relpath`` in the ``contents``
+    tree (or None) """
+
+    siblings, i = _locate_in_contents(contents, relpath)
+
+    return siblings[i] if i is not None else None
+
+def remove_from_contents(contents, relpath):
+    """ This function removes the entry for ``relpath`` (a file or a whole
+    directory) from the ``contents`` tree in place and returns it (or None
+    if there is no such entry).
+    """
+
+    siblings, i = _locate_in_contents(contents, relpath)
+
+    return siblings.pop(i) if i is not None else None
+
+def insert_into_contents(contents, relpath, entry):
+    """ This function inserts a copy of the ``contents`` entry ``entry`` 
+    (a file or a whole directory, usually found at another path) at 
+    ``relpath`` in the ``contents`` tree, creating its parent directories if
+    needed. The paths of the entry and its children are updated.
+    """
+
+    def rebase(entry, path):
+        new_entry = OrderedDict(entry)
+        new_entry['name'] = path.rsplit('/', 1)[-1]
+        new_entry['path'] = path
+
+        if entry.get('type') == 'directory':
+            new_entry['children'] = [ rebase(c, path + '/' + c['name']) 
+                                        for c in entry.get('children') or [] ]
+        return new_entry
+
+    parts = relpath.split('/')
+
+    for depth, name in enumerate(parts[:-1]):
+        for parent in contents:
+            if parent.get('name') == name:
+                break
+        else:
+            parent = OrderedDict([
+                ('name', name),
+                ('path', '/'.join(parts[:depth + 1])),
+                ('type', 'directory'),
+                ('children', [])
+            ])
+            contents.append(parent)
+            contents.sort(key=lambda e: e['name'])
+
+        contents = parent.setdefault('children', [])
+
+    contents.append(rebase(entry, relpath))
+    contents.sort(key=lambda e: e['name'])
+
+FINGERPRINT_DTYPE = [
+    ('offset', '<u8'),
+    ('size', '<u8'),
+    ('hash', '<u8'),
+    ('digest', 'S32'),
+]
+
+def fingerprints_array(fps):
+    """ This function converts the fingerprints ``fps`` into a structured 
+    NumPy array. Chunks without a digest get an empty one.
+    """
+
+    try:
+        if all(len(fp) == 4 for fp in fps):
+            return np.array(fps, dtype=FINGERPRINT_DTYPE)
+
+        return np.array([ (fp[0], fp[1], fp[2], fp[3] if len(fp) > 3 else b'') 
+                            for fp in fps ], dtype=FINGERPRINT_DTYPE)
+    except OverflowError:
+        # negative Rabin hashes
+        return np.array([ (fp[0], fp[1], fp[2] & 0xFFFFFFFFFFFFFFFF, 
+                           fp[3] if len(fp) > 3 else b'') 
+                            for fp in fps ], dtype=FINGERPRINT_DTYPE)
+
+def match_chunks(fps, other_fps):
+    """ This function finds, for each chunk in ``fps``, a chunk in 
+    ``other_fps`` with the same contents (see same_chunk). It returns a 
+    list (or array) with the index of the matching chunk in ``other_fps`` 
+    for each chunk, or -1 if there is none.
+    """
+
+    if np is not None:
+        return _match_chunks_vectorized(fps, other_fps)
+
+    candidates = {}
+    for j, fp in enumerate(other_fps):
+        candidates.setdefault(fp[2], []).append(j)
+
+    return [ next((j for j in candidates.get(fp[2], ()) 
+                    if same_chunk(fp, other_fps[j])), -1) for fp in fps ]
+
+def _match_chunks_vectorized(fps, other_fps, new=None, old=None):
+    """ This function implements match_chunks with a sorted search over the
+    Rabin hashes of ``other_fps``. Only the chunks whose first candidate 
+    doesn't match (i.e. actual hash collisions) are checked one by one.
+    ``new`` and ``old`` can be provided if the arrays for ``fps`` and 
+    ``other_fps`` have already been built.
+    """
+
+    matches = np.full(len(fps), -1, dtype=np.int64)
+
+    if len(fps) == 0 or len(other_fps) == 0:
+        return matches
+
+    new = fingerprints_array(fps) if new is None else new
+    old = fingerprints_array(other_fps) if old is None else old
+
+    order = np.argsort(old['hash'], kind='stable')
+    sorted_hashes = old['hash'][order]
+
+    # searching for sorted keys is much faster (cache friendly)
+    new_order = np.argsort(new['hash'], kind='stable')
+    first = np.empty(len(new), dtype=np.int64)
+    first[new_order] = np.searchsorted(sorted_hashes, new['hash'][new_order])
+    first = np.minimum(first, len(old) - 1)
+    same_hash = sorted_hashes[first] == new['hash']
+
+    candidate = order[first]
+    found = same_hash & (old['size'][candidate] == new['size'])
+
+    both_digests = (new['digest'] != b'') & (old['digest'][candidate] != b'')
+    found &= ~both_digests | (old['digest'][candidate] == new['digest'])
+
+    matches[found] = candidate[found]
+
+    # other chunks with the same hash may still match
+    for i in np.flatnonzero(same_hash & ~found):
+        last = np.searchsorted(sorted_hashes, new['hash'][i], side='right')
+
+        for j in order[first[i]+1:last]:
+            if same_chunk(fps[i], other_fps[j]):
+                matches[i] = j
+                break
+
+    return matches
+
+def plan_rebuild(new_fps, old_fps):
+    """ This function computes how to rebuild a file described by 
+    ``new_fps`` from a file described by ``old_fps`` and the chunks that are
+    not in it. It returns a list of (first, last, old_offset) runs of 
+    consecutive chunks ``new_fps[first:last]`` that can be copied from 
+    ``old_offset`` in the old file, or that must be provided separately 
+    (``old_offset`` is None, one run per chunk).
+    """
+
+    if len(new_fps) == 0 or len(old_fps) == 0:
+        return [ (i, i + 1, None) for i in range(len(new_fps)) ]
+
+    if np is not None:
+        new = fingerprints_array(new_fps)
+        old = fingerprints_array(old_fps)
+
+        matches = _match_chunks_vectorized(new_fps, old_fps, new, old)
+        matched = matches >= 0
+
+        sizes = new['size'].astype(np.int64)
+        old_offsets = old['offset'].astype(np.int64)
+        src_offsets = np.where(matched, old_offsets[np.maximum(matches, 0)], -1)
+
+        # a run continues if both chunks are matched and contiguous in the 
+        # old file
+        continues = matched[1:] & matched[:-1] & \
+                    (src_offsets[1:] == src_offsets[:-1] + sizes[:-1])
+
+        starts = np.flatnonzero(np.concatenate(([True], ~continues))).tolist()
+        ends = starts[1:] + [len(new_fps)]
+
+        return [ (first, last, int(src_offsets[first]) if matched[first] else None)
+                    for first, last in zip(starts, ends) ]
+
+    matches = match_chunks(new_fps, old_fps)
+    runs = []
+
+    for i, j in enumerate(matches):
+        if j < 0:
+            runs.append((i, i + 1, None))
+        elif len(runs) > 0 and runs[-1][2] is not None and \
+            old_fps[j][0] == old_fps[matches[i-1]][0] + old_fps[matches[i-1]][1]:
+            runs[-1] = (runs[-1][0], i + 1, runs[-1][2])
+        else:
+            runs.append((i, i + 1, old_fps[j][0]))
+
+    return runs
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+
+################################################################################
+##### garbage collection                                                   #####
+################################################################################
+#
+# Data files are shared between drafts and versions by means of hard links,
+# which means that the filesystem keeps a reference count for each of them
+# (i.e. st_nlink) and that removing a draft or a version never affects the 
+# data of others. What the repository needs to care about is data that is no
+# longer referenced by any draft or version record (e.g. left behind by an
+# interrupted upload or publish), which is found with a mark-and-sweep pass
+# over the repository records, and reporting how much space can actually be
+# reclaimed, which is only the size of those files whose links are *all* 
+# garbage.
+#
+
+def reclaimable_bytes(paths):
+    """ This function computes how many bytes would be freed if all files
+    and directories in ``paths`` were removed, taking into account that some
+    of their files may be hard links shared with live data.
+    """
+
+    # (st_dev, st_ino) -> [st_nlink, st_size, links found]
+    inodes = {}
+
+    def account(filepath):
+        try:
+            st = os.lstat(filepath)
+        except OSError:
+            return
+
+        key = (st.st_dev, st.st_ino)
+
+        if key not in inodes:
+            inodes[key] = [st.st_nlink, st.st_size, 0]
+
+        inodes[key][2] += 1
+
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    account(os.path.join(root, f))
+        else:
+            account(path)
+
+    return sum(size for nlink, size, found in inodes.values() if found >= nlink)
+
+class GarbageCollector:
+    """ This class finds data in the repository that is not referenced by 
+    any draft or version and hands it to the trash to be removed in the 
+    background. Collection is incremental: each call to ``collect()`` 
+    processes at most ``max_entries`` candidates, and the actual removal
+    is done by the (throttled) trash collector.
+    """
+
+    def __init__(self, backend, grace_period=3600):
+        self.backend = backend
+
+        # data younger than this (in seconds) is never considered garbage,
+        # since it may belong to an operation still in progress
+        self.grace_period = grace_period
+
+    def collect(self, dry_run=True, max_entries=None):
+        """ This function runs a garbage collection pass and returns a report
+        with the garbage found and the bytes that can be reclaimed. If
+        ``dry_run`` is True nothing is removed.
+        """
+
+        entries = []
+        paths = []
+
+        for path, namespace, reason in self.backend.find_garbage(self.grace_period):
+
+            if max_entries is not None and len(entries) >= max_entries:
+                break
+
+            entries.append({
+                'path' : os.path.relpath(path, self.backend.base_location),
+                'reason' : reason,
+                'reclaimable_bytes' : reclaimable_bytes([path])
+            })
+            paths.append((path, namespace))
+
+        # data already in the trash will also be reclaimed eventually
+        trash_stats = self.backend.get_trash_stats()
+
+        report = {
+            'dry_run' : dry_run,
+            'garbage' : entries,
+            'reclaimable_bytes' : reclaimable_bytes([p for p, _ in paths]),
+            'trash_pending_bytes' : trash_stats['pending_bytes'],
+        }
+
+        if not dry_run:
+            for path, namespace in paths:
+                self.backend.discard(path, namespace, purge=True)
+
+        return report
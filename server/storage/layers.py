@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+
+""" Layered views of directory trees.
+
+Drafts created from a dataset do not copy (or link) the data of the version
+they are based on. Instead, the data directory of a draft is a sparse 
+'overlay' with the files added or replaced in the draft, which is stacked on
+top of the (immutable) data of its parent version:
+
+    draft overlay      a.txt'          c.txt
+    parent version     a.txt   b.txt           d/e.txt   
+
+    draft              a.txt'  b.txt   c.txt   d/e.txt
+
+Files removed from a draft are recorded as 'whiteouts', i.e. paths (of files
+or directories) that hide the contents of the lower layers. A LayeredTree 
+resolves paths through the layers of a draft (a version is a tree with a 
+single layer).
+"""
+
+import os
+from collections import OrderedDict
+
+def normalize_relpath(relpath):
+    """ This function normalizes the path ``relpath`` of a file in a tree
+    ('/'-separated and relative to its root). Returns None if the path is
+    not valid (e.g. it is absolute or escapes the tree).
+    """
+
+    if relpath is None or relpath.startswith('/') or '\\' in relpath:
+        return None
+
+    parts = [ p for p in relpath.split('/') if p not in ('', '.') ]
+
+    if not parts or '..' in parts:
+        return None
+
+    return '/'.join(parts)
+
+class LayeredTree:
+    """ A read-only view of the directory trees ``layers`` (from top to 
+    bottom) where the paths in ``whiteouts`` hide all layers except the 
+    topmost one """
+
+    def __init__(self, layers, whiteouts=()):
+        self.layers = [ l for l in layers if l is not None ]
+        self.whiteouts = set(whiteouts)
+
+    @property
+    def upper(self):
+        return self.layers[0]
+
+    def is_whiteout(self, relpath):
+        """ This function checks if ``relpath`` (or any of its parent 
+        directories) is hidden in the lower layers """
+
+        if not self.whiteouts:
+            return False
+
+        parts = relpath.split('/')
+
+        return any('/'.join(parts[:i]) in self.whiteouts 
+                        for i in range(1, len(parts) + 1))
+
+    def _candidates(self, relpath):
+        yield os.path.join(self.upper, relpath)
+
+        if self.is_whiteout(relpath):
+            return
+
+        for layer in self.layers[1:]:
+            yield os.path.join(layer, relpath)
+
+    def resolve(self, relpath):
+        """ This function returns the path of the file at ``relpath`` in the
+        topmost layer that has it, or None if there is no such file """
+
+        relpath = normalize_relpath(relpath)
+
+        if relpath is None:
+            return None
+
+        for path in self._candidates(relpath):
+            if os.path.isfile(path):
+                return path
+
+        return None
+
+    def exists(self, relpath):
+        """ This function checks if there is a file or a directory at 
+        ``relpath`` """
+
+        relpath = normalize_relpath(relpath)
+
+        if relpath is None:
+            return False
+
+        return any(os.path.exists(path) for path in self._candidates(relpath))
+
+    def entries(self, top=None):
+        """ This function returns an OrderedDict {relpath : path} with all 
+        the files in the tree (sorted by relpath) and the set of the relpaths
+        of its directories. If ``top`` is given, only the subtree under that
+        directory is returned.
+        """
+
+        files = {}
+        directories = set()
+
+        for i, layer in enumerate(self.layers):
+            start = layer if top is None else os.path.join(layer, top)
+
+            if not os.path.isdir(start) or (i > 0 and top is not None and 
+                                            self.is_whiteout(top)):
+                continue
+
+            for root, dirs, filenames in os.walk(start):
+                relroot = os.path.relpath(root, layer).replace(os.sep, '/')
+                relroot = '' if relroot == '.' else relroot + '/'
+
+                # directories hidden by a whiteout or by a file in an upper
+                # layer are skipped
+                dirs[:] = [ d for d in dirs if relroot + d not in files and 
+                                not (i > 0 and self.is_whiteout(relroot + d)) ]
+
+                directories.update(relroot + d for d in dirs)
+
+                for f in filenames:
+                    relpath = relroot + f
+
+                    if relpath in files or relpath in directories:
+                        continue
+
+                    if i > 0 and self.is_whiteout(relpath):
+                        continue
+
+                    files[relpath] = os.path.join(root, f)
+
+        return OrderedDict(sorted(files.items())), directories
+
+    def walk(self):
+        """ This function generates (relpath, path) for all the files in the
+        tree """
+
+        files, _ = self.entries()
+
+        return iter(files.items())
+
+    def to_dict(self):
+        """ This function returns the contents of the tree in the format of
+        the 'contents' of drafts and versions """
+
+        files, directories = self.entries()
+        root = OrderedDict()
+
+        def node(relpath, kind):
+            parent = root
+
+            for name in relpath.split('/')[:-1]:
+                parent = parent.setdefault(name, OrderedDict())
+
+            if kind == 'directory':
+                parent.setdefault(relpath.rsplit('/', 1)[-1], OrderedDict())
+            else:
+                parent[relpath.rsplit('/', 1)[-1]] = None
+
+        for relpath in sorted(directories):
+            node(relpath, 'directory')
+
+        for relpath in files:
+            node(relpath, 'file')
+
+        def subtree_to_dict(name, children, prefix):
+            subtree = OrderedDict([
+                ('name', name),
+                ('path', prefix + name)
+            ])
+
+            if children is None:
+                subtree['type'] = 'file'
+            else:
+                subtree['type'] = 'directory'
+                subtree['children'] = [ subtree_to_dict(n, c, prefix + name + '/')
+                                            for n, c in sorted(children.items()) ]
+
+            return subtree
+
+        return [ subtree_to_dict(n, c, '') for n, c in sorted(root.items()) ]
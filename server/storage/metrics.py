@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import threading
+import time
+import math
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+################################################################################
+##### minimal Prometheus-style metrics                                     #####
+################################################################################
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 
+                   10.0, 30.0, 60.0, 300.0)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+
+    if len(pairs) == 0:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                     .replace('"', '\\"')
+                                                     .replace('\n', '\\n'))
+                          for k, v in pairs) + '}'
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Expected labels {} for metric '{}'".format(
+                             self.labelnames, self.name))
+        return tuple(labels[l] for l in self.labelnames)
+
+    def expose(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type)
+        ]
+
+        with self.lock:
+            lines.extend(self._samples())
+
+        return lines
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [ '{}{} {}'.format(self.name, _format_labels(self.labelnames, k), 
+                                  _format_value(v))
+                 for k, v in sorted(self.values.items()) ]
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            counts, _, _ = entry = self.values[key]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        lines = []
+
+        for key, (counts, count, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append('{}_bucket{} {}'.format(self.name, 
+                    _format_labels(self.labelnames, key, [('le', _format_value(bound))]),
+                    cumulative))
+
+            labels = _format_labels(self.labelnames, key)
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+
+        return lines
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def register_collector(self, collector):
+        """ register a function that will be called right before metrics 
+        are exposed (e.g. to update gauges) """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def expose(self):
+        """ This function generates the text exposition format of all metrics
+        registered.
+        """
+
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = [self.metrics[k] for k in sorted(self.metrics)]
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception:
+                pass
+
+        lines = []
+        for m in metrics:
+            lines.extend(m.expose())
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+################################################################################
+##### metrics for storage operations                                       #####
+################################################################################
+
+FINGERPRINT_BYTES = counter('ddreplay_fingerprint_bytes_total',
+        'Bytes processed when computing fingerprints')
+FINGERPRINT_SECONDS = counter('ddreplay_fingerprint_seconds_total',
+        'Time spent computing fingerprints')
+UPLOAD_FILE_BYTES = counter('ddreplay_upload_file_bytes_total',
+        'Size of the files uploaded or replaced', ['mode'])
+UPLOAD_TRANSFERRED_BYTES = counter('ddreplay_upload_transferred_bytes_total',
+        'Bytes actually transferred by clients to upload or replace files', ['mode'])
+UPLOAD_DEDUP_RATIO = histogram('ddreplay_upload_dedup_ratio',
+        'Fraction of each replaced file that did not need to be transferred',
+        buckets=(0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0))
+REBUILD_SECONDS = histogram('ddreplay_rebuild_duration_seconds',
+        'Time spent rebuilding files from deltas')
+CACHE_REQUESTS = counter('ddreplay_cache_requests_total',
+        'Cache lookups', ['cache', 'result'])
+PHASE_SECONDS = histogram('ddreplay_storage_phase_duration_seconds',
+        'Time spent in each phase of storage operations', ['phase'])
+
+################################################################################
+##### timing spans                                                         #####
+################################################################################
+
+_local = threading.local()
+
+@contextmanager
+def span(phase):
+    """ This context manager measures the time spent in ``phase``, logs it,
+    and records it in the current thread's span list if span recording has 
+    been enabled with ``start_recording_spans()``.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+
+        PHASE_SECONDS.observe(elapsed, phase=phase)
+        logger.debug("%s: %.6f s", phase, elapsed)
+
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((phase, elapsed))
+
+def start_recording_spans():
+    _local.spans = []
+
+def stop_recording_spans():
+    spans = getattr(_local, 'spans', None)
+    _local.spans = None
+    return spans or []
+
+def bind_spans(function):
+    """ This function returns a wrapper of ``function`` that records its spans
+    in the span list of the calling thread (if any), so that the spans of 
+    the work done by worker threads on its behalf (e.g. in a 
+    ThreadPoolExecutor) are not lost.
+    """
+
+    spans = getattr(_local, 'spans', None)
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'spans', None)
+        _local.spans = spans
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.spans = previous
+
+    return wrapper
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+""" Clients for the object stores where the ObjectStorage backend keeps the
+published datasets (see storage.backends.objectstorage).
+
+Objects are transferred in parts of ``part_size`` bytes by up to ``threads``
+concurrent requests: large files are uploaded with multipart uploads and 
+downloaded with ranged GETs. Subclasses only implement the basic operations
+of the store:
+
+  - S3ObjectStore: any S3-compatible store (AWS S3, MinIO, Ceph RGW...). 
+    It requires the 'boto3' module.
+  - LocalObjectStore: a stand-in that keeps the objects as files in a local 
+    directory, for development and testing.
+
+Objects that are modified (i.e. dataset records) are updated with 
+conditional writes, which fail with ConflictError if the object changed 
+since it was read.
+"""
+
+import os
+import fcntl
+import shutil
+import hashlib
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+DEFAULT_PART_SIZE = 8*1024*1024
+
+class ConflictError(Exception):
+    """ raised when an object was modified concurrently """
+
+class ObjectStore:
+
+    def __init__(self, part_size=DEFAULT_PART_SIZE, threads=8):
+        self.part_size = part_size
+        self.threads = threads
+
+    ############################################################################
+    ##### basic operations (implemented by subclasses)                     #####
+    ############################################################################
+    def size(self, key):
+        """ This function returns the size of the object ``key`` or None if 
+        it does not exist """
+        raise NotImplementedError
+
+    def get(self, key, start=0, end=None):
+        """ This function returns the bytes [start, end) of the object 
+        ``key``. It raises KeyError if the object does not exist. """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def get_with_etag(self, key):
+        """ This function returns the contents of the object ``key`` and its
+        ETag. It raises KeyError if the object does not exist. """
+        raise NotImplementedError
+
+    def put_if_match(self, key, data, etag):
+        """ This function stores ``data`` as the object ``key`` only if its 
+        ETag is still ``etag`` (or, if ``etag`` is None, only if it does not
+        exist). It raises ConflictError otherwise. """
+        raise NotImplementedError
+
+    def copy(self, src_key, dst_key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ This function removes the object ``key`` (if it exists) """
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """ This function generates the keys of all the objects whose key 
+        starts with ``prefix`` """
+        raise NotImplementedError
+
+    def create_multipart_upload(self, key):
+        raise NotImplementedError
+
+    def upload_part(self, key, upload_id, number, data):
+        """ This function uploads ``data`` as part ``number`` (starting at 1)
+        of the multipart upload ``upload_id`` and returns its ETag """
+        raise NotImplementedError
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        raise NotImplementedError
+
+    def abort_multipart_upload(self, key, upload_id):
+        raise NotImplementedError
+
+    ############################################################################
+    ##### file transfers                                                   #####
+    ############################################################################
+    def _ranges(self, size):
+        return [ (start, min(start + self.part_size, size)) 
+                    for start in range(0, size, self.part_size) ]
+
+    def upload_file(self, key, filename):
+        """ This function stores the contents of ``filename`` as the object 
+        ``key``. Files larger than ``part_size`` are uploaded by parts, 
+        concurrently, and the object only appears in the store once all of
+        them have been uploaded.
+        """
+
+        size = os.path.getsize(filename)
+
+        if size <= self.part_size:
+            with open(filename, 'rb') as infile:
+                self.put(key, infile.read())
+            return
+
+        upload_id = self.create_multipart_upload(key)
+
+        def upload(number, start, end):
+            with open(filename, 'rb') as infile:
+                infile.seek(start)
+                return self.upload_part(key, upload_id, number, infile.read(end - start))
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.threads)) as pool:
+                futures = [ pool.submit(upload, number, start, end) 
+                                for number, (start, end) in 
+                                    enumerate(self._ranges(size), start=1) ]
+
+                etags = [ f.result() for f in futures ]
+
+            self.complete_multipart_upload(key, upload_id, etags)
+        except Exception:
+            self.abort_multipart_upload(key, upload_id)
+            raise
+
+    def download_file(self, key, filename):
+        """ This function writes the contents of the object ``key`` into 
+        ``filename``, fetching its parts concurrently with ranged GETs. It 
+        raises KeyError if the object does not exist.
+        """
+
+        size = self.size(key)
+
+        if size is None:
+            raise KeyError(key)
+
+        with open(filename, 'wb') as outfile:
+            outfile.truncate(size)
+
+        def download(start, end):
+            data = self.get(key, start, end)
+
+            with open(filename, 'r+b') as outfile:
+                outfile.seek(start)
+                outfile.write(data)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.threads)) as pool:
+            for f in [ pool.submit(download, start, end) 
+                        for start, end in self._ranges(size) ]:
+                f.result()
+
+
+class S3ObjectStore(ObjectStore):
+    """ This class stores the objects in the ``bucket`` of an S3-compatible 
+    service. Note that S3 requires all the parts of a multipart upload but 
+    the last one to be at least 5 MiB long.
+    """
+
+    def __init__(self, bucket, endpoint_url=None, access_key=None, 
+                 secret_key=None, region=None, **kwargs):
+
+        if boto3 is None:
+            raise Exception("the 's3' object store requires the 'boto3' module")
+
+        super().__init__(**kwargs)
+
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   aws_access_key_id=access_key,
+                                   aws_secret_access_key=secret_key,
+                                   region_name=region)
+
+    @staticmethod
+    def _not_found(e):
+        return e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                return None
+            raise
+
+    def get(self, key, start=0, end=None):
+
+        if end is not None and end <= start:
+            return b''
+
+        byte_range = 'bytes={}-{}'.format(start, '' if end is None else end - 1)
+
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key, 
+                                              Range=byte_range)
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                raise KeyError(key)
+            # empty objects can't satisfy any range
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                return b''
+            raise
+
+        return response['Body'].read()
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get_with_etag(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                raise KeyError(key)
+            raise
+
+        return response['Body'].read(), response['ETag']
+
+    def put_if_match(self, key, data, etag):
+
+        if etag is None:
+            condition = {'IfNoneMatch' : '*'}
+        else:
+            condition = {'IfMatch' : etag}
+
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data, 
+                                   **condition)
+        except botocore.exceptions.ClientError as e:
+            # (409 is returned if another conditional write is in progress)
+            if e.response.get('Error', {}).get('Code') in \
+                    ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise ConflictError(key)
+            raise
+
+    def copy(self, src_key, dst_key):
+        # (a managed transfer, since single copies are limited to 5 GiB)
+        self.client.copy({'Bucket' : self.bucket, 'Key' : src_key}, 
+                         self.bucket, dst_key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def create_multipart_upload(self, key):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+        return response['UploadId']
+
+    def upload_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, 
+                        UploadId=upload_id, PartNumber=number, Body=data)
+        return response['ETag']
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        parts = [ {'ETag' : etag, 'PartNumber' : number} 
+                    for number, etag in enumerate(etags, start=1) ]
+
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key,
+                UploadId=upload_id, MultipartUpload={'Parts' : parts})
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, 
+                                           UploadId=upload_id)
+
+
+class LocalObjectStore(ObjectStore):
+    """ This class stores the objects as files under the ``root`` directory
+    (named after their keys). The parts of multipart uploads are kept in 
+    its UPLOADS_FOLDER until they are completed. Conditional writes are
+    serialized with a lock file, so that the directory can be shared by 
+    several processes (i.e. nodes) in the same host.
+    """
+
+    UPLOADS_FOLDER = '.uploads'
+
+    def __init__(self, root, **kwargs):
+        super().__init__(**kwargs)
+
+        self.root = root
+
+        os.makedirs(os.path.join(self.root, self.UPLOADS_FOLDER), exist_ok=True)
+
+    def _path(self, key):
+        parts = key.split('/')
+
+        if key.startswith('/') or any(p in ('', '.', '..') for p in parts) or \
+                parts[0] == self.UPLOADS_FOLDER:
+            raise ValueError("Invalid object key '{}'".format(key))
+
+        return os.path.join(self.root, *parts)
+
+    def _upload_path(self, upload_id, *names):
+        return os.path.join(self.root, self.UPLOADS_FOLDER, upload_id, *names)
+
+    def _write(self, path, data_or_file):
+        """ write the new object atomically, so that readers never see it
+        partially written """
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = self._upload_path(uuid.uuid4().hex + '.tmp')
+
+        if isinstance(data_or_file, bytes):
+            with open(tmp_path, 'wb') as outfile:
+                outfile.write(data_or_file)
+        else:
+            shutil.copyfile(data_or_file, tmp_path)
+
+        os.replace(tmp_path, path)
+
+    def size(self, key):
+        path = self._path(key)
+
+        if not os.path.isfile(path):
+            return None
+
+        return os.path.getsize(path)
+
+    def get(self, key, start=0, end=None):
+        try:
+            with open(self._path(key), 'rb') as infile:
+                infile.seek(start)
+                return infile.read(-1 if end is None else max(0, end - start))
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put(self, key, data):
+        self._write(self._path(key), data)
+
+    @staticmethod
+    def _etag(data):
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    @contextmanager
+    def _conditional_lock(self):
+
+        with open(self._upload_path('.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def get_with_etag(self, key):
+        data = self.get(key)
+        return data, self._etag(data)
+
+    def put_if_match(self, key, data, etag):
+        path = self._path(key)
+
+        with self._conditional_lock():
+            try:
+                _, current_etag = self.get_with_etag(key)
+            except KeyError:
+                current_etag = None
+
+            if current_etag != etag:
+                raise ConflictError(key)
+
+            self._write(path, data)
+
+    def copy(self, src_key, dst_key):
+        src_path = self._path(src_key)
+
+        if not os.path.isfile(src_path):
+            raise KeyError(src_key)
+
+        self._write(self._path(dst_key), src_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        keys = []
+
+        for root, dirs, files in os.walk(self.root):
+            if root == self.root:
+                dirs.remove(self.UPLOADS_FOLDER)
+
+            for name in files:
+                key = os.path.relpath(os.path.join(root, name), 
+                                      self.root).replace(os.sep, '/')
+
+                if key.startswith(prefix):
+                    keys.append(key)
+
+        # (in lexicographic order, like S3)
+        yield from sorted(keys)
+
+    def create_multipart_upload(self, key):
+        self._path(key)
+
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_path(upload_id))
+
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        with open(self._upload_path(upload_id, str(number)), 'wb') as outfile:
+            outfile.write(data)
+
+        return str(number)
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        tmp_path = self._upload_path(upload_id, 'object')
+
+        with open(tmp_path, 'wb') as outfile:
+            for etag in etags:
+                with open(self._upload_path(upload_id, etag), 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+        self.abort_multipart_upload(key, upload_id)
+
+    def abort_multipart_upload(self, key, upload_id):
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+
+_stores = {
+    's3' : S3ObjectStore,
+    'local' : LocalObjectStore,
+}
+
+def open_object_store(config):
+    """ This function creates a client for the object store described by the
+    dict ``config``: its 'type' ('s3' or 'local') and the arguments for the
+    class implementing it, e.g.:
+
+        { 'type' : 's3', 'bucket' : 'ddreplay', 
+          'endpoint_url' : 'http://minio:9000', 
+          'access_key' : '...', 'secret_key' : '...' }
+
+        { 'type' : 'local', 'root' : '/srv/ddreplay-objects' }
+    """
+
+    config = dict(config)
+    store_type = config.pop('type', 's3')
+
+    if store_type not in _stores:
+        raise Exception("Unknown object store type '{}'".format(store_type))
+
+    return _stores[store_type](**config)
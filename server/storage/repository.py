@@ -28,6 +28,10 @@
 import uuid
 import datetime as dt
 from storage.backends.filesystem import Filesystem
+from storage.backends.objectstorage import ObjectStorage
+from storage.compression import available_codecs
+from storage.objectstore import ConflictError
+from storage.garbage import GarbageCollector
 
 ################################################################################
 ##### main class                                                           #####
@@ -38,6 +42,10 @@ class Repository:
 
         if backend == 'filesystem':
             self.backend = Filesystem(**kwargs)
+        elif backend == 'objectstore':
+            self.backend = ObjectStorage(**kwargs)
+        else:
+            raise Exception("Unknown repository backend '{}'".format(backend))
 
         ## self.cached_drafts = []
         ## self.cached_versions = {}
@@ -47,12 +55,47 @@ class Repository:
         """
         self.backend.destroy()
 
+    def collect_trash(self):
+        """This function removes all expired data from the repository's 
+        trash and returns the number of bytes reclaimed.
+        """
+        return self.backend.collect_trash()
+
+    def get_trash_stats(self):
+        return self.backend.get_trash_stats()
+
+    def get_profiles_path(self):
+        return self.backend.get_profiles_path()
+
+    def collect_garbage(self, dry_run=True, max_entries=None, grace_period=3600):
+        """This function looks for data that is no longer referenced by any 
+        draft or version and returns a report with the bytes that can be
+        reclaimed. Unless ``dry_run`` is True, the garbage found is moved to
+        the trash to be removed.
+        """
+
+        gc = GarbageCollector(self.backend, grace_period)
+
+        report = gc.collect(dry_run, max_entries)
+
+        # if there's no background collector, reclaim the space now
+        if not dry_run and not self.backend.trash.running:
+            self.backend.collect_trash()
+
+        return report
+
     def generate_DID(self):
         return uuid.uuid4().hex[0:8]
 
     def generate_PID(self):
         return uuid.uuid4().hex[0:16]
 
+    def list_compression_codecs(self):
+        """This function returns the codecs that can be used to compress the
+        data stored for a dataset.
+        """
+        return available_codecs()
+
     def _refresh_cached_drafts(self):
         pass
 ##         self.cached_drafts = []
@@ -126,6 +169,8 @@ class Repository:
         if current_version is None:
             return None
 
+        dataset = self.lookup_dataset(PID)
+
         DID = self.generate_DID()
 
         new_draft = {
@@ -133,17 +178,19 @@ class Repository:
             "PID" : PID,
             "parent_version" : current_version["id"],
             "created_at" : dt.datetime.now(),
+            "compression" : dataset.get("compression"),
+            "chunking" : dataset.get("chunking"),
             "contents" : current_version["contents"]
         }
 
         result = self.backend.save_draft_record(new_draft)
 
-        # since we are not deduplicating data, just copy the data
-        # from 'current_version' to 'new_draft'
+        # the data from 'current_version' is shared with 'new_draft' 
+        # (the backend takes care of copying it when it is modified)
         self.backend.transfer_data_to_draft(DID, PID, current_version['id'])
 
-        # we also need to copy the stored fingerprints from 'current_version' 
-        #(i.e. PID+current_version['id'] to 'new_draft'
+        # the fingerprints of 'current_version' (i.e. PID+current_version['id'])
+        # are also shared with 'new_draft', which only stores its changes
         self.backend.transfer_fingerprints_to_draft(DID, PID, current_version['id'])
 
         return result
@@ -156,6 +203,35 @@ class Repository:
 
         return result
 
+    def add_batch_to_draft(self, draft, data_iterator, usr_path=None):
+        """This function adds several files and/or delta sets to ``draft`` in
+        a single operation (see Filesystem.add_batch_to_draft()).
+        """
+
+        return self.backend.add_batch_to_draft(draft, data_iterator, usr_path)
+
+    def remove_path_from_draft(self, draft, usr_path):
+        """This function removes the file or directory ``usr_path`` from 
+        ``draft`` (see Filesystem.remove_path_from_draft()). Returns None if
+        the draft has no such path.
+        """
+
+        return self.backend.remove_path_from_draft(draft, usr_path)
+
+    def move_draft_path(self, draft, src_path, dst_path):
+        """This function moves the file or directory ``src_path`` of 
+        ``draft`` to ``dst_path`` (see Filesystem.move_draft_path()).
+        """
+
+        return self.backend.move_draft_path(draft, src_path, dst_path)
+
+    def copy_draft_path(self, draft, src_path, dst_path):
+        """This function copies the file or directory ``src_path`` of 
+        ``draft`` to ``dst_path`` (see Filesystem.copy_draft_path()).
+        """
+
+        return self.backend.copy_draft_path(draft, src_path, dst_path)
+
     def lookup_draft(self, DID, fetch_data=False, fetch_fingerprints=False):
         """This version searches for the draft identified by ``DID`` and 
         returns its JSON record. The draft is initially searched for in the
@@ -223,7 +299,9 @@ class Repository:
         if dataset is None:
             dataset = {
                 "PID" : PID,
-                "current" : VID
+                "current" : VID,
+                "compression" : draft.get("compression"),
+                "chunking" : draft.get("chunking")
             }
         else:
             parent_version = dataset["current"]
@@ -238,26 +316,32 @@ class Repository:
         if draft['parent_version'] is not None and draft['parent_version'] != parent_version:
             return None
 
-        # update the dataset record
-        self.backend.save_dataset_record(dataset) 
-
-        # save a new version record to the backend
-        new_version = self.backend.save_version_record(PID, 
-            {
-                "id" : draft['id'],
-                "PID" : PID,
-                "parent_version": parent_version,
-                "created_at" : dt.datetime.now(),
-                "author" : author,
-                "message" : message,
-                "contents" : draft['contents']
-            })
-
-        # the new version inherits all the data from the promoted draft
-        self.backend.transfer_data_from_draft(DID, PID, VID)
-
-        # the new version inherits the fingerprints from the promoted draft
-        self.backend.transfer_fingerprints_from_draft(DID, PID, VID)
+        try:
+            # update the dataset record
+            self.backend.save_dataset_record(dataset) 
+
+            # save a new version record to the backend
+            new_version = self.backend.save_version_record(PID, 
+                {
+                    "id" : draft['id'],
+                    "PID" : PID,
+                    "parent_version": parent_version,
+                    "created_at" : dt.datetime.now(),
+                    "author" : author,
+                    "message" : message,
+                    "contents" : draft['contents']
+                })
+
+            # the new version inherits all the data from the promoted draft
+            self.backend.transfer_data_from_draft(DID, PID, VID)
+
+            # the new version inherits the fingerprints from the promoted draft
+            self.backend.transfer_fingerprints_from_draft(DID, PID, VID)
+        except ConflictError:
+            # backends shared by several nodes check it again when the 
+            # dataset record is stored, since another node may have 
+            # published a version meanwhile (the publication is undone)
+            return None
 
         # delete record for the 'old draft'
         #print('removing draft', DID)
@@ -307,6 +391,36 @@ class Repository:
 
         return version, data_path
 
+    def release_version_data(self, data_path):
+        """ This function must be called once the data of a version returned
+        by lookup_version() or lookup_current_version() (with ``fetch_data``)
+        is no longer used, so that the backend can evict it from its cache.
+        """
+
+        self.backend.release_version_data(data_path)
+
+
+    def lookup_version_fingerprints(self, PID, VID):
+        """ This function returns the fingerprints of the files in version
+        ``VID`` of dataset ``PID`` (a dict {path : fingerprints}) or None if
+        they are not available.
+        """
+
+        return self.backend.load_version_fingerprints(PID, VID)
+
+    def lookup_draft_fingerprints(self, DID):
+        """ This function returns the fingerprints of the files in draft 
+        ``DID`` (a dict {path : fingerprints}) or None if there are none.
+        """
+
+        return self.backend.load_draft_fingerprints(DID)
+
+    def open_draft_fingerprints(self, DID):
+        """ This function returns a binary file object with the pickled 
+        fingerprints of draft ``DID`` (an empty set if there are none).
+        """
+
+        return self.backend.open_draft_fingerprints(DID)
 
     def list_all_versions(self, PID, refresh_cache=False):
 
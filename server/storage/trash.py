@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#  (C) Copyright 2016-2017 Barcelona Supercomputing Center                #
+#                     Centro Nacional de Supercomputacion                 #
+#                                                                         #
+#  This file is part of the Dataset Replayer.                             #
+#                                                                         #
+#  See AUTHORS file in the top level directory for information            #
+#  regarding developers and contributors.                                 #
+#                                                                         #
+#  This package is free software; you can redistribute it and/or          #
+#  modify it under the terms of the GNU Lesser General Public             #
+#  License as published by the Free Software Foundation; either           #
+#  version 3 of the License, or (at your option) any later version.       #
+#                                                                         #
+#  The Dataset Replayer is distributed in the hope that it will           #
+#  be useful, but WITHOUT ANY WARRANTY; without even the implied          #
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR                #
+#  PURPOSE.  See the GNU Lesser General Public License for more           #
+#  details.                                                               #
+#                                                                         #
+#  You should have received a copy of the GNU Lesser General Public       #
+#  License along with Echo Filesystem NG; if not, write to the Free       #
+#  Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.     #
+#                                                                         #
+###########################################################################
+
+
+import os
+import shutil
+import threading
+import time
+import uuid
+import datetime as dt
+
+from storage.garbage import reclaimable_bytes
+
+################################################################################
+##### trash management                                                     #####
+################################################################################
+class Trash:
+    """ This class manages the repository's TRASH folder. Discarded files and
+    directories are stored in namespaced, timestamped entries:
+
+        <trash_path>
+        ├── drafts
+        │   ├── data
+        │   │   └── 20170823T101530.123456-3f2a9c1d
+        │   │       └── fe5c2d9f
+        │   └── metadata
+        │       └── 20170823T101530.120001-9b7e01aa
+        │           └── fe5c2d9f.json
+        └── versions
+            └── fingerprints
+                └── ...
+
+    Entries expire according to a retention policy (``max_age`` in seconds
+    and/or ``max_size`` in bytes for the whole trash) and are removed by
+    ``collect()``, either explicitly or periodically from a background thread
+    started with ``start()``. Removal is throttled by sleeping ``throttle`` 
+    seconds after each batch of ``batch_size`` files, so that large trees 
+    do not starve request handling of I/O.
+    """
+
+    TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S.%f'
+    INCOMING_SUFFIX = '.incoming'
+    PURGE_SUFFIX = '.purge'
+
+    # incomplete entries older than this (in seconds) were left behind by
+    # an interrupted discard() and are removed
+    INCOMING_GRACE_PERIOD = 24*3600
+
+    def __init__(self, trash_path, max_age=None, max_size=None, throttle=0.0,
+                 batch_size=256, interval=None):
+
+        self.trash_path = trash_path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.throttle = throttle
+        self.batch_size = batch_size
+        self.interval = interval
+
+        # 'lock' protects the statistics, 'collect_lock' ensures that only one
+        # collection is in progress at any given time
+        self.lock = threading.Lock()
+        self.collect_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+        # entry path -> bytes freed by removing it (computed once, the first
+        # time that it is needed)
+        self.sizes = {}
+
+        self.statistics = {
+            'reclaimed_bytes' : 0,
+            'reclaimed_entries' : 0,
+            'collections' : 0,
+            'last_collection' : None,
+        }
+
+    ############################################################################
+    ##### public interface                                                 #####
+    ############################################################################
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def discard(self, path, namespace, purge=False):
+        """ This function moves ``path`` into a new trash entry in 
+        ``namespace``. If ``purge`` is True, the entry is removed in the next
+        collection regardless of the retention policy.
+        """
+
+        stamp = dt.datetime.now().strftime(self.TIMESTAMP_FORMAT)
+        name = stamp + '-' + uuid.uuid4().hex[0:8]
+
+        ns_path = os.path.join(self.trash_path, namespace)
+        incoming = os.path.join(ns_path, name + self.INCOMING_SUFFIX)
+
+        # the entry is only renamed to its final name once it is complete,
+        # so that the collector never sees it partially moved
+        os.makedirs(incoming)
+        shutil.move(path, os.path.join(incoming, os.path.basename(path)))
+
+        entry = os.path.join(ns_path, name + (self.PURGE_SUFFIX if purge else ''))
+        os.rename(incoming, entry)
+
+        if purge:
+            self.wakeup.set()
+
+        return entry
+
+    def collect(self, now=None):
+        """ This function removes all expired entries from the trash and 
+        returns the number of bytes reclaimed.
+        """
+
+        with self.collect_lock:
+            if now is None:
+                now = dt.datetime.now()
+
+            entries = self._list_entries(now)
+            expired = []
+            kept = []
+
+            for entry, stamp, purge in entries:
+                if purge or (self.max_age is not None and 
+                        (now - stamp).total_seconds() > self.max_age):
+                    expired.append(entry)
+                else:
+                    kept.append(entry)
+
+            # if the trash is still too large, expire the oldest entries first
+            if self.max_size is not None:
+                total_size = sum(self._entry_size(e) for e in kept)
+
+                for entry in kept:
+                    if total_size <= self.max_size:
+                        break
+                    total_size -= self._entry_size(entry)
+                    expired.append(entry)
+
+            reclaimed = 0
+            for entry in expired:
+                if self.stopped:
+                    break
+                reclaimed += self._remove_entry(entry)
+
+            with self.lock:
+                self.statistics['collections'] += 1
+                self.statistics['last_collection'] = now
+
+            return reclaimed
+
+    def stats(self):
+        """ This function returns statistics about the contents of the trash 
+        and the space reclaimed so far.
+        """
+
+        entries = self._list_entries()
+        pending_bytes = sum(self._entry_size(e) for e, _, _ in entries)
+
+        with self.lock:
+            result = dict(self.statistics)
+
+        result['pending_entries'] = len(entries)
+        result['pending_bytes'] = pending_bytes
+
+        return result
+
+    def start(self):
+        """ This function starts a background thread that collects the trash
+        every ``interval`` seconds (or as soon as an entry is purged).
+        """
+
+        if self.running or self.interval is None:
+            return
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='trash-collector')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    ############################################################################
+    ##### private functions                                                #####
+    ############################################################################
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            if self.stopped:
+                break
+
+            try:
+                self.collect()
+            except Exception:
+                # never let an error kill the collector
+                pass
+
+    def _list_entries(self, now=None):
+        """ This function returns a list of (path, timestamp, purge) tuples
+        for all entries in the trash, sorted from oldest to newest. Entries
+        that are still being moved into the trash are skipped.
+        """
+
+        if now is None:
+            now = dt.datetime.now()
+
+        entries = []
+
+        for root, dirs, files in os.walk(self.trash_path):
+            for d in list(dirs):
+                name = d
+                purge = name.endswith(self.PURGE_SUFFIX)
+                incoming = name.endswith(self.INCOMING_SUFFIX)
+
+                if purge:
+                    name = name[:-len(self.PURGE_SUFFIX)]
+                elif incoming:
+                    name = name[:-len(self.INCOMING_SUFFIX)]
+
+                try:
+                    stamp = dt.datetime.strptime(name.split('-')[0], 
+                                                 self.TIMESTAMP_FORMAT)
+                except ValueError:
+                    # this is a namespace (or an incomplete entry)
+                    continue
+
+                # entries are leaves: don't descend into them
+                dirs.remove(d)
+
+                if incoming:
+                    if (now - stamp).total_seconds() <= self.INCOMING_GRACE_PERIOD:
+                        continue
+                    purge = True
+
+                entries.append((os.path.join(root, d), stamp, purge))
+
+        entries.sort(key=lambda e: e[1])
+
+        # forget the sizes of entries that are gone
+        with self.lock:
+            current = set(e[0] for e in entries)
+
+            for entry in [ e for e in self.sizes if e not in current ]:
+                del self.sizes[entry]
+
+        return entries
+
+    def _entry_size(self, entry):
+        """ This function returns how many bytes would be freed by removing
+        ``entry``. Files in the trash may be hard links to live data (e.g. 
+        the files that a discarded draft shared with a version), which are
+        not counted. The size is computed once and cached, so it does not 
+        grow if the data that it shares is removed later.
+        """
+
+        with self.lock:
+            if entry in self.sizes:
+                return self.sizes[entry]
+
+        size = reclaimable_bytes([entry])
+
+        with self.lock:
+            self.sizes[entry] = size
+
+        return size
+
+    def _remove_entry(self, entry):
+        """ remove ``entry`` file by file, throttling the removal rate. It 
+        returns the number of bytes actually freed, i.e. the size of the 
+        files whose last link was removed.
+        """
+
+        size = 0
+        count = 0
+
+        for root, dirs, files in os.walk(entry, topdown=False):
+            for f in files:
+                filepath = os.path.join(root, f)
+                st = os.lstat(filepath)
+
+                os.remove(filepath)
+                count += 1
+
+                if st.st_nlink <= 1:
+                    size += st.st_size
+
+                if self.throttle > 0 and count % self.batch_size == 0:
+                    time.sleep(self.throttle)
+
+                    if self.stopped:
+                        return 0
+
+            for d in dirs:
+                os.rmdir(os.path.join(root, d))
+
+        os.rmdir(entry)
+
+        with self.lock:
+            self.sizes.pop(entry, None)
+            self.statistics['reclaimed_bytes'] += size
+            self.statistics['reclaimed_entries'] += 1
+
+        return size
@@ -28,25 +28,47 @@
 
 
 import os
+import sys
 import unittest
 import tempfile
 import json
 import shutil
 import io
+import re
 import tarfile
+import zipfile
 import warnings
 import random
+import datetime
+import threading
+import pickle
+import time
+import hashlib
+import rabin as librp
 
 from pprint import pprint
 from collections import OrderedDict
 from werkzeug.utils import secure_filename
+from werkzeug.test import EnvironBuilder
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # for the tests to use a temporary repository, FLASK_CONFIGURATION
 # needs to be set to 'testing' BEFORE importing the app
 os.environ['FLASK_CONFIGURATION'] = 'testing'
 from ddreplay import app, set_repository
 from storage.repository import Repository
-from storage.backends.filesystem import DraftSchema
+from storage.backends.filesystem import DraftSchema, Filesystem
+from storage.objectstore import LocalObjectStore, ConflictError
+from storage.archives import extract_archive, find_decompressor, register_decompressor, \
+                             Decompressor, _decompressors
+from storage.compression import compress_file, open_stored_file, stored_file_size, is_compressed
+from ddreplay.encoding import negotiate_encoding, encode_stream, DecodingMiddleware
+from storage.trash import Trash
+from storage.garbage import reclaimable_bytes
+from storage import metrics
+from storage import fingerprints as fingerprints_module
+from storage import chunking
+from storage import fastcdc
 
 # disable flask internal logging
 import logging
@@ -159,8 +181,7 @@ def verify_repository(repo, draft_id, exp_contents):
 
     def verify_file(name, path):
         assert(name == os.path.basename(path))
-        repo_base = repo.backend.base_location
-        exp_path = os.path.join(repo_base, 'drafts', 'data', draft_id, path)
+        exp_path = os.path.join(repo.backend._get_draft_data_path(draft_id), path)
 
         assert(os.path.exists(exp_path))
         assert(os.path.isfile(exp_path))
@@ -623,5 +644,2096 @@ class DraftTest(unittest.TestCase):
         response = upload_file(self.app, draft_id, test_data, overwrite=True)
         resp = json_response(response, 200)
 
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_archive(self, name, mode, members):
+        filename = os.path.join(self.tmpdir, name)
+
+        with tarfile.open(filename, mode) as tar:
+            for member_name, data in members:
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        return filename
+
+    ### tests begin here ###
+    def test_find_decompressor(self):
+        for name in ['a.tar', 'a.tar.gz', 'a.tgz', 'a.tar.bz2', 'a.tar.xz', 'a.tar.zst']:
+            self.assertIsNotNone(find_decompressor(name))
+
+        self.assertIsNone(find_decompressor('a.zip'))
+        self.assertIsNone(find_decompressor('a.gz'))
+
+    def test_extract_archive(self):
+        for name, mode in [('a.tar', 'w'), ('a.tar.gz', 'w:gz'), 
+                           ('a.tar.bz2', 'w:bz2'), ('a.tar.xz', 'w:xz')]:
+            archive = self.make_archive(name, mode, [('foo/bar', b'data')])
+            dst = tempfile.mkdtemp(dir=self.tmpdir)
+
+            extract_archive(archive, dst)
+
+            with open(os.path.join(dst, 'foo', 'bar'), 'rb') as infile:
+                self.assertEqual(infile.read(), b'data')
+
+    def test_extract_archive_outside_destination(self):
+        archive = self.make_archive('a.tar', 'w', [('../evil', b'data')])
+        dst = tempfile.mkdtemp(dir=self.tmpdir)
+
+        with self.assertRaises(Exception):
+            extract_archive(archive, dst)
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'evil')))
+
+    def test_extract_archive_tool_messages(self):
+        # a 'decompressor' that writes more to stderr than fits in a pipe
+        class NoisyDecompressor(Decompressor):
+            suffixes = ('.tar.noisy',)
+            tools = (
+                (sys.executable, ['-c', 'import sys, shutil; '
+                    'sys.stderr.write("warning " * 100000); sys.stderr.flush(); '
+                    'shutil.copyfileobj(open(sys.argv[1], "rb"), sys.stdout.buffer); '
+                    'sys.exit(sys.argv[1].endswith("bad.tar.noisy"))']),
+            )
+
+        decompressor = NoisyDecompressor()
+        register_decompressor(decompressor)
+
+        try:
+            archive = self.make_archive('a.tar.noisy', 'w', [('foo/bar', b'data')])
+            dst = tempfile.mkdtemp(dir=self.tmpdir)
+
+            extract_archive(archive, dst)
+
+            with open(os.path.join(dst, 'foo', 'bar'), 'rb') as infile:
+                self.assertEqual(infile.read(), b'data')
+
+            archive = self.make_archive('bad.tar.noisy', 'w', [('foo/bar', b'data')])
+            dst = tempfile.mkdtemp(dir=self.tmpdir)
+
+            with self.assertRaisesRegex(Exception, 'Failed to decompress archive: warning'):
+                extract_archive(archive, dst)
+        finally:
+            _decompressors.remove(decompressor)
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    ### tests begin here ###
+    def test_random_access(self):
+        data = os.urandom(1024) * 300
+        src = os.path.join(self.tmpdir, 'src')
+        dst = os.path.join(self.tmpdir, 'dst')
+
+        with open(src, 'wb') as outfile:
+            outfile.write(data)
+
+        compress_file(src, dst, 'zlib', block_size=4096)
+
+        self.assertTrue(is_compressed(dst))
+        self.assertFalse(is_compressed(src))
+        self.assertTrue(os.path.getsize(dst) < len(data))
+        self.assertEqual(stored_file_size(dst, 'zlib'), len(data))
+        self.assertEqual(stored_file_size(dst), os.path.getsize(dst))
+
+        with open_stored_file(dst, 'zlib') as infile:
+            for i in range(0, 100):
+                offset = random.randrange(len(data))
+                size = random.randrange(20000)
+
+                infile.seek(offset)
+                self.assertEqual(infile.read(size), data[offset:offset+size])
+
+class EncodingTest(unittest.TestCase):
+
+    ### tests begin here ###
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(negotiate_encoding('identity'))
+        self.assertIsNone(negotiate_encoding('gzip;q=0'))
+        self.assertIsNone(negotiate_encoding(None))
+
+    def test_decode_request(self):
+        data = b'some text to be compressed\n' * 1000
+        encoded = b''.join(encode_stream([data], 'gzip'))
+
+        def wsgi_app(environ, start_response):
+            self.assertNotIn('HTTP_CONTENT_ENCODING', environ)
+            self.assertEqual(environ['wsgi.input'].read(), data)
+            return []
+
+        environ = {
+            'HTTP_CONTENT_ENCODING' : 'gzip',
+            'CONTENT_LENGTH' : str(len(encoded)),
+            'wsgi.input' : io.BytesIO(encoded)
+        }
+
+        DecodingMiddleware(wsgi_app)(environ, None)
+
+    def test_decode_request_too_large(self):
+        data = b'\0' * (16*1024*1024)
+        encoded = b''.join(encode_stream([data], 'gzip'))
+
+        def wsgi_app(environ, start_response):
+            stream = environ['wsgi.input']
+            self.assertRaises(RequestEntityTooLarge, stream.read)
+            # (nothing is decompressed beyond the limit)
+            self.assertLessEqual(stream.size, 1024*1024 + stream.chunk_size)
+            return []
+
+        environ = {
+            'HTTP_CONTENT_ENCODING' : 'gzip',
+            'CONTENT_LENGTH' : str(len(encoded)),
+            'wsgi.input' : io.BytesIO(encoded)
+        }
+
+        DecodingMiddleware(wsgi_app, max_size=1024*1024)(environ, None)
+
+    def test_upload_too_large(self):
+        repo = Repository(backend='filesystem', base_location=tempfile.mkdtemp(),
+                          permanent_remove=True, remove_fingerprints=True)
+        set_repository(repo)
+
+        client = app.test_client()
+
+        # (wrapped by the other middlewares, e.g. the one of the metrics)
+        decoder = app.wsgi_app
+        while not isinstance(decoder, DecodingMiddleware):
+            decoder = decoder.wsgi_app
+
+        max_size = decoder.max_size
+        decoder.max_size = 1024*1024
+
+        try:
+            response = client.post('/api/v1.2/drafts/')
+            draft_id = json_response(response, 201)['draft']['id']
+
+            builder = EnvironBuilder(method='PUT', 
+                    data={'file' : (io.BytesIO(b'\0' * (2*1024*1024)), 'data.bin')})
+            body = builder.get_environ()['wsgi.input'].read()
+            encoded = b''.join(encode_stream([body], 'gzip'))
+
+            response = client.put('/api/v1.2/drafts/' + draft_id, data=encoded,
+                    content_type=builder.content_type,
+                    headers={'content-disposition' : 'attachment; filename=data.bin',
+                             'Content-Encoding' : 'gzip'})
+            self.assertEqual(response.status_code, 413)
+
+            draft, _, _ = repo.lookup_draft(draft_id)
+            self.assertEqual(len(draft['contents']), 0)
+        finally:
+            decoder.max_size = max_size
+            repo.destroy()
+
+class TrashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.trash = Trash(os.path.join(self.tmpdir, 'trash'), max_age=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def discard_file(self, name, namespace, size, purge=False):
+        filename = os.path.join(self.tmpdir, name)
+
+        with open(filename, 'wb') as outfile:
+            outfile.write(b'x' * size)
+
+        return self.trash.discard(filename, namespace, purge)
+
+    ### tests begin here ###
+    def test_no_collisions(self):
+        e1 = self.discard_file('foo.json', 'drafts/metadata', 10)
+        e2 = self.discard_file('foo.json', 'drafts/metadata', 10)
+
+        self.assertNotEqual(e1, e2)
+        self.assertTrue(os.path.exists(os.path.join(e1, 'foo.json')))
+        self.assertTrue(os.path.exists(os.path.join(e2, 'foo.json')))
+
+    def test_retention_policy(self):
+        self.discard_file('a', 'drafts/data', 100)
+        self.discard_file('b', 'drafts/data', 50, purge=True)
+
+        self.assertEqual(self.trash.collect(), 50)
+        self.assertEqual(self.trash.stats()['pending_entries'], 1)
+
+        later = datetime.datetime.now() + datetime.timedelta(hours=2)
+        self.assertEqual(self.trash.collect(now=later), 100)
+
+        stats = self.trash.stats()
+        self.assertEqual(stats['pending_entries'], 0)
+        self.assertEqual(stats['reclaimed_bytes'], 150)
+        self.assertEqual(stats['reclaimed_entries'], 2)
+
+    def test_max_size(self):
+        self.trash.max_size = 100
+
+        for name in ['a', 'b', 'c']:
+            self.discard_file(name, 'drafts/data', 60)
+
+        self.assertEqual(self.trash.collect(), 120)
+        self.assertEqual(self.trash.stats()['pending_bytes'], 60)
+
+    def test_incoming_entries(self):
+        self.trash.max_size = 0
+
+        # an entry that is still being moved into the trash
+        stamp = datetime.datetime.now().strftime(Trash.TIMESTAMP_FORMAT)
+        incoming = os.path.join(self.tmpdir, 'trash', 'drafts', 'data', 
+                                stamp + '-0123abcd' + Trash.INCOMING_SUFFIX)
+        os.makedirs(os.path.join(incoming, 'a'))
+
+        self.discard_file('b', 'drafts/data', 60)
+
+        self.assertEqual(self.trash.collect(), 60)
+        self.assertTrue(os.path.exists(incoming))
+        self.assertEqual(self.trash.stats()['pending_entries'], 0)
+
+        # unless it was left behind by an interrupted discard
+        later = datetime.datetime.now() + datetime.timedelta(days=2)
+        self.trash.collect(now=later)
+        self.assertFalse(os.path.exists(incoming))
+
+    def test_hard_links(self):
+        self.trash.max_size = 100
+
+        # a file that is still linked from live data frees no space
+        live = os.path.join(self.tmpdir, 'live')
+        with open(live, 'wb') as outfile:
+            outfile.write(b'x' * 200)
+        os.link(live, os.path.join(self.tmpdir, 'shared'))
+
+        self.trash.discard(os.path.join(self.tmpdir, 'shared'), 'drafts/data')
+        self.discard_file('a', 'drafts/data', 60)
+
+        self.assertEqual(self.trash.stats()['pending_bytes'], 60)
+        self.assertEqual(self.trash.collect(), 0)
+
+        later = datetime.datetime.now() + datetime.timedelta(hours=2)
+        self.assertEqual(self.trash.collect(now=later), 60)
+        self.assertEqual(self.trash.stats()['reclaimed_bytes'], 60)
+        self.assertEqual(self.trash.sizes, {})
+        self.assertTrue(os.path.exists(live))
+
+class GarbageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    ### tests begin here ###
+    def test_reclaimable_bytes(self):
+        live = os.path.join(self.tmpdir, 'live')
+        garbage = os.path.join(self.tmpdir, 'garbage')
+        os.makedirs(live)
+        os.makedirs(garbage)
+
+        with open(os.path.join(garbage, 'a'), 'wb') as outfile:
+            outfile.write(b'x' * 100)
+
+        with open(os.path.join(garbage, 'b'), 'wb') as outfile:
+            outfile.write(b'x' * 200)
+
+        # 'b' is shared with live data, so removing it reclaims nothing
+        os.link(os.path.join(garbage, 'b'), os.path.join(live, 'b'))
+
+        self.assertEqual(reclaimable_bytes([garbage]), 100)
+        self.assertEqual(reclaimable_bytes([garbage, live]), 300)
+
+class RepositoryTestCase(unittest.TestCase):
+    """ Base class for the tests that run against a temporary filesystem 
+    repository through the API """
+
+    def setUp(self):
+        self.app = app.test_client()
+
+        # create a temporary Repository for the test
+        self.repo_location = tempfile.mkdtemp()
+        self.repo = self.open_repository()
+        set_repository(self.repo)
+
+    def tearDown(self):
+        self.repo.destroy()
+
+    def open_repository(self):
+        return Repository(backend='filesystem', base_location=self.repo_location,
+                          permanent_remove=True, remove_fingerprints=True)
+
+    def upload(self, draft_id, relpath, data=None):
+        """ upload ``data`` (by default, ``self.data[relpath]``) as 
+        ``relpath`` in the draft """
+
+        if data is None:
+            data = self.data[relpath]
+
+        usr_path, _, filename = relpath.rpartition('/')
+
+        response = self.app.put('/api/v1.2/drafts/' + draft_id + 
+                        ('/' + usr_path if usr_path else ''),
+                        content_type='multipart/form-data',
+                        headers={'content-disposition' : 'attachment; filename=' + filename},
+                        data={'file' : (io.BytesIO(data), filename)})
+        json_response(response, 200)
+
+    def create_draft(self, files=(), compression=None):
+        """ create a draft with ``files``, either a dict {relpath : data} or
+        a list of paths in ``self.data``, and return its id """
+
+        url = '/api/v1.2/drafts/'
+        if compression is not None:
+            url += '?compression=' + compression
+
+        draft_id = json_response(self.app.post(url), 201)['draft']['id']
+
+        for relpath in files:
+            self.upload(draft_id, relpath, files[relpath] if isinstance(files, dict) else None)
+
+        return draft_id
+
+    def publish(self, draft_id):
+        response = self.app.post('/api/v1.2/drafts/' + draft_id + 
+                                 '/publish?author=test&message=test')
+        return json_response(response, 201)['version']
+
+    def create_dataset(self, files):
+        """ publish a new dataset with ``files`` (see create_draft()) and 
+        return its first version """
+
+        return self.publish(self.create_draft(files))
+
+    def new_draft(self, PID):
+        response = self.app.put('/api/v1.2/datasets/' + PID + '/')
+        return json_response(response, 201)['draft']
+
+    def get_fingerprints(self, draft_id):
+        response = self.app.get('/api/v1.2/drafts/' + draft_id + '/fingerprints')
+        self.assertEqual(response.status_code, 200)
+        return pickle.loads(response.get_data())
+
+    @classmethod
+    def paths(cls, contents):
+        """ return the sorted paths of all the entries in ``contents`` """
+
+        result = []
+        for entry in contents:
+            result.append(entry['path'])
+            result.extend(cls.paths(entry.get('children', [])))
+        return sorted(result)
+
+class MetricsTest(RepositoryTestCase):
+
+    ### tests begin here ###
+    def test_histogram_exposition(self):
+        registry = metrics.Registry()
+        h = registry.register(metrics.Histogram('test_seconds', 'test', ['op'], buckets=(1, 10)))
+
+        h.observe(0.5, op='a')
+        h.observe(5, op='a')
+        h.observe(50, op='a')
+
+        text = registry.expose()
+
+        self.assertIn('test_seconds_bucket{op="a",le="1.0"} 1', text)
+        self.assertIn('test_seconds_bucket{op="a",le="10.0"} 2', text)
+        self.assertIn('test_seconds_bucket{op="a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{op="a"} 3', text)
+
+    def test_metrics_endpoint(self):
+        # (requests are recorded once the server closes their response)
+        self.app.get('/api/v1.2/drafts/').close()
+
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+
+        text = response.get_data(as_text=True)
+        self.assertIn('ddreplay_http_request_duration_seconds_count{method="GET",'
+                      'route="/api/v1.2/drafts/",status="200"}', text)
+
+    def test_failed_requests(self):
+
+        def failed_requests():
+            text = self.app.get('/metrics').get_data(as_text=True)
+            match = re.search('^ddreplay_http_request_duration_seconds_count\\{method="GET",'
+                              'route="/api/v1.2/drafts/",status="500"\\} (\\S+)$', text, re.M)
+            return float(match.group(1)) if match else 0
+
+        count = failed_requests()
+
+        def fail():
+            raise RuntimeError('list failed')
+
+        self.repo.list_all_drafts = fail
+
+        # (exceptions are propagated when testing, so the handlers that 
+        # record the requests are skipped)
+        with self.assertRaises(RuntimeError):
+            self.app.get('/api/v1.2/drafts/')
+
+        self.assertEqual(failed_requests(), count + 1)
+
+    def test_package_duration(self):
+
+        def packages_sent():
+            text = self.app.get('/metrics').get_data(as_text=True)
+            match = re.search('^ddreplay_package_duration_seconds_count (\\S+)$', text, re.M)
+            return float(match.group(1)) if match else 0
+
+        draft_id = self.create_draft({'data.bin' : os.urandom(1000)})
+
+        count = packages_sent()
+
+        # packages are only timed once they have been sent
+        response = self.app.get('/api/v1.2/drafts/' + draft_id)
+        self.assertEqual(packages_sent(), count)
+
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as pkg:
+            self.assertEqual(pkg.namelist(), ['data.bin'])
+
+        response.close()
+        self.assertEqual(packages_sent(), count + 1)
+
+class ProfilingTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.config['DD_PROFILING_ENABLED'] = True
+
+    def tearDown(self):
+        app.config['DD_PROFILING_ENABLED'] = False
+        super().tearDown()
+
+    ### tests begin here ###
+    def test_profile_request(self):
+        response = self.app.get('/api/v1.2/drafts/')
+        self.assertNotIn('X-DDReplay-Profile-Id', response.headers)
+
+        response = self.app.get('/api/v1.2/drafts/?profile=true')
+        self.assertEqual(response.status_code, 200)
+        profile_id = response.headers['X-DDReplay-Profile-Id']
+
+        response = self.app.get('/api/v1.2/profiles/' + profile_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('GET /api/v1.2/drafts/', response.get_data(as_text=True))
+
+    def test_profile_not_found(self):
+        response = self.app.get('/api/v1.2/profiles/0123456789abcdef')
+        self.assertEqual(response.status_code, 404)
+
+    def test_profiler_disabled_on_teardown(self):
+        # after_request handlers are not run for requests that fail
+        with app.test_request_context('/api/v1.2/drafts/?profile=true'):
+            app.preprocess_request()
+            self.assertIsNotNone(sys.getprofile())
+
+        self.assertIsNone(sys.getprofile())
+
+    def test_profile_streamed_response(self):
+        draft_id = self.create_draft({'data.bin' : os.urandom(1000)})
+
+        # packages are built while they are sent, so they are profiled until
+        # the response is closed
+        response = self.app.get('/api/v1.2/drafts/' + draft_id + '?profile=true')
+        self.assertEqual(response.status_code, 200)
+        profile_id = response.headers['X-DDReplay-Profile-Id']
+
+        self.assertEqual(self.app.get('/api/v1.2/profiles/' + profile_id).status_code, 404)
+
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as pkg:
+            self.assertEqual(pkg.namelist(), ['data.bin'])
+
+        response.close()
+
+        response = self.app.get('/api/v1.2/profiles/' + profile_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('zipstream', response.get_data(as_text=True))
+
+    def test_profile_batch_spans(self):
+        draft_id = self.create_draft()
+
+        files = [ (io.BytesIO(os.urandom(64*1024)), 'file_{}.dat'.format(i)) for i in range(3) ]
+        response = self.app.post('/api/v1.2/drafts/' + draft_id + '/batch?profile=true',
+                                 content_type='multipart/form-data', data={'files' : files})
+        json_response(response, 200)
+        profile_id = response.headers['X-DDReplay-Profile-Id']
+
+        # the files are processed by worker threads
+        report = self.app.get('/api/v1.2/profiles/' + profile_id).get_data(as_text=True)
+        self.assertEqual(len(re.findall('^    compute_fingerprints ', report, re.M)), 3)
+
+    def test_profiles_pruned(self):
+        app.config['DD_PROFILES_MAX_COUNT'] = 2
+
+        try:
+            profile_ids = []
+
+            for _ in range(3):
+                response = self.app.get('/api/v1.2/drafts/?profile=true')
+                profile_ids.append(response.headers['X-DDReplay-Profile-Id'])
+                # (so that they are ordered by their modification times)
+                time.sleep(0.01)
+        finally:
+            del app.config['DD_PROFILES_MAX_COUNT']
+
+        response = self.app.get('/api/v1.2/profiles/' + profile_ids[0])
+        self.assertEqual(response.status_code, 404)
+
+        for profile_id in profile_ids[1:]:
+            response = self.app.get('/api/v1.2/profiles/' + profile_id)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(len(os.listdir(self.repo.get_profiles_path())), 4)
+
+    def test_profiles_survive_garbage_collection(self):
+        response = self.app.get('/api/v1.2/drafts/?profile=true')
+        profile_id = response.headers['X-DDReplay-Profile-Id']
+
+        self.repo.collect_garbage(dry_run=False, grace_period=0)
+
+        response = self.app.get('/api/v1.2/profiles/' + profile_id)
+        self.assertEqual(response.status_code, 200)
+
+class ConcurrentUploadTest(RepositoryTestCase):
+
+    ### tests begin here ###
+    def test_concurrent_uploads_to_same_draft(self):
+        draft_id = self.create_draft()
+
+        names = [ 'file_{}.dat'.format(i) for i in range(0, 16) ]
+        paths = [ 'dir_{}'.format(i % 3) for i in range(0, 16) ]
+        statuses = []
+
+        def upload(name, path):
+            client = app.test_client()
+            response = client.put('/api/v1.2/drafts/' + draft_id + '/' + path,
+                            content_type='multipart/form-data',
+                            headers={'content-disposition' : 'attachment; filename=' + name},
+                            data={'file' : (io.BytesIO(os.urandom(64*1024)), name)})
+            statuses.append(response.status_code)
+
+        threads = [ threading.Thread(target=upload, args=(n, p)) 
+                        for n, p in zip(names, paths) ]
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(statuses, [200] * len(names))
+
+        # no update of the draft's metadata should have been lost
+        response = self.app.get('/api/v1.2/drafts/' + draft_id + '/fingerprints')
+        fps = pickle.loads(response.get_data())
+        self.assertEqual(sorted(fps.keys()), 
+                         sorted(p + '/' + n for n, p in zip(names, paths)))
+
+        response = self.app.get('/api/v1.2/drafts/' + draft_id + '/record')
+        contents = json_response(response, 200)['draft']['contents']
+        files = [ f['name'] for d in contents for f in d['children'] ]
+        self.assertEqual(sorted(files), sorted(names))
+
+class FileAccessTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.data = os.urandom(3*1024*1024 + 17)
+
+    ### tests begin here ###
+    def check_file_access(self, base_url):
+        resp = json_response(self.app.get(base_url + '/files/'), 200)
+
+        self.assertEqual(len(resp['files']), 1)
+        self.assertEqual(resp['files'][0]['path'], 'sub/data.bin')
+        self.assertEqual(resp['files'][0]['size'], len(self.data))
+        self.assertIsNotNone(resp['files'][0]['fingerprints'])
+        self.assertEqual(resp['files'][0]['sha256'], hashlib.sha256(self.data).hexdigest())
+
+        response = self.app.get(base_url + '/files/sub/data.bin')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), self.data)
+
+        response = self.app.get(base_url + '/files/sub/data.bin',
+                                headers={'Range' : 'bytes=1048570-2097160'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], 
+                         'bytes 1048570-2097160/{}'.format(len(self.data)))
+        self.assertEqual(response.get_data(), self.data[1048570:2097161])
+
+        response = self.app.get(base_url + '/files/sub/data.bin',
+                                headers={'Range' : 'bytes={}-'.format(len(self.data) + 10)})
+        self.assertEqual(response.status_code, 416)
+
+        response = self.app.get(base_url + '/files/sub/missing.bin')
+        self.assertEqual(response.status_code, 404)
+
+        response = self.app.get(base_url + '/files/../../etc/passwd')
+        self.assertEqual(response.status_code, 404)
+
+    def test_draft_file_access(self):
+        for compression in (None, 'zlib'):
+            draft_id = self.create_draft({'sub/data.bin' : self.data}, compression)
+            self.check_file_access('/api/v1.2/drafts/' + draft_id)
+
+    def test_version_file_access(self):
+        for compression in (None, 'zlib'):
+            draft_id = self.create_draft({'sub/data.bin' : self.data}, compression)
+            PID = self.publish(draft_id)['PID']
+
+            self.check_file_access('/api/v1.2/datasets/' + PID)
+
+    def test_raw_files_in_compressed_format(self):
+        # user data that happens to be in the format of compressed files
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'src')
+            dst = os.path.join(tmpdir, 'dst')
+
+            with open(src, 'wb') as outfile:
+                outfile.write(self.data)
+
+            compress_file(src, dst, 'zlib')
+
+            with open(dst, 'rb') as infile:
+                self.data = infile.read()
+
+        self.assertTrue(self.data.startswith(b'DDRZ') and self.data.endswith(b'DDRZ'))
+
+        draft_id = self.create_draft({'sub/data.bin' : self.data})
+        self.check_file_access('/api/v1.2/drafts/' + draft_id)
+
+        response = self.app.get('/api/v1.2/drafts/' + draft_id)
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as pkg:
+            self.assertEqual(pkg.read('sub/data.bin'), self.data)
+
+        PID = self.publish(draft_id)['PID']
+
+        self.check_file_access('/api/v1.2/datasets/' + PID)
+
+class BatchUploadTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.draft_id = self.create_draft()
+
+        self.files = { 'dir_{}/file_{}.dat'.format(i % 3, i) : os.urandom(128*1024) 
+                            for i in range(0, 10) }
+
+    def post_batch(self, fields):
+        return self.app.post('/api/v1.2/drafts/' + self.draft_id + '/batch',
+                             content_type='multipart/form-data', data=fields)
+
+    ### tests begin here ###
+    def test_batch_create_and_replace(self):
+        fields = {'files' : [ (io.BytesIO(data), path) for path, data in self.files.items() ]}
+        json_response(self.post_batch(fields), 200)
+
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/fingerprints')
+        fps = pickle.loads(response.get_data())
+        self.assertEqual(sorted(fps.keys()), sorted(self.files.keys()))
+
+        # replace two of the files sending only the chunks that changed
+        replaced = sorted(self.files)[:2]
+        fields = {'replace.fingerprints' : [], 'replace.parts' : []}
+
+        for path in replaced:
+            new_data = self.files[path][:1000] + b'modified' + self.files[path][1000:]
+
+            with tempfile.NamedTemporaryFile() as tmp:
+                tmp.write(new_data)
+                tmp.flush()
+                new_fps = librp.get_file_fingerprints(tmp.name)
+
+            known = set(fp[2] for fp in fps[path])
+            fields['replace.fingerprints'].append((io.BytesIO(pickle.dumps(new_fps)), path))
+
+            for offset, size, hv in new_fps:
+                if hv not in known:
+                    fields['replace.parts'].append((io.BytesIO(new_data[offset:offset+size]),
+                            '{}.__part_{}_{}__'.format(path, offset, size)))
+
+            self.files[path] = new_data
+
+        json_response(self.post_batch(fields), 200)
+
+        for path, data in self.files.items():
+            response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/' + path)
+            self.assertEqual(response.get_data(), data)
+
+    def test_batch_is_atomic(self):
+        path, data = sorted(self.files.items())[0]
+        json_response(self.post_batch({'files' : [(io.BytesIO(data), path)]}), 200)
+
+        # one of the files already exists: nothing should be added
+        fields = {'files' : [ (io.BytesIO(data), path) for path, data in self.files.items() ]}
+        response = self.post_batch(fields)
+        self.assertEqual(response.status_code, 409)
+
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/')
+        self.assertEqual([ f['path'] for f in json_response(response, 200)['files'] ], [path])
+
+    def test_batch_invalid_paths(self):
+        response = self.post_batch({'files' : [(io.BytesIO(b'x'), '../escape.dat')]})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.post_batch({'files' : [(io.BytesIO(b'x'), 'a.dat'),
+                                               (io.BytesIO(b'y'), 'a.dat')]})
+        self.assertEqual(response.status_code, 400)
+
+    def list_files(self):
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/')
+        return sorted(f['path'] for f in json_response(response, 200)['files'])
+
+    def test_batch_conflicting_paths(self):
+        json_response(self.post_batch({'files' : [(io.BytesIO(b'x'), 'x')]}), 200)
+
+        # a file of the batch and its parent directory
+        response = self.post_batch({'files' : [(io.BytesIO(b'a'), 'a'),
+                                               (io.BytesIO(b'b'), 'a/b')]})
+        self.assertEqual(response.status_code, 400)
+
+        # a file under an existing file
+        response = self.post_batch({'files' : [(io.BytesIO(b'c'), 'c'),
+                                               (io.BytesIO(b'y'), 'x/y')]})
+        self.assertEqual(response.status_code, 409)
+
+        self.assertEqual(self.list_files(), ['x'])
+
+    def test_batch_rollback(self):
+        backend = self.repo.backend
+        move_file = backend._move_file
+        calls = []
+
+        def failing_move(src, dst, overwrite=False):
+            calls.append(dst)
+            if len(calls) == 3:
+                raise OSError("No space left on device")
+            return move_file(src, dst, overwrite)
+
+        backend._move_file = failing_move
+
+        try:
+            fields = {'files' : [ (io.BytesIO(data), path) for path, data in self.files.items() ]}
+            self.assertEqual(self.post_batch(fields).status_code, 409)
+        finally:
+            del backend._move_file
+
+        self.assertEqual(self.list_files(), [])
+        self.assertEqual(os.listdir(backend._get_draft_data_path(self.draft_id)), [])
+
+    def test_batch_concurrent_replace(self):
+        path, data = sorted(self.files.items())[0]
+        json_response(self.post_batch({'files' : [(io.BytesIO(data), path)]}), 200)
+
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/fingerprints')
+        fps = pickle.loads(response.get_data())
+
+        new_data = data[:1000] + b'modified' + data[1000:]
+        other_data = os.urandom(1000) + data
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(new_data)
+            tmp.flush()
+            new_fps = librp.get_file_fingerprints(tmp.name)
+
+        known = set(fp[2] for fp in fps[path])
+        fields = {'replace.fingerprints' : [(io.BytesIO(pickle.dumps(new_fps)), path)],
+                  'replace.parts' : [ (io.BytesIO(new_data[offset:offset+size]), 
+                                       '{}.__part_{}_{}__'.format(path, offset, size))
+                                            for offset, size, hv in new_fps if hv not in known ]}
+
+        # another upload replaces the file while the batch is processed
+        backend = self.repo.backend
+        process_batch_item = backend._process_batch_item
+
+        def racing(draft, tree, item, server_fps):
+            if not hasattr(racing, 'done'):
+                racing.done = True
+                dst_file = os.path.join(backend._get_draft_data_path(self.draft_id), path)
+
+                with backend._draft_lock(self.draft_id):
+                    with open(dst_file + '.new', 'wb') as outfile:
+                        outfile.write(other_data)
+                    os.replace(dst_file + '.new', dst_file)
+
+                    other_fps, _ = backend._compute_fingerprints(dst_file)
+                    backend._save_draft_fingerprints(self.draft_id, { path : other_fps })
+
+            return process_batch_item(draft, tree, item, server_fps)
+
+        backend._process_batch_item = racing
+
+        try:
+            response = self.post_batch(fields)
+        finally:
+            del backend._process_batch_item
+
+        # the file is either rebuilt from its new contents or the batch fails,
+        # but it is never rebuilt from the old fingerprints
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/' + path)
+        self.assertIn(response.get_data(), (new_data, other_data))
+
+class ChunkDigestTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.draft_id = self.create_draft()
+
+        self.data = os.urandom(512*1024)
+
+        response = self.put_file({'file' : (io.BytesIO(self.data), 'data.bin')})
+        json_response(response, 200)
+
+    def put_file(self, fields, replace=False):
+        return self.app.put('/api/v1.2/drafts/' + self.draft_id + 
+                            ('?replace=true' if replace else ''),
+                            content_type='multipart/form-data',
+                            headers={'content-disposition' : 'attachment; filename=data.bin'},
+                            data=fields)
+
+    def file_fingerprints(self):
+        return self.get_fingerprints(self.draft_id)['data.bin']
+
+    def replace_fields(self, new_data, new_fps):
+        known = set(fp[2] for fp in self.file_fingerprints())
+
+        return {
+            'fingerprints' : (io.BytesIO(pickle.dumps(new_fps)), 'data.bin.fps'),
+            'parts' : [ (io.BytesIO(new_data[fp[0]:fp[0]+fp[1]]), 
+                         'data.bin.__part_{}_{}__'.format(fp[0], fp[1])) 
+                            for fp in new_fps if fp[2] not in known ]
+        }
+
+    ### tests begin here ###
+    def test_chunk_digests(self):
+        fps = self.file_fingerprints()
+
+        for offset, size, hv, digest in fps:
+            self.assertEqual(digest, hashlib.sha256(self.data[offset:offset+size]).digest())
+
+    def test_replace_computes_digests(self):
+        new_data = self.data[:1000] + b'modified' + self.data[1000:]
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(new_data)
+            tmp.flush()
+            new_fps = librp.get_file_fingerprints(tmp.name)
+
+        # fingerprints without digests (i.e. from older clients) are accepted
+        response = self.put_file(self.replace_fields(new_data, new_fps), replace=True)
+        draft = json_response(response, 200)['draft']
+
+        self.assertEqual(draft['contents'][0]['sha256'], hashlib.sha256(new_data).hexdigest())
+
+        for offset, size, hv, digest in self.file_fingerprints():
+            self.assertEqual(digest, hashlib.sha256(new_data[offset:offset+size]).digest())
+
+    def test_replace_rejects_wrong_digests(self):
+        new_data = self.data[:1000] + b'modified' + self.data[1000:]
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(new_data)
+            tmp.flush()
+            new_fps = [ (offset, size, hv, b'\0' * 32) for offset, size, hv in 
+                            librp.get_file_fingerprints(tmp.name) ]
+
+        response = self.put_file(self.replace_fields(new_data, new_fps), replace=True)
+        self.assertEqual(response.status_code, 409)
+
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/data.bin')
+        self.assertEqual(response.get_data(), self.data)
+
+class FingerprintMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(42)
+
+        # a small pool of chunks, so that files share many of them
+        pool = [ (rng.choice([1, 2, 3]), rng.randrange(10), 
+                  rng.choice([None, b'a' * 32, b'b' * 32])) for _ in range(20) ]
+
+        def make_fps(n):
+            fps = []
+            offset = 0
+            for size, hv, digest in (rng.choice(pool) for _ in range(n)):
+                fps.append((offset, size, hv) if digest is None else (offset, size, hv, digest))
+                offset += size
+            return fps
+
+        self.cases = [ (make_fps(rng.randrange(50)), make_fps(rng.randrange(50))) 
+                            for _ in range(200) ]
+
+    def plan(self, new_fps, old_fps, vectorized):
+        np = fingerprints_module.np
+
+        if not vectorized:
+            fingerprints_module.np = None
+
+        try:
+            return fingerprints_module.plan_rebuild(new_fps, old_fps)
+        finally:
+            fingerprints_module.np = np
+
+    def check_plan(self, runs, new_fps, old_fps):
+        old_chunks = { fp[0] : fp for fp in old_fps }
+
+        self.assertEqual([ i for first, last, _ in runs for i in range(first, last) ], 
+                         list(range(len(new_fps))))
+
+        for first, last, old_offset in runs:
+            if old_offset is None:
+                self.assertEqual(last, first + 1)
+                continue
+
+            for fp in new_fps[first:last]:
+                self.assertTrue(fingerprints_module.same_chunk(fp, old_chunks[old_offset]))
+                old_offset += fp[1]
+
+    ### tests begin here ###
+    def test_plan_rebuild(self):
+        for new_fps, old_fps in self.cases:
+            self.check_plan(self.plan(new_fps, old_fps, False), new_fps, old_fps)
+
+    @unittest.skipIf(fingerprints_module.np is None, "requires NumPy")
+    def test_plan_rebuild_vectorized(self):
+        for new_fps, old_fps in self.cases:
+            runs = self.plan(new_fps, old_fps, True)
+            self.check_plan(runs, new_fps, old_fps)
+
+            # both implementations must produce the same plan
+            self.assertEqual(runs, self.plan(new_fps, old_fps, False))
+
+@unittest.skipIf(not hasattr(librp, 'set_average_block_size'), 
+                 "pyrabin does not support setting the chunking parameters")
+class ChunkingProfileTest(RepositoryTestCase):
+
+    params = { 'min_block_size' : 1024, 'average_block_size' : 4096, 
+               'max_block_size' : 32768 }
+
+    def setUp(self):
+        super().setUp()
+
+        self.saved_profiles = app.config.get('DD_CHUNKING_PROFILES')
+        app.config['DD_CHUNKING_PROFILES'] = { 'small' : self.params }
+
+        self.data = os.urandom(256*1024)
+
+    def tearDown(self):
+        app.config['DD_CHUNKING_PROFILES'] = self.saved_profiles
+        super().tearDown()
+
+    ### tests begin here ###
+    def test_unknown_profile(self):
+        response = self.app.post('/api/v1.2/drafts/?chunking=missing')
+        self.assertEqual(response.status_code, 400)
+
+    def test_profile_is_honored(self):
+        response = self.app.post('/api/v1.2/drafts/?chunking=small')
+        draft = json_response(response, 201)['draft']
+        self.assertEqual(draft['chunking'], self.params)
+
+        self.upload(draft['id'], 'data.bin', self.data)
+
+        response = self.app.get('/api/v1.2/drafts/' + draft['id'] + '/fingerprints')
+        self.assertEqual(json.loads(response.headers['X-DDReplay-Chunking']), self.params)
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(self.data)
+            tmp.flush()
+            expected = chunking.get_file_fingerprints(tmp.name, self.params)
+
+        fps = pickle.loads(response.get_data())['data.bin']
+        self.assertEqual([ fp[0:3] for fp in fps ], expected)
+
+        # the parameters are kept by the dataset and the drafts created from it
+        PID = self.publish(draft['id'])['PID']
+
+        self.assertEqual(self.repo.lookup_dataset(PID)['chunking'], self.params)
+
+        response = self.app.put('/api/v1.2/datasets/' + PID + '/')
+        self.assertEqual(json_response(response, 201)['draft']['chunking'], self.params)
+
+class FastCDCTest(RepositoryTestCase):
+
+    params = { 'algorithm' : 'fastcdc', 'average_block_size' : 4096 }
+
+    def setUp(self):
+        super().setUp()
+
+        self.saved_profiles = app.config.get('DD_CHUNKING_PROFILES')
+        app.config['DD_CHUNKING_PROFILES'] = { 'fast' : self.params }
+
+        self.data = os.urandom(512*1024)
+
+    def tearDown(self):
+        app.config['DD_CHUNKING_PROFILES'] = self.saved_profiles
+        super().tearDown()
+
+    def chunks(self, data, params=None):
+        return [ (offset, bytes(chunk)) for offset, chunk in 
+                    fastcdc.iter_chunks(io.BytesIO(data), params) ]
+
+    ### tests begin here ###
+    def test_chunk_sizes(self):
+        chunks = self.chunks(self.data)
+
+        self.assertEqual(b''.join(c for _, c in chunks), self.data)
+        self.assertEqual(self.chunks(b''), [])
+
+        for offset, chunk in chunks[:-1]:
+            self.assertTrue(fastcdc.DEFAULT_PARAMETERS['min_block_size'] <= len(chunk) <= 
+                            fastcdc.DEFAULT_PARAMETERS['max_block_size'])
+
+    def test_edits_keep_boundaries(self):
+        chunks = self.chunks(self.data)
+        edited = self.data[:100000] + b'inserted' + self.data[100000:]
+
+        # only the chunks around the insertion should change
+        new_chunks = set(c for _, c in self.chunks(edited))
+        changed = [ c for _, c in chunks if c not in new_chunks ]
+        self.assertLessEqual(len(changed), 2)
+
+    def test_fallback_is_equivalent(self):
+        params = { 'min_block_size' : 256, 'average_block_size' : 1024, 
+                   'max_block_size' : 4096 }
+        expected = self.chunks(self.data, params)
+
+        np = fastcdc.np
+        fastcdc.np = None
+        try:
+            self.assertEqual(self.chunks(self.data, params), expected)
+        finally:
+            fastcdc.np = np
+
+    def test_validation(self):
+        self.assertEqual(chunking.validate_chunking({ 'algorithm' : 'rabin' }), None)
+        self.assertEqual(chunking.validate_chunking(self.params), self.params)
+
+        for params in ({ 'algorithm' : 'missing' },
+                       { 'algorithm' : 'fastcdc', 'window_size' : 32 },
+                       { 'algorithm' : 'fastcdc', 'min_block_size' : 16 },
+                       { 'algorithm' : 'fastcdc', 'average_block_size' : 128*1024 }):
+            with self.assertRaises(ValueError):
+                chunking.validate_chunking(params)
+
+    def test_fastcdc_dataset(self):
+        response = self.app.post('/api/v1.2/drafts/?chunking=fast')
+        draft = json_response(response, 201)['draft']
+        self.assertEqual(draft['chunking'], self.params)
+
+        self.upload(draft['id'], 'data.bin', self.data)
+
+        response = self.app.get('/api/v1.2/drafts/' + draft['id'] + '/fingerprints')
+        self.assertEqual(json.loads(response.headers['X-DDReplay-Chunking']), self.params)
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(self.data)
+            tmp.flush()
+            expected, digest = chunking.fingerprint_file(tmp.name, self.params)
+
+        self.assertEqual(pickle.loads(response.get_data())['data.bin'], expected)
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+
+class FingerprintOverlayTest(RepositoryTestCase):
+
+    def upload(self, draft_id, relpath):
+        super().upload(draft_id, relpath, os.urandom(64*1024))
+
+    ### tests begin here ###
+    def test_drafts_share_version_fingerprints(self):
+        DID = self.create_draft()
+
+        for name in ('a.bin', 'b.bin'):
+            self.upload(DID, name)
+
+        version = self.publish(DID)
+        PID = version['PID']
+        version_fps = self.repo.lookup_version_fingerprints(PID, version['id'])
+
+        # the new draft references the version's fingerprints
+        DID = self.new_draft(PID)['id']
+        backend = self.repo.backend
+        _, _, overlay_path = backend._get_draft_metadata_paths(DID)
+        _, _, version_fps_path = backend._get_version_metadata_paths(PID, version['id'])
+
+        self.assertFalse(os.path.exists(overlay_path))
+        self.assertTrue(os.path.samefile(backend._get_draft_base_fingerprints_path(DID), 
+                                         version_fps_path))
+        self.assertEqual(self.get_fingerprints(DID), version_fps)
+
+        # uploads only store the changed paths
+        self.upload(DID, 'c.bin')
+
+        with open(overlay_path, 'rb') as infile:
+            self.assertEqual(list(pickle.load(infile)), ['c.bin'])
+
+        fps = self.get_fingerprints(DID)
+        self.assertEqual(sorted(fps), ['a.bin', 'b.bin', 'c.bin'])
+        self.assertEqual(dict(self.repo.lookup_draft_fingerprints(DID)), fps)
+
+        # and publishing compacts them into a new set
+        version = self.publish(DID)
+        self.assertEqual(self.repo.lookup_version_fingerprints(PID, version['id']), fps)
+
+        # the fingerprints of the parent version are removed, but drafts 
+        # created from it keep them
+        DID = self.new_draft(PID)['id']
+        self.publish(self.new_draft(PID)['id'])
+
+        self.assertEqual(self.get_fingerprints(DID), fps)
+
+    def test_unchanged_draft(self):
+        DID = self.create_draft()
+        self.upload(DID, 'a.bin')
+        PID = self.publish(DID)['PID']
+
+        version = self.publish(self.new_draft(PID)['id'])
+
+        backend = self.repo.backend
+        _, _, fps_path = backend._get_version_metadata_paths(PID, version['id'])
+
+        self.assertEqual(list(backend._load_fingerprints(fps_path)), ['a.bin'])
+        self.assertEqual(list(backend.find_garbage()), [])
+
+class LayeredDraftTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.data = { name : os.urandom(32*1024) for name in ('a.bin', 'd/b.bin', 'c.bin') }
+
+    def file_list(self, url):
+        response = self.app.get(url)
+        return [ f['path'] for f in json_response(response, 200)['files'] ]
+
+    ### tests begin here ###
+    def test_draft_is_layered(self):
+        PID = self.create_dataset(['a.bin', 'd/b.bin'])['PID']
+        draft = self.new_draft(PID)
+        DID = draft['id']
+
+        # nothing is copied or linked into the draft
+        draft_path = self.repo.backend._get_draft_data_path(DID)
+        self.assertEqual(os.listdir(draft_path), [])
+
+        # but the files of the parent version are visible
+        self.assertEqual(self.file_list('/api/v1.2/drafts/' + DID + '/files/'), 
+                         ['a.bin', 'd/b.bin'])
+
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/d/b.bin')
+        self.assertEqual(response.get_data(), self.data['d/b.bin'])
+
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/../' + DID + '/a.bin')
+        self.assertEqual(response.status_code, 404)
+
+        # files of the parent version cannot be created again
+        filename = 'a.bin'
+        response = self.app.put('/api/v1.2/drafts/' + DID, content_type='multipart/form-data',
+                        headers={'content-disposition' : 'attachment; filename=' + filename},
+                        data={'file' : (io.BytesIO(b'foo'), filename)})
+        self.assertEqual(response.status_code, 409)
+
+        self.upload(DID, 'c.bin')
+        self.assertEqual(os.listdir(draft_path), ['c.bin'])
+
+        record = self.app.get('/api/v1.2/drafts/' + DID + '/record')
+        contents = json_response(record, 200)['draft']['contents']
+        self.assertEqual(sorted(e['path'] for e in contents), ['a.bin', 'c.bin', 'd'])
+
+    def test_publish_shares_unchanged_files(self):
+        parent = self.create_dataset(['a.bin', 'd/b.bin'])
+        PID = parent['PID']
+        DID = self.new_draft(PID)['id']
+        self.upload(DID, 'c.bin')
+
+        version = self.publish(DID)
+
+        self.assertEqual(self.file_list('/api/v1.2/datasets/' + PID + '/files/'),
+                         ['a.bin', 'c.bin', 'd/b.bin'])
+
+        backend = self.repo.backend
+        parent_path = backend._get_version_data_path(PID, parent['id'])
+        version_path = backend._get_version_data_path(PID, version['id'])
+
+        for relpath in ('a.bin', 'd/b.bin'):
+            self.assertTrue(os.path.samefile(os.path.join(parent_path, relpath),
+                                             os.path.join(version_path, relpath)))
+
+        for relpath, data in self.data.items():
+            response = self.app.get('/api/v1.2/datasets/' + PID + '/files/' + relpath)
+            self.assertEqual(response.get_data(), data)
+
+    def test_whiteouts(self):
+        PID = self.create_dataset(['a.bin', 'd/b.bin'])['PID']
+        DID = self.new_draft(PID)['id']
+
+        draft, _, _ = self.repo.lookup_draft(DID)
+        draft['whiteouts'] = ['d']
+        self.repo.backend.save_draft_record(draft)
+
+        self.assertEqual(self.file_list('/api/v1.2/drafts/' + DID + '/files/'), ['a.bin'])
+
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/d/b.bin')
+        self.assertEqual(response.status_code, 404)
+
+        # files added to the draft are not hidden
+        self.upload(DID, 'd/b.bin')
+        self.assertEqual(self.file_list('/api/v1.2/drafts/' + DID + '/files/'), 
+                         ['a.bin', 'd/b.bin'])
+
+        draft, _, _ = self.repo.lookup_draft(DID)
+        draft['whiteouts'] = ['a.bin', 'd']
+        self.repo.backend.save_draft_record(draft)
+
+        self.publish(DID)
+        self.assertEqual(self.file_list('/api/v1.2/datasets/' + PID + '/files/'), ['d/b.bin'])
+
+class DraftDeletionTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.data = { name : os.urandom(32*1024) 
+                        for name in ('a.bin', 'd/b.bin', 'd/e/f.bin', 'c.bin') }
+
+    def delete(self, draft_id, relpath, code=200):
+        response = self.app.delete('/api/v1.2/drafts/' + draft_id + '/' + relpath)
+        return json_response(response, code) if code == 200 else response
+
+    ### tests begin here ###
+    def test_delete_from_draft(self):
+        DID = self.create_draft(['a.bin', 'd/b.bin', 'd/e/f.bin'])
+
+        draft = self.delete(DID, 'a.bin')['draft']
+        self.assertEqual(self.paths(draft['contents']), ['d', 'd/b.bin', 'd/e', 'd/e/f.bin'])
+        self.assertNotIn('a.bin', self.get_fingerprints(DID))
+
+        draft = self.delete(DID, 'd/e')['draft']
+        self.assertEqual(self.paths(draft['contents']), ['d', 'd/b.bin'])
+
+        # the record matches a full scan of the draft's data
+        record, _, _ = self.repo.lookup_draft(DID)
+        self.assertEqual(self.paths(record['contents']), 
+                         self.paths(self.repo.backend._load_draft_contents(record)))
+
+        self.assertEqual(self.delete(DID, 'a.bin', 404).status_code, 404)
+        self.assertEqual(self.delete(DID, 'd/../../x', 400).status_code, 400)
+
+        # the draft itself is still there
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/record')
+        json_response(response, 200)
+
+        self.upload(DID, 'a.bin')
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/a.bin')
+        self.assertEqual(response.get_data(), self.data['a.bin'])
+
+    def test_delete_from_dataset_draft(self):
+        src = self.create_draft(['a.bin', 'd/b.bin', 'd/e/f.bin'])
+        parent = self.publish(src)
+        PID = parent['PID']
+
+        DID = self.new_draft(PID)['id']
+        self.upload(DID, 'c.bin')
+
+        self.delete(DID, 'd/e/f.bin')
+        draft = self.delete(DID, 'd')['draft']
+
+        # nested whiteouts are folded into the one of the directory
+        self.assertEqual(draft['whiteouts'], ['d'])
+        self.assertEqual(self.paths(draft['contents']), ['a.bin', 'c.bin'])
+
+        fps = self.get_fingerprints(DID)
+        self.assertEqual(sorted(fps), ['a.bin', 'c.bin'])
+
+        # the parent version is left untouched
+        backend = self.repo.backend
+        parent_path = backend._get_version_data_path(PID, parent['id'])
+        self.assertTrue(os.path.exists(os.path.join(parent_path, 'd', 'e', 'f.bin')))
+        self.assertIn('d/e/f.bin', backend.load_version_fingerprints(PID, parent['id']))
+
+        version = self.publish(DID)
+
+        response = self.app.get('/api/v1.2/datasets/' + PID + '/files/')
+        self.assertEqual([ f['path'] for f in json_response(response, 200)['files'] ], 
+                         ['a.bin', 'c.bin'])
+
+        fps = backend.load_version_fingerprints(PID, version['id'])
+        self.assertEqual(sorted(fps), ['a.bin', 'c.bin'])
+
+
+class DraftMoveCopyTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.data = { name : os.urandom(32*1024) 
+                        for name in ('a.bin', 'd/b.bin', 'd/e/f.bin') }
+
+    def transfer(self, op, draft_id, source, destination, code=200):
+        response = self.app.post('/api/v1.2/drafts/' + draft_id + '/' + op + 
+                                 '?source=' + source + '&destination=' + destination)
+        if code != 200:
+            self.assertEqual(response.status_code, code)
+            return None
+        return json_response(response, 200)['draft']
+
+    def check_files(self, url, expected):
+        response = self.app.get(url)
+        self.assertEqual(sorted(f['path'] for f in json_response(response, 200)['files']),
+                         sorted(expected))
+
+        for relpath, original in expected.items():
+            response = self.app.get(url + relpath)
+            self.assertEqual(response.get_data(), self.data[original])
+
+    ### tests begin here ###
+    def test_move_and_copy(self):
+        DID = self.create_draft(sorted(self.data))
+        draft_path = self.repo.backend._get_draft_data_path(DID)
+        before = self.repo.lookup_draft_fingerprints(DID)
+
+        draft = self.transfer('move', DID, 'a.bin', 'x/a2.bin')
+        self.assertEqual(self.paths(draft['contents']), 
+                         ['d', 'd/b.bin', 'd/e', 'd/e/f.bin', 'x', 'x/a2.bin'])
+
+        draft = self.transfer('copy', DID, 'd', 'y')
+        self.assertTrue(os.path.samefile(os.path.join(draft_path, 'd', 'e', 'f.bin'),
+                                         os.path.join(draft_path, 'y', 'e', 'f.bin')))
+
+        self.check_files('/api/v1.2/drafts/' + DID + '/files/', 
+                         { 'x/a2.bin' : 'a.bin', 'd/b.bin' : 'd/b.bin', 
+                           'd/e/f.bin' : 'd/e/f.bin', 'y/b.bin' : 'd/b.bin', 
+                           'y/e/f.bin' : 'd/e/f.bin' })
+
+        # the record matches a full scan of the draft's data
+        record, _, _ = self.repo.lookup_draft(DID)
+        self.assertEqual(self.paths(record['contents']), 
+                         self.paths(self.repo.backend._load_draft_contents(record)))
+
+        # the fingerprints follow the files
+        fps = self.repo.lookup_draft_fingerprints(DID)
+        self.assertEqual(fps['x/a2.bin'], fingerprints_module.lookup_file_fingerprints(before, 'a.bin'))
+        self.assertEqual(fps['y/e/f.bin'], fingerprints_module.lookup_file_fingerprints(before, 'd/e/f.bin'))
+        self.assertNotIn('a.bin', fps)
+
+        self.transfer('move', DID, 'a.bin', 'z.bin', 404)
+        self.transfer('move', DID, 'd', 'y', 409)
+        self.transfer('move', DID, 'd', 'x/a2.bin/z', 409)
+        self.transfer('move', DID, 'd', 'd/z', 400)
+        self.transfer('copy', DID, 'd', '../z', 400)
+
+    def test_move_in_dataset_draft(self):
+        src = self.create_draft(sorted(self.data))
+        parent = self.publish(src)
+        PID = parent['PID']
+
+        DID = self.new_draft(PID)['id']
+        before = self.repo.lookup_draft_fingerprints(DID)
+
+        draft = self.transfer('move', DID, 'd', 'z')
+        self.assertEqual(draft['whiteouts'], ['d'])
+        self.assertEqual(self.paths(draft['contents']), 
+                         ['a.bin', 'z', 'z/b.bin', 'z/e', 'z/e/f.bin'])
+
+        # the files of the parent version are linked, not copied
+        backend = self.repo.backend
+        parent_path = backend._get_version_data_path(PID, parent['id'])
+        draft_path = backend._get_draft_data_path(DID)
+        self.assertTrue(os.path.samefile(os.path.join(parent_path, 'd', 'b.bin'),
+                                         os.path.join(draft_path, 'z', 'b.bin')))
+
+        fps = self.repo.lookup_draft_fingerprints(DID)
+        self.assertEqual(fps['z/b.bin'], fingerprints_module.lookup_file_fingerprints(before, 'd/b.bin'))
+
+        self.publish(DID)
+
+        self.check_files('/api/v1.2/datasets/' + PID + '/files/', 
+                         { 'a.bin' : 'a.bin', 'z/b.bin' : 'd/b.bin', 
+                           'z/e/f.bin' : 'd/e/f.bin' })
+
+        # the parent version is left untouched
+        self.check_files('/api/v1.2/datasets/' + PID + '/versions/' + parent['id'] + 
+                         '/files/', { p : p for p in self.data })
+
+
+class NestedReplaceTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.draft_id = self.create_draft()
+
+        # files with the same name in different directories
+        self.data = { 'd/e/x.bin' : os.urandom(256*1024), 'x.bin' : os.urandom(256*1024) }
+
+        for relpath in ('d/e/x.bin', 'x.bin'):
+            response = self.put_file(relpath, {'file' : (io.BytesIO(self.data[relpath]), 'x.bin')})
+            json_response(response, 200)
+
+    def put_file(self, relpath, fields, replace=False):
+        usr_path, _, filename = relpath.rpartition('/')
+
+        return self.app.put('/api/v1.2/drafts/' + self.draft_id + 
+                            ('/' + usr_path if usr_path else '') +
+                            ('?replace=true' if replace else ''),
+                            content_type='multipart/form-data',
+                            headers={'content-disposition' : 'attachment; filename=' + filename},
+                            data=fields)
+
+    ### tests begin here ###
+    def test_fingerprints_keyed_by_path(self):
+        self.assertEqual(sorted(self.get_fingerprints(self.draft_id)), ['d/e/x.bin', 'x.bin'])
+
+    def test_nested_replace_sends_deltas(self):
+        relpath = 'd/e/x.bin'
+        new_data = bytearray(self.data[relpath])
+        new_data[1000:1008] = b'modified'
+        new_data = bytes(new_data)
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(new_data)
+            tmp.flush()
+            new_fps = librp.get_file_fingerprints(tmp.name)
+
+        known = set(fp[2] for fp in self.get_fingerprints(self.draft_id)[relpath])
+        parts = [ (io.BytesIO(new_data[fp[0]:fp[0]+fp[1]]), 
+                   'x.bin.__part_{}_{}__'.format(fp[0], fp[1])) 
+                        for fp in new_fps if fp[2] not in known ]
+
+        self.assertLess(sum(fp[1] for fp in new_fps if fp[2] not in known), 
+                        len(new_data) // 2)
+
+        response = self.put_file(relpath, {
+            'fingerprints' : (io.BytesIO(pickle.dumps(new_fps)), 'x.bin.fps'),
+            'parts' : parts }, replace=True)
+        json_response(response, 200)
+
+        for path, data in ((relpath, new_data), ('x.bin', self.data['x.bin'])):
+            response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/' + path)
+            self.assertEqual(response.get_data(), data)
+
+    def test_concurrent_replace(self):
+        relpath = 'd/e/x.bin'
+        data = self.data[relpath]
+        new_data = data[:1000] + b'modified' + data[1000:]
+        other_data = os.urandom(1000) + data
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(new_data)
+            tmp.flush()
+            new_fps = librp.get_file_fingerprints(tmp.name)
+
+        known = set(fp[2] for fp in self.get_fingerprints(self.draft_id)[relpath])
+        parts = [ (io.BytesIO(new_data[fp[0]:fp[0]+fp[1]]), 
+                   'x.bin.__part_{}_{}__'.format(fp[0], fp[1])) 
+                        for fp in new_fps if fp[2] not in known ]
+
+        # another upload replaces the file while it is rebuilt
+        backend = self.repo.backend
+        rebuild_file = backend._rebuild_file
+
+        def racing(*args):
+            if not hasattr(racing, 'done'):
+                racing.done = True
+                dst_file = os.path.join(backend._get_draft_data_path(self.draft_id), relpath)
+
+                with backend._draft_lock(self.draft_id):
+                    with open(dst_file + '.new', 'wb') as outfile:
+                        outfile.write(other_data)
+                    os.replace(dst_file + '.new', dst_file)
+
+                    other_fps, _ = backend._compute_fingerprints(dst_file)
+                    fps = dict(backend._load_draft_overlay(self.draft_id))
+                    fps[relpath] = other_fps
+                    backend._save_draft_fingerprints(self.draft_id, fps)
+
+            return rebuild_file(*args)
+
+        backend._rebuild_file = racing
+
+        try:
+            self.put_file(relpath, {
+                'fingerprints' : (io.BytesIO(pickle.dumps(new_fps)), 'x.bin.fps'),
+                'parts' : parts }, replace=True)
+        finally:
+            del backend._rebuild_file
+
+        # the file is either rebuilt from its new contents or the replace 
+        # fails, but its data and fingerprints always match
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/' + relpath)
+        data = response.get_data()
+        self.assertIn(data, (new_data, other_data))
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(data)
+            tmp.flush()
+            expected = librp.get_file_fingerprints(tmp.name)
+
+        self.assertEqual([ tuple(fp[:3]) for fp in self.get_fingerprints(self.draft_id)[relpath] ], 
+                         [ tuple(fp) for fp in expected ])
+
+    def test_replace_without_fingerprints(self):
+        relpath = 'd/e/x.bin'
+        backend = self.repo.backend
+
+        fps = dict(backend._load_draft_overlay(self.draft_id))
+        del fps[relpath]
+        backend._save_draft_fingerprints(self.draft_id, fps)
+
+        new_fps = librp.get_file_fingerprints(__file__)
+        response = self.put_file(relpath, {
+            'fingerprints' : (io.BytesIO(pickle.dumps(new_fps)), 'x.bin.fps'),
+            'parts' : [] }, replace=True)
+
+        # the fingerprints of the other x.bin are never used
+        self.assertEqual(response.status_code, 409)
+        self.assertIn(b'Replacement target does not exist', response.get_data())
+        self.assertEqual(os.listdir(backend.config['TMP_FOLDER']), [])
+
+    def test_legacy_fingerprints_rekeyed(self):
+        response = self.put_file('d/y.bin', {'file' : (io.BytesIO(b'y' * 1000), 'y.bin')})
+        json_response(response, 200)
+
+        # older servers keyed the files created by a single upload by their
+        # name only
+        backend = self.repo.backend
+        fps = dict(backend._load_draft_overlay(self.draft_id))
+        fps['y.bin'] = fps.pop('d/y.bin')
+
+        _, _, fps_path = backend._get_draft_metadata_paths(self.draft_id)
+        with open(fps_path + '.new', 'wb') as outfile:
+            pickle.dump(fps, outfile)
+        os.replace(fps_path + '.new', fps_path)
+
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/fingerprints')
+        self.assertEqual(response.headers['X-DDReplay-Fingerprint-Keys'], 'path')
+        self.assertEqual(sorted(pickle.loads(response.get_data())), 
+                         ['d/e/x.bin', 'd/y.bin', 'x.bin'])
+
+        # the rekeyed set is stored once the fingerprints of the draft change
+        response = self.put_file('z.bin', {'file' : (io.BytesIO(b'z'), 'z.bin')})
+        json_response(response, 200)
+
+        with open(fps_path, 'rb') as infile:
+            self.assertEqual(sorted(pickle.load(infile)), 
+                             ['d/e/x.bin', 'd/y.bin', 'x.bin', 'z.bin'])
+
+    def test_fingerprints_replaced_atomically(self):
+        _, _, fps_path = self.repo.backend._get_draft_metadata_paths(self.draft_id)
+        before = os.stat(fps_path).st_ino
+
+        response = self.put_file('y.bin', {'file' : (io.BytesIO(b'y'), 'y.bin')})
+        json_response(response, 200)
+
+        # the file is never rewritten in place, so readers see either the 
+        # old or the new fingerprints
+        self.assertNotEqual(os.stat(fps_path).st_ino, before)
+        self.assertEqual(sorted(self.get_fingerprints(self.draft_id)), ['d/e/x.bin', 'x.bin', 'y.bin'])
+
+
+class UnpackTest(RepositoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.draft_id = self.create_draft()
+
+        archive = io.BytesIO()
+
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name in ['a.bin', 'd/b.bin']:
+                info = tarfile.TarInfo(name)
+                info.size = 1000
+                tar.addfile(info, io.BytesIO(b'a' * 1000))
+
+        self.archive = archive.getvalue()
+
+    def unpack(self):
+        return self.app.put('/api/v1.2/drafts/' + self.draft_id + '?unpack=true',
+                            content_type='multipart/form-data',
+                            headers={'content-disposition' : 'attachment; filename=data.tar.gz'},
+                            data={'file' : (io.BytesIO(self.archive), 'data.tar.gz')})
+
+    def draft_files(self):
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/')
+        return sorted(f['path'] for f in json_response(response, 200)['files'])
+
+    ### tests begin here ###
+    def test_unpack(self):
+        json_response(self.unpack(), 200)
+
+        self.assertEqual(self.draft_files(), ['a.bin', 'd/b.bin'])
+        self.assertEqual(sorted(self.get_fingerprints(self.draft_id)), ['a.bin', 'd/b.bin'])
+
+        # the files cannot be unpacked twice
+        response = self.unpack()
+        self.assertEqual(json_response(response, 409)['error'], 'Destination path already exists')
+
+    def test_concurrent_unpack(self):
+        backend = self.repo.backend
+        original = backend._compute_fingerprints
+        data = os.urandom(100)
+
+        # one of the files is uploaded while the archive is being unpacked
+        # (by another thread, as another request would)
+        def upload_meanwhile(*args):
+            if backend._compute_fingerprints is upload_meanwhile:
+                backend._compute_fingerprints = original
+
+                uploader = threading.Thread(target=self.upload, args=(self.draft_id, 'd/b.bin', data))
+                uploader.start()
+                uploader.join()
+
+            return original(*args)
+
+        backend._compute_fingerprints = upload_meanwhile
+
+        response = self.unpack()
+        self.assertEqual(response.status_code, 409)
+
+        # nothing was unpacked and the uploaded file was kept
+        self.assertEqual(self.draft_files(), ['d/b.bin'])
+        self.assertEqual(sorted(self.get_fingerprints(self.draft_id)), ['d/b.bin'])
+
+        response = self.app.get('/api/v1.2/drafts/' + self.draft_id + '/files/d/b.bin')
+        self.assertEqual(response.get_data(), data)
+
+class ShardedLayoutTest(RepositoryTestCase):
+
+    def flatten(self):
+        """ move all the entries of the repository to the flat layout of 
+        older versions """
+
+        for folder in ('datasets', os.path.join('drafts', 'data'), 
+                       os.path.join('drafts', 'metadata')):
+            path = os.path.join(self.repo_location, folder)
+
+            for shard in os.listdir(path):
+                for root, dirs, files in os.walk(os.path.join(path, shard)):
+                    if root.count(os.sep) - path.count(os.sep) == Filesystem.SHARD_LEVELS:
+                        for name in dirs + files:
+                            os.rename(os.path.join(root, name), os.path.join(path, name))
+                        dirs[:] = []
+
+                shutil.rmtree(os.path.join(path, shard))
+
+    def reopen(self):
+        self.repo = self.open_repository()
+        set_repository(self.repo)
+
+    def listing(self, url, key):
+        response = self.app.get('/api/v1.2/' + url)
+        return sorted(e[key] for e in json_response(response, 200)[url.rstrip('/')])
+
+    ### tests begin here ###
+    def test_sharded_paths(self):
+        PID = self.create_dataset({'a.bin' : b'a' * 1000})['PID']
+
+        DID = self.new_draft(PID)['id']
+
+        backend = self.repo.backend
+        self.assertEqual(os.listdir(os.path.join(self.repo_location, 'datasets')), 
+                         [ backend._shard(PID)[0] ])
+
+        dataset_path, _ = backend._get_dataset_paths(PID)
+        self.assertEqual(dataset_path, os.path.join(self.repo_location, 'datasets', 
+                                                    *backend._shard(PID), PID))
+
+        _, record_path, _ = backend._get_draft_metadata_paths(DID)
+        self.assertTrue(os.path.exists(record_path))
+        self.assertIn(os.path.join(*backend._shard(DID)), record_path)
+
+        self.assertEqual(self.listing('datasets/', 'PID'), [PID])
+        self.assertEqual(self.listing('drafts/', 'id'), [DID])
+        self.assertEqual(list(backend.find_garbage()), [])
+
+    def test_migration(self):
+        PID = self.create_dataset({'a.bin' : b'a' * 1000})['PID']
+
+        DID = self.new_draft(PID)['id']
+        self.upload(DID, 'b.bin', b'b' * 1000)
+
+        self.flatten()
+        self.reopen()
+
+        # entries in the flat layout are still found
+        self.assertTrue(self.repo.backend.legacy_layout)
+        self.assertEqual(self.listing('datasets/', 'PID'), [PID])
+        self.assertEqual(self.listing('drafts/', 'id'), [DID])
+
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/a.bin')
+        self.assertEqual(response.get_data(), b'a' * 1000)
+
+        moved = list(self.repo.backend.migrate_layout())
+        self.assertEqual(len(moved), 5)
+        self.assertFalse(self.repo.backend.legacy_layout)
+
+        for folder in ('datasets', os.path.join('drafts', 'data'), 
+                       os.path.join('drafts', 'metadata')):
+            self.assertTrue(all(Filesystem._is_shard(name) for name in 
+                                os.listdir(os.path.join(self.repo_location, folder))))
+
+        self.assertEqual(self.listing('drafts/', 'id'), [DID])
+
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/b.bin')
+        self.assertEqual(response.get_data(), b'b' * 1000)
+
+        self.publish(DID)
+
+        response = self.app.get('/api/v1.2/datasets/' + PID + '/files/a.bin')
+        self.assertEqual(response.get_data(), b'a' * 1000)
+
+        self.assertEqual(list(self.repo.backend.find_garbage()), [])
+
+    def test_legacy_empty_draft(self):
+        DID = self.create_draft()
+
+        self.flatten()
+        self.reopen()
+
+        # its fingerprints are stored next to its record
+        self.upload(DID, 'a.bin', b'a' * 1000)
+
+        draft, _, _ = self.repo.lookup_draft(DID)
+        self.assertEqual([ e['path'] for e in draft['contents'] ], ['a.bin'])
+
+        _, record_path, fps_path = self.repo.backend._get_draft_metadata_paths(DID)
+        self.assertEqual(os.path.dirname(fps_path), os.path.dirname(record_path))
+        self.assertEqual(list(self.repo.lookup_draft_fingerprints(DID)), ['a.bin'])
+
+        list(self.repo.backend.migrate_layout())
+
+        self.assertEqual(list(self.repo.lookup_draft_fingerprints(DID)), ['a.bin'])
+
+    def test_migration_rewritten_record(self):
+        DID = self.create_draft()
+
+        self.flatten()
+        self.reopen()
+
+        # a record written at both locations during the migration
+        backend = self.repo.backend
+        _, src, _ = backend._get_draft_metadata_paths(DID)
+        dst = os.path.join(self.repo_location, 'drafts', 'metadata', 
+                           *backend._shard(DID), DID + '.json')
+        os.makedirs(os.path.dirname(dst))
+        shutil.copy(src, dst)
+        os.utime(dst, (0, 0))
+
+        list(backend.migrate_layout())
+
+        self.assertFalse(os.path.exists(src))
+        self.assertNotEqual(os.stat(dst).st_mtime, 0)
+        self.assertEqual(self.listing('drafts/', 'id'), [DID])
+
+
+class RecordingObjectStore(LocalObjectStore):
+    """ a LocalObjectStore that records the parts and ranges transferred """
+
+    def __init__(self, root, **kwargs):
+        super().__init__(root, **kwargs)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _record(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def upload_part(self, key, upload_id, number, data):
+        self._record('upload_part', key, number)
+        return super().upload_part(key, upload_id, number, data)
+
+    def get(self, key, start=0, end=None):
+        self._record('get', key, start, end)
+        return super().get(key, start, end)
+
+    def copy(self, src_key, dst_key):
+        self._record('copy', src_key, dst_key)
+        return super().copy(src_key, dst_key)
+
+class ObjectStorageTest(RepositoryTestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+        # a store shared by two repositories, i.e. two nodes of the service
+        self.store_location = tempfile.mkdtemp()
+        self.store = RecordingObjectStore(self.store_location, part_size=1000)
+
+        self.repos = []
+        self.node_a = self.open_node()
+        self.node_b = self.open_node()
+        self.use_node(self.node_a)
+
+    def tearDown(self):
+        for repo in self.repos:
+            repo.destroy()
+
+        shutil.rmtree(self.store_location)
+
+    def open_node(self, cache_size=None):
+        repo = Repository(backend='objectstore', base_location=tempfile.mkdtemp(),
+                          permanent_remove=True, remove_fingerprints=True,
+                          object_store=self.store, cache_size=cache_size)
+        self.repos.append(repo)
+        return repo
+
+    def use_node(self, repo):
+        set_repository(repo)
+
+    def get_file(self, PID, relpath):
+        # (buffered, so that the response is closed once it has been read)
+        response = self.app.get('/api/v1.2/datasets/' + PID + '/files/' + relpath,
+                                buffered=True)
+        self.assertEqual(response.status_code, 200)
+        return response.get_data()
+
+    ### tests begin here ###
+    def test_transfers(self):
+        data = os.urandom(3500)
+        fd, src_file = tempfile.mkstemp()
+
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+
+        self.store.upload_file('a/b.bin', src_file)
+        self.assertEqual(sorted(c[2] for c in self.store.calls if c[0] == 'upload_part'),
+                         [1, 2, 3, 4])
+        self.assertEqual(self.store.size('a/b.bin'), 3500)
+        self.assertEqual(self.store.get('a/b.bin', 1000, 1010), data[1000:1010])
+
+        self.store.calls = []
+        self.store.download_file('a/b.bin', src_file)
+
+        with open(src_file, 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+
+        self.assertEqual(sorted(c[2:] for c in self.store.calls if c[0] == 'get'),
+                         [(0, 1000), (1000, 2000), (2000, 3000), (3000, 3500)])
+
+        self.store.copy('a/b.bin', 'c.bin')
+        self.assertEqual(list(self.store.list('')), ['a/b.bin', 'c.bin'])
+        self.assertEqual(list(self.store.list('a/')), ['a/b.bin'])
+
+        self.store.delete('c.bin')
+        self.assertIsNone(self.store.size('c.bin'))
+        self.assertRaises(KeyError, self.store.get, 'c.bin')
+        self.assertRaises(KeyError, self.store.download_file, 'c.bin', src_file)
+        self.assertRaises(ValueError, self.store.put, '../c.bin', b'')
+
+        # conditional writes
+        self.store.put_if_match('c.json', b'1', None)
+        self.assertRaises(ConflictError, self.store.put_if_match, 'c.json', b'2', None)
+
+        data, etag = self.store.get_with_etag('c.json')
+        self.store.put_if_match('c.json', b'2', etag)
+        self.assertRaises(ConflictError, self.store.put_if_match, 'c.json', b'3', etag)
+        self.assertEqual(self.store.get('c.json'), b'2')
+
+        os.remove(src_file)
+
+    def test_publish(self):
+        files = { 'a.bin' : os.urandom(2500), 'd/e/b.bin' : os.urandom(500) }
+        PID = self.create_dataset(files)['PID']
+
+        dataset = self.repos[0].lookup_dataset(PID)
+        VID = dataset['current']
+
+        keys = list(self.store.list(''))
+        self.assertIn('datasets/' + PID + '.json', keys)
+        self.assertIn('versions/' + PID + '/' + VID + '.json', keys)
+        self.assertIn('versions/' + PID + '/' + VID + '.fps', keys)
+        self.assertEqual(sorted(self.store.list('data/')), 
+                         [ 'data/' + PID + '/' + VID + '/' + relpath for relpath in sorted(files) ])
+
+        # the dataset is available from the other node
+        self.use_node(self.node_b)
+
+        response = self.app.get('/api/v1.2/datasets/')
+        self.assertEqual([ d['PID'] for d in json_response(response, 200)['datasets'] ], [PID])
+
+        for relpath, data in files.items():
+            self.assertEqual(self.get_file(PID, relpath), data)
+
+        self.assertEqual(sorted(self.repos[1].lookup_version_fingerprints(PID, VID)), 
+                         sorted(files))
+
+        # drafts created on the other node are layered over the cached data
+        DID = self.new_draft(PID)['id']
+
+        new_data = os.urandom(1500)
+        self.upload(DID, 'c.bin', new_data)
+
+        self.store.calls = []
+        version = self.publish(DID)
+
+        # unchanged files are copied inside the store
+        self.assertEqual(sorted(c[1:] for c in self.store.calls if c[0] == 'copy'),
+                [ ('data/' + PID + '/' + VID + '/' + relpath, 
+                   'data/' + PID + '/' + version['id'] + '/' + relpath) 
+                        for relpath in sorted(files) ])
+
+        self.use_node(self.node_a)
+
+        response = self.app.get('/api/v1.2/datasets/' + PID + '/versions/')
+        self.assertEqual(len(json_response(response, 200)['versions']), 2)
+
+        self.assertEqual(self.get_file(PID, 'c.bin'), new_data)
+        self.assertEqual(self.get_file(PID, 'd/e/b.bin'), files['d/e/b.bin'])
+
+        # the fingerprints of the old version were removed
+        self.assertIsNone(self.store.size('versions/' + PID + '/' + VID + '.fps'))
+
+    def test_cache_eviction(self):
+        first = self.create_dataset({ 'a.bin' : os.urandom(3000) })['PID']
+        second = self.create_dataset({ 'b.bin' : os.urandom(3000) })['PID']
+
+        node = self.open_node(cache_size=4000)
+        self.use_node(node)
+
+        def cached(PID):
+            dataset = node.lookup_dataset(PID)
+            return os.path.isdir(node.backend._get_version_data_path(PID, dataset['current']))
+
+        self.get_file(first, 'a.bin')
+        self.assertTrue(cached(first))
+
+        self.get_file(second, 'b.bin')
+        self.assertTrue(cached(second))
+        self.assertFalse(cached(first))
+
+        # the data is fetched again when needed
+        self.get_file(first, 'a.bin')
+        self.assertTrue(cached(first))
+        self.assertFalse(cached(second))
+
+        # versions with drafts based on them are kept (the drafts are not
+        # loaded again to find them)
+        DID = self.new_draft(first)['id']
+
+        node.backend.load_draft_records = None
+
+        self.get_file(second, 'b.bin')
+        self.assertTrue(cached(first))
+        self.assertTrue(cached(second))
+
+        # ... until the drafts are removed
+        response = self.app.delete('/api/v1.2/drafts/' + DID)
+        self.assertEqual(response.status_code, 204)
+
+        self.get_file(second, 'b.bin')
+        self.assertFalse(cached(first))
+
+        # versions are not evicted while they are being sent
+        response = self.app.get('/api/v1.2/datasets/' + first + '/')
+        self.assertEqual(response.status_code, 200)
+
+        self.get_file(second, 'b.bin')
+        self.assertTrue(cached(first))
+        self.assertTrue(cached(second))
+
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as pkg:
+            self.assertEqual(pkg.namelist(), ['a.bin'])
+
+        response.close()
+
+        self.get_file(second, 'b.bin')
+        self.assertFalse(cached(first))
+
+    def test_cache_lock_not_held(self):
+        first = self.create_dataset({ 'a.bin' : os.urandom(3000) })['PID']
+        second = self.create_dataset({ 'b.bin' : os.urandom(3000) })['PID']
+
+        node = self.open_node(cache_size=4000)
+        self.use_node(node)
+
+        backend = node.backend
+        calls = []
+
+        def unlocked(name):
+            original = getattr(backend, name)
+
+            def wrapper(*args):
+                calls.append((name, backend.cache_lock.locked()))
+                return original(*args)
+
+            setattr(backend, name, wrapper)
+
+        unlocked('_tree_size')
+        unlocked('_remove_directory')
+
+        # the versions are sized when fetched and the first one is evicted
+        self.get_file(first, 'a.bin')
+        self.get_file(second, 'b.bin')
+
+        self.assertIn(('_tree_size', False), calls)
+        self.assertIn(('_remove_directory', False), calls)
+        self.assertNotIn(('_tree_size', True), calls)
+        self.assertNotIn(('_remove_directory', True), calls)
+
+    def check_concurrent_publish(self, step):
+        files = { 'a.bin' : os.urandom(2500) }
+        PID = self.create_dataset(files)['PID']
+
+        # a draft on each node, and the one on node A is published while 
+        # node B is publishing its own (at ``step``)
+        response = self.app.put('/api/v1.2/datasets/' + PID + '/')
+        draft_a, _, _ = self.node_a.lookup_draft(json_response(response, 201)['draft']['id'])
+
+        self.use_node(self.node_b)
+        DID = self.new_draft(PID)['id']
+
+        new_data = os.urandom(1500)
+        self.upload(DID, 'c.bin', new_data)
+
+        backend = self.node_b.backend
+        original = getattr(backend, step)
+
+        def publish_elsewhere(*args):
+            self.node_a.publish_draft(draft_a, 'test', 'test')
+            return original(*args)
+
+        setattr(backend, step, publish_elsewhere)
+
+        response = self.app.post('/api/v1.2/drafts/' + DID + '/publish?author=test&message=test')
+        self.assertEqual(response.status_code, 409)
+
+        setattr(backend, step, original)
+
+        # the version of node A was kept and nothing remains of the other one
+        self.assertEqual(self.node_b.lookup_dataset(PID)['current'], draft_a['id'])
+        self.assertEqual([ k for k in self.store.list('') if DID in k ], [])
+
+        # the draft is still complete
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/c.bin')
+        self.assertEqual(response.get_data(), new_data)
+        response = self.app.get('/api/v1.2/drafts/' + DID + '/files/a.bin')
+        self.assertEqual(response.get_data(), files['a.bin'])
+
+        fps = self.node_b.lookup_draft_fingerprints(DID)
+        self.assertEqual(sorted(fps), ['a.bin', 'c.bin'])
+
+    def test_concurrent_publish(self):
+        # detected before anything is stored
+        self.check_concurrent_publish('save_dataset_record')
+
+    def test_concurrent_publish_undone(self):
+        # detected when the dataset record is uploaded
+        self.check_concurrent_publish('transfer_fingerprints_from_draft')
+
 if __name__ == "__main__":
     unittest.main()